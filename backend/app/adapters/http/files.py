@@ -1,21 +1,35 @@
-from typing import Callable
+from typing import BinaryIO, Callable
 from uuid import uuid4
+import hashlib
+import json
+import zipfile
 from pathlib import Path
+from datetime import datetime
 from mimetypes import guess_type
+from urllib.parse import quote
 from enum import Enum
 
-from fastapi import APIRouter, HTTPException, UploadFile, File, Query
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, UploadFile, File, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
-from rq.job import Job
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+from rq import Callback
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
 
-from app.infrastructure.redis_client import default_queue, redis_conn
-from app.infrastructure.storage import output_path, probe_any
-from app.app_tasks.process import process_file_task
+from app.core.config import get_settings
+from app.infrastructure.redis_client import redis_conn, async_redis_conn
+from app.infrastructure.storage import spool_input, remove_input
+from app.infrastructure import storage
+from app.infrastructure import result_cache, queues, admission, inline_pool, job_events, job_groups, retention, webhooks
+from app.app_tasks.process import process_file_task, on_job_success, on_job_failure
+from app.app_tasks import baoguan_dag
 import logging
 
 
 logger = logging.getLogger('router.file')
+settings = get_settings()
 
 
 router = APIRouter(prefix="/files", tags=["files"])
@@ -45,124 +59,583 @@ WORKER_MAP: dict[TaskType, Callable] = {
     TaskType.baoguan: process_file_task,
 }
 
-@router.post("", summary="上传并排队处理")
-async def upload(
-    file: UploadFile = File(...),
-    task_type: TaskType = Query(TaskType.text),
-):
-    raw = await file.read()
-    task_id = uuid4().hex
+def _reuse_cached(cache_key: str, task_id: str) -> dict | None:
+    """
+    命中已完成的缓存产物，或加入正在处理的相同任务时返回响应体；
+    返回 None 表示本次上传已抢到 in-flight 标记，需要正常投递。
+    """
+    hit = result_cache.lookup(redis_conn, cache_key)
+    if hit and redis_conn.exists(Job.key_for(hit["task_id"])):
+        logger.info(f"♻️ [上传接口] 命中结果缓存, task_id={hit['task_id']}")
+        return {"task_id": hit["task_id"], "status": JobStatus.FINISHED, "cached": True}
+
+    owner = result_cache.claim(redis_conn, cache_key, task_id)
+    if owner is None:
+        return None
+    try:
+        owner_status = Job.fetch(owner, connection=redis_conn).get_status(refresh=False)
+    except Exception:
+        owner_status = None
+    if owner_status in (None, JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED):
+        result_cache.force_claim(redis_conn, cache_key, task_id)
+        return None
+    logger.info(f"🔗 [上传接口] 相同输入正在处理，加入已有任务, task_id={owner}")
+    return {"task_id": owner, "status": owner_status, "cached": True}
+
+
+async def _callback_of(callback_url: str | None) -> str | None:
+    if not callback_url:
+        return None
+    try:
+        return await run_in_threadpool(webhooks.validate, callback_url)  # 要解析主机名
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def _join_callback(task_id: str, callback_url: str) -> None:
+    """
+    给复用的任务（命中缓存 / 加入进行中的相同任务）登记回调。
+    已经结束的不会再有 worker 回调，直接建投递；worker 先发布结束状态再读登记，两边都建时按 delivery_id 去重。
+    """
+    async with async_redis_conn.pipeline(transaction=False) as pipe:
+        webhooks.subscribe_cmds(pipe, task_id, callback_url)
+        await pipe.execute()
+    snap = await job_events.current_async(async_redis_conn, redis_conn, task_id)
+    if snap is None or snap["status"] not in job_events.TERMINAL:
+        return
+
+    def notify():
+        try:
+            job = Job.fetch(task_id, connection=redis_conn)
+        except NoSuchJobError:
+            return
+        webhooks.notify(redis_conn, job, snap["status"], snap["result"], urls=[callback_url])
+
+    await run_in_threadpool(notify)
+
+
+def _user_of(request: Request) -> str:
+    """准入按用户计数：优先取 ADMISSION_USER_HEADER 请求头，没有时按客户端 IP。"""
+    user = request.headers.get(settings.ADMISSION_USER_HEADER)
+    if user:
+        return user.strip()[:64]
+    return f"ip:{request.client.host}" if request.client else "ip:unknown"
+
+
+async def _try_inline(file: UploadFile) -> Response | None:
+    """同步快速通道：返回 zip 响应；返回 None 表示改走队列（文件指针已复位）。"""
+    raw = await file.read(settings.INLINE_MAX_BYTES + 1)
+    blob = None
+    if len(raw) <= settings.INLINE_MAX_BYTES:
+        try:
+            blob = await inline_pool.run_baoguan(raw)
+        except Exception as e:
+            logger.warning(f"⚠️ [上传接口] 同步生成失败, filename={file.filename}: {e}")
+            raise HTTPException(status_code=422, detail=f"报关资料生成失败: {e}")
+    if blob is None:
+        await file.seek(0)
+        return None
+
+    filename = f"baoguan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    logger.info(f"⚡ [上传接口] 同步生成完成, filename={file.filename}, size={len(raw)}, zip={len(blob)}")
+    return Response(
+        content=blob,
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Processing": "inline"},
+    )
+
+
+def _discard(input_key: str | None, cache_key: str | None, task_id: str) -> None:
+    """投递没有成功：删掉已落盘的输入，释放结果缓存的 in-flight 标记。"""
+    if input_key:
+        remove_input(input_key)
+    if cache_key:
+        result_cache.release(redis_conn, cache_key, task_id)
+
+
+def _reject(decision: admission.Decision, task_type: str, user: str) -> HTTPException:
+    logger.warning(
+        f"⛔ [上传接口] 拒绝, task_type={task_type}, user={user}, "
+        f"projected_wait={decision.projected_wait:.1f}s, retry_after={decision.retry_after}s, {decision.reason}"
+    )
+    return HTTPException(
+        status_code=429,
+        detail=decision.reason,
+        headers={"Retry-After": str(decision.retry_after)},
+    )
 
+
+async def _submit(
+    task_type: TaskType,
+    src: BinaryIO,
+    filename: str | None,
+    content_type: str | None,
+    user: str,
+    admitted: admission.Decision | None = None,
+    group_id: str | None = None,
+    callback_url: str | None = None,
+) -> dict:
+    """
+    落盘/读入一个上传文件并投递任务，返回 {task_id, status, cached}；失败抛 HTTPException。
+    admitted：调用方已经做过的准入判断（批量上传按整批、同步快速通道在进程池之前），为 None 时在这里判断。
+    """
+    task_id = uuid4().hex
     worker = WORKER_MAP.get(task_type)
     if not worker:
         raise HTTPException(status_code=400, detail=f"未知任务类型: {task_type}")
 
     default_ext = DEFAULT_EXT_MAP.get(task_type, "bin")
 
+    # 准入：预计排队时间超过预算 / 用户未完成任务过多时直接拒绝。
+    # 只看任务类型和用户，放在落盘、算哈希之前，被拒的上传不再写存储（繁忙时命中缓存的上传也一并拒绝）
+    decision = admitted
+    if decision is None:
+        decision = await run_in_threadpool(admission.check, redis_conn, task_type.value, user)
+        if not decision.admitted:
+            raise _reject(decision, task_type.value, user)
+
+    # spool：分块落盘，只把 input_key 投递给 RQ；inline：整包读入随任务投递
+    raw: bytes | None = None
+    input_key: str | None = None
+    if settings.UPLOAD_MODE == "spool":
+        try:
+            input_key, in_size, content_sha256 = await run_in_threadpool(spool_input, src, task_id)
+        except OSError as e:
+            raise HTTPException(status_code=500, detail=f"上传文件落盘失败: {e}")
+    else:
+        raw = await run_in_threadpool(src.read)
+        in_size = len(raw)
+        content_sha256 = hashlib.sha256(raw).hexdigest()
+
+    # 结果缓存：相同输入 + 任务类型 + 模板版本，直接复用已有产物 / 加入进行中的任务
+    cache_key: str | None = None
+    if result_cache.is_cacheable(task_type.value):
+        cache_key = result_cache.make_key(content_sha256, task_type.value)
+        reused = await run_in_threadpool(_reuse_cached, cache_key, task_id)
+        if reused:
+            if input_key:
+                await run_in_threadpool(remove_input, input_key)
+            if callback_url:
+                await _join_callback(reused["task_id"], callback_url)
+            return reused
+
+    queue = queues.queue_for(task_type.value)
+    meta = {
+        "user": user,
+        "task_type": task_type.value,  # 存成字符串，避免 Enum 反序列化问题
+        "expect_ext": default_ext,
+        "filename": filename,
+        "content_type": content_type,
+    }
+    if cache_key:
+        meta["cache_key"] = cache_key
+    if group_id:
+        meta["group_id"] = group_id
+    # job 记录按任务类型的保留期过期；可缓存 / 属于任务组的还要和缓存条目、任务组活得一样久，之后 /status 和组汇总才查得到
+    ttls = retention.job_ttls(task_type.value, at_least=max(
+        settings.RESULT_CACHE_TTL if cache_key else 0,
+        settings.JOB_GROUP_TTL if group_id else 0,
+    ))
+    final_kwargs = dict(
+        meta=meta,
+        **ttls,
+        on_success=Callback(on_job_success),
+        on_failure=Callback(on_job_failure),
+    )
+
+    def side_writes(pipe, job: Job) -> None:
+        """与任务一起写入：用户名下登记、回调地址（任务再快也不会错过）、queued 状态快照。"""
+        admission.track(redis_conn, user, task_id, pipeline=pipe)
+        if callback_url:
+            webhooks.subscribe_cmds(pipe, task_id, callback_url)
+        job_events.publish(redis_conn, job_events.queued(job), job, pipeline=pipe)
+
     try:
-        job = default_queue.enqueue(
-            worker,
-            task_id,
-            raw,
-            task_type=task_type.value,
-            ext=default_ext,
-            job_id=task_id,
-        )
+        if task_type == TaskType.baoguan and settings.BAOGUAN_DAG:
+            # 解析 -> 5 个构建 -> 打包 拆成任务图，返回的是 job_id=task_id 的打包任务；
+            # 整张图和 side_writes 在一个 MULTI/EXEC 里写完（RQ 的依赖登记只有同步接口，整体放进线程）
+            def enqueue_dag() -> Job:
+                pipe = redis_conn.pipeline()
+                job = baoguan_dag.enqueue(queue, task_id, raw, input_key, pipeline=pipe, **final_kwargs)
+                side_writes(pipe, job)
+                try:
+                    pipe.execute()
+                except Exception:
+                    baoguan_dag.discard(redis_conn, task_id)
+                    raise
+                return job
+
+            job = await run_in_threadpool(enqueue_dag)
+        else:
+            # job、入队、登记和状态快照在 redis.asyncio 上一个事务写完
+            job = await queues.enqueue_async(
+                async_redis_conn,
+                queue,
+                worker,
+                args=(task_id, raw),
+                kwargs=dict(task_type=task_type.value, ext=default_ext, input_key=input_key),
+                job_id=task_id,
+                extra=side_writes,
+                **final_kwargs,
+            )
     except Exception as e:
+        await run_in_threadpool(_discard, input_key, cache_key, task_id)
         raise HTTPException(status_code=500, detail=f"任务投递失败: {e}")
 
-    task_type_val = getattr(task_type, "value", str(task_type))
     logger.info(
         f"📥 [上传接口] 开始处理, "
-        f"task_type={task_type_val}, "
-        f"filename={file.filename}, "
-        f"ext={default_ext}"
+        f"task_type={task_type.value}, "
+        f"filename={filename}, "
+        f"ext={default_ext}, "
+        f"size={in_size}, "
+        f"mode={settings.UPLOAD_MODE}, "
+        f"queue={queue.name}, "
+        f"user={user}, "
+        f"projected_wait={decision.projected_wait:.1f}s"
+        + (f", group={group_id}" if group_id else "")
+        + (", callback=yes" if callback_url else "")
     )
-    job.meta.update(
-        {
-            "task_type": task_type.value,  # 存成字符串，避免 Enum 反序列化问题
-            "expect_ext": default_ext,
-            "filename": file.filename,
-            "content_type": file.content_type,
-        }
+    return {"task_id": task_id, "status": job.get_status(refresh=False), "cached": False}
+
+
+@router.post("", summary="上传并排队处理")
+async def upload(
+    request: Request,
+    file: UploadFile = File(...),
+    task_type: TaskType = Query(TaskType.text),
+    sync: bool = Query(False, description="小清单报关资料同步生成并直接返回 zip；超出大小/行数上限或繁忙时仍排队。不能和 callback_url 同用"),
+    callback_url: str | None = Query(None, description="任务结束（成功或失败）后 POST 最终状态和下载地址到这个地址"),
+):
+    if sync and callback_url:
+        raise HTTPException(status_code=400, detail="sync=true 时结果直接在响应里返回，不支持 callback_url")
+    callback_url = await _callback_of(callback_url)
+    user = _user_of(request)
+    admitted = None
+    if sync and inline_pool.accepts(task_type.value, file.size):
+        # 同步通道同样占用处理能力：先做准入，繁忙 / 用户未完成任务过多时和排队一样拒绝
+        admitted = await run_in_threadpool(admission.check, redis_conn, task_type.value, user)
+        if not admitted.admitted:
+            raise _reject(admitted, task_type.value, user)
+        inline = await _try_inline(file)
+        if inline is not None:
+            return inline
+
+    return await _submit(task_type, file.file, file.filename, file.content_type, user, admitted=admitted,
+                         callback_url=callback_url)
+
+
+def _zip_members(upload: UploadFile) -> list[tuple[str, Callable[[], BinaryIO]]]:
+    """把上传的 zip 展开成 [(文件名, 打开函数)]，跳过目录、__MACOSX、隐藏文件和 Office 临时文件。"""
+    zf = zipfile.ZipFile(upload.file)
+    out = []
+    for info in zf.infolist():
+        if info.is_dir() or info.filename.startswith("__MACOSX/"):
+            continue
+        name = info.filename
+        if not info.flag_bits & 0x800:
+            # 未标记 UTF-8 的文件名按 cp437 解码过，Windows 中文系统打的包实际是 GBK
+            try:
+                name = name.encode("cp437").decode("gbk")
+            except (UnicodeEncodeError, UnicodeDecodeError):
+                pass
+        base = name.rsplit("/", 1)[-1]
+        if not base or base.startswith((".", "~$")):
+            continue
+        out.append((base, lambda info=info: zf.open(info)))
+    return out
+
+
+@router.post("/batch", summary="批量上传（多个文件或一个 zip），一个任务组")
+async def upload_batch(
+    request: Request,
+    files: list[UploadFile] = File(...),
+    task_type: TaskType = Query(TaskType.text),
+    callback_url: str | None = Query(None, description="组内每个任务结束后各 POST 一次"),
+):
+    callback_url = await _callback_of(callback_url)
+    # 展开成 [(文件名, content_type, 打开函数)]；文件名以 .zip 结尾的当作文件包（xlsx 本身也是 zip，只看扩展名）
+    entries: list[tuple[str, str | None, Callable[[], BinaryIO]]] = []
+    for f in files:
+        if (f.filename or "").lower().endswith(".zip"):
+            try:
+                entries.extend((name, None, opener) for name, opener in _zip_members(f))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail=f"无法解压: {f.filename}")
+        else:
+            entries.append((f.filename or "file", f.content_type, lambda f=f: f.file))
+    if not entries:
+        raise HTTPException(status_code=400, detail="没有可处理的文件")
+    if len(entries) > settings.BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"单次最多 {settings.BATCH_MAX_FILES} 个文件，本次 {len(entries)} 个")
+
+    # 准入按整批判断：用户名下要能再放下这么多任务，队列的预计等待不超预算
+    user = _user_of(request)
+    decision = await run_in_threadpool(admission.check, redis_conn, task_type.value, user, len(entries))
+    if not decision.admitted:
+        raise _reject(decision, task_type.value, user)
+
+    group_id = uuid4().hex
+    used: set[str] = set()
+    items: list[dict] = []
+    for filename, content_type, opener in entries:
+        item = {"filename": filename, "name": job_groups.entry_name(filename, used), "task_id": None, "error": None}
+        try:
+            src = await run_in_threadpool(opener)
+            res = await _submit(task_type, src, filename, content_type, user, admitted=decision, group_id=group_id,
+                                callback_url=callback_url)
+            item["task_id"] = res["task_id"]
+        except HTTPException as e:
+            item["error"] = str(e.detail)
+        items.append(item)
+
+    await run_in_threadpool(job_groups.create, redis_conn, group_id, task_type.value, user, items)
+    logger.info(f"📦 [批量上传] group={group_id}, task_type={task_type.value}, files={len(items)}, user={user}")
+    return jsonable_encoder(await run_in_threadpool(job_groups.summary, redis_conn, group_id))
+
+
+@router.get("/batch/{group_id}/status", summary="任务组汇总状态")
+async def batch_status(group_id: str):
+    # 汇总要读各个 job 记录（RQ 只有同步接口），放进线程
+    data = await run_in_threadpool(job_groups.summary, redis_conn, group_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="任务组不存在")
+    return jsonable_encoder(data)
+
+
+@router.get("/batch/{group_id}/download", summary="下载任务组合并包（已完成的部分）")
+async def batch_download(group_id: str):
+    data = await run_in_threadpool(job_groups.summary, redis_conn, group_id)
+    entries = await run_in_threadpool(job_groups.ready_items, redis_conn, group_id)
+    if data is None or entries is None:
+        raise HTTPException(status_code=404, detail="任务组不存在")
+    if not entries:
+        raise HTTPException(status_code=409, detail="任务组还没有已完成的文件")
+
+    # 合并包在下载时边读各任务的产物边生成，大小事先未知：不带 Content-Length，也不支持 Range
+    logger.info(f"📦 [批量下载] group={group_id}, packed={len(entries)}/{data['total']}, complete={data['complete']}")
+    return StreamingResponse(
+        job_groups.stream_zip(entries),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": _content_disposition(f"batch_{group_id[:8]}.zip"),
+            "X-Group-Packed": f"{len(entries)}/{data['total']}",
+            "X-Group-Complete": "true" if data["complete"] else "false",
+        },
     )
-    job.save_meta()
 
-    return {"task_id": task_id, "status": job.get_status(refresh=False)}
+
+@router.get("/queues", summary="各队列积压与排队等待统计")
+async def queue_stats():
+    return jsonable_encoder(await run_in_threadpool(queues.queue_stats))
+
+
+@router.get("/retention", summary="保留期清理统计（累计回收的对象数与字节数）")
+async def retention_stats():
+    return jsonable_encoder(await retention.stats_async(async_redis_conn))
 
 
 @router.get("/{task_id}/status", summary="查询任务状态")
-def status(task_id: str):
-    
-    try:
-        job = Job.fetch(task_id, connection=redis_conn)
-    except Exception:
+async def status(task_id: str):
+    # 读 worker / API 发布的状态快照（一次 GET）；快照过旧或不存在时才读 job 记录
+    data = await job_events.current_async(async_redis_conn, redis_conn, task_id)
+    if data is None:
         raise HTTPException(status_code=404, detail="任务不存在")
-
-    data = {
-        "task_id": task_id,
-        "status": job.get_status(refresh=True),
-        "result": job.result if job.is_finished else None,
-        "exc_info": job.exc_info if job.is_failed else None,
-        "meta": {
-            "task_type": job.meta.get("task_type"),
-            "output_ext": job.meta.get("output_ext"),
-            "expect_ext": job.meta.get("expect_ext"),
-            "filename": job.meta.get("filename"),
-            "content_type": job.meta.get("content_type"),
-        },
-    }
     return jsonable_encoder(data)
 
 
-@router.get("/{task_id}/download", summary="下载生成文件")
-def download(task_id: str):
-    logger.info(f"📥 [下载接口] 开始处理, task_id={task_id}")
-    ext: str | None = None
-    job: Job | None = None
+class StatusBatchIn(BaseModel):
+    task_ids: list[str] = Field(..., min_length=1, max_length=settings.JOB_STATUS_BATCH_MAX)
+    # 只返回这些字段（task_id 总会带上）；默认 status / stage / percent / progress / result
+    fields: list[str] | None = None
+    # 失败任务的完整 traceback 可能很大，只在明确要求时返回
+    include_exc_info: bool = False
+
+
+_STATUS_FIELDS = {"status", "stage", "result", "meta", "progress", "step", "percent", "eta_s", "ts"}
+_STATUS_DEFAULT_FIELDS = ("status", "stage", "percent", "progress", "result")
+
+
+@router.post("/status:batch", summary="批量查询任务状态")
+async def status_batch(body: StatusBatchIn):
+    fields = list(body.fields or _STATUS_DEFAULT_FIELDS)
+    unknown = set(fields) - _STATUS_FIELDS - {"task_id", "exc_info"}
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"未知字段: {', '.join(sorted(unknown))}，可选 {', '.join(sorted(_STATUS_FIELDS))}")
+    fields = [f for f in fields if f in _STATUS_FIELDS]
+    if body.include_exc_info:
+        fields.append("exc_info")
+
+    task_ids = list(dict.fromkeys(body.task_ids))  # 去重，保持顺序
+    snaps = await job_events.current_many_async(async_redis_conn, redis_conn, task_ids)
+    tasks, missing = [], []
+    for task_id in task_ids:
+        snap = snaps.get(task_id)
+        if snap is None:
+            missing.append(task_id)
+            continue
+        tasks.append({"task_id": task_id, **{f: snap.get(f) for f in fields}})
+    return jsonable_encoder({"tasks": tasks, "missing": missing})
+
+
+@router.get("/{task_id}/callbacks", summary="任务完成回调的投递情况")
+async def callbacks(task_id: str):
+    return {"task_id": task_id, "callbacks": await webhooks.deliveries_async(async_redis_conn, task_id)}
+
+
+@router.get("/{task_id}/events", summary="任务状态推送（SSE），到任务结束为止")
+async def status_events(task_id: str):
+    first = await job_events.current_async(async_redis_conn, redis_conn, task_id)
+    if first is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def events():
+        yield f"retry: {settings.JOB_EVENTS_HEARTBEAT_S * 1000}\n\n"
+        async for snap in job_events.stream(async_redis_conn, redis_conn, task_id):
+            if snap is None:
+                yield ": keepalive\n\n"
+                continue
+            data = json.dumps(jsonable_encoder(snap), ensure_ascii=False)
+            yield f"event: status\nid: {snap['ts']}\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # nginx 不缓冲，逐条转发
+    )
+
+
+@router.websocket("/{task_id}/ws")
+async def status_ws(websocket: WebSocket, task_id: str):
+    """与 /events 相同的快照序列，以 JSON 文本帧发送；心跳为 {"event": "ping"}，任务结束后服务端关闭连接。"""
+    await websocket.accept()
+    found = False
     try:
-        job = Job.fetch(task_id, connection=redis_conn)
-        task_type = job.meta.get("task_type")
-        logger.info(f"✅ 已获取任务: task_type={task_type}")
-        if task_type:
-            try:
-                task_type = TaskType(task_type)  # 转换成 Enum
-            except ValueError:
-                task_type = None
-        ext = job.meta.get("output_ext") or job.meta.get("expect_ext")
-        if not ext and task_type:
-            ext = DEFAULT_EXT_MAP.get(task_type)
-        logger.info(f"📄 文件扩展名解析结果: {ext}")
-    except Exception as e:
-        logger.warning(f"⚠️ 获取任务失败: {e}")
+        async for snap in job_events.stream(async_redis_conn, redis_conn, task_id):
+            found = True
+            await websocket.send_json({"event": "ping"} if snap is None else jsonable_encoder(snap))
+    except WebSocketDisconnect:
+        return
+    await websocket.close(code=1000 if found else 4404, reason="" if found else "任务不存在")
 
-    path: Path | None = None
-    if ext:
-        candidate = output_path(task_id, ext=ext)
-        if candidate.exists():
-            path = candidate
-            logger.info(f"🔍 找到候选文件: {path}")
 
-    if path is None:
-        path = probe_any(task_id)
-        logger.info(f"🔎 probe_any 查找结果: {path}")
+@router.get("/{task_id}/download", summary="下载生成文件")
+async def download(request: Request, task_id: str):
+    logger.info(f"📥 [下载接口] 开始处理, task_id={task_id}")
+    # 文件名和结果 ref 都在状态快照里（一次 GET），不用读 job 记录
+    snap = await job_events.current_async(async_redis_conn, redis_conn, task_id)
+    if snap is None:
+        logger.warning(f"⚠️ 获取任务失败: 任务不存在, task_id={task_id}")
 
-    if path is None or not path.exists():
+    # 产物索引按 task_id 直接查；索引里没有的（索引上线前的旧任务）再用任务结果里记录的 ref
+    rec = await run_in_threadpool(storage.find_output, task_id)
+    ref, sha256 = (rec.ref, rec.sha256) if rec else (None, None)
+    if ref is None and snap is not None and snap["status"] == JobStatus.FINISHED.value:
+        result = snap.get("result")
+        if isinstance(result, dict):
+            ref = result.get("path")
+    logger.info(f"🔍 产物查找结果: {ref}")
+
+    if ref is None:
         logger.error(f"❌ 文件未找到, task_id={task_id}")
         raise HTTPException(status_code=404, detail="文件未找到!")
 
     # 优先使用原始文件名
-    filename = None
-    if job:
-        filename = job.meta.get("filename")
+    filename = (snap or {}).get("meta", {}).get("filename")
     if not filename:
-        filename = f"result_{task_id}{path.suffix}"
+        filename = f"result_{task_id}{Path(ref).suffix}"
     logger.info(f"📦 最终下载文件名: {filename}")
 
-    media_type = guess_type(path.name)[0] or "application/octet-stream"
-    logger.info(f"🎉 下载成功, 返回文件: {path}")
-    return FileResponse(
-        str(path),
-        media_type=media_type,
-        filename=filename,
-    )
\ No newline at end of file
+    media_type = guess_type(ref)[0] or "application/octet-stream"
+    logger.info(f"🎉 下载成功, 返回文件: {ref}")
+    # 对象存储要先读一次大小 / 是否存在，放进线程
+    return await run_in_threadpool(_file_response, request, ref, media_type=media_type, filename=filename, sha256=sha256)
+
+
+# ---------- 下载响应 ----------
+# DOWNLOAD_MODE：
+# - direct：API 进程自己发送（本地文件 FileResponse，对象存储边读边转发），支持 ETag / If-None-Match 和单区间 Range
+# - x-accel：只做鉴权和查找，返回 X-Accel-Redirect: <DOWNLOAD_ACCEL_PREFIX><key>，由 nginx 的 internal location 发送
+# - x-sendfile：返回 X-Sendfile: <绝对路径>，由 Apache mod_xsendfile / lighttpd 等发送
+# 代理模式只适用于 local 后端 OUTPUT_DIR 下的文件，其余（对象存储、旧路径）照常走 direct。
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match 比较（弱比较，W/ 前缀忽略）。"""
+    if header.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == bare for tag in header.split(","))
+
+
+def _byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    解析 Range，返回 [start, end]（含）。只支持单个区间，多区间或格式不对时返回 None（整文件发送）；
+    区间完全落在文件之外抛 416。
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) if last else size - 1
+        else:
+            start, end = max(0, size - int(last)), size - 1  # bytes=-N：最后 N 字节
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="请求的范围超出文件大小", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+def _file_response(
+    request: Request,
+    ref: str,
+    media_type: str,
+    filename: str,
+    headers: dict | None = None,
+    sha256: str | None = None,
+) -> Response:
+    """sha256：产物索引里的内容摘要，直接作为 ETag；没有时按 ref + 大小生成。"""
+    headers = {**(headers or {}), "Content-Disposition": _content_disposition(filename)}
+
+    if settings.DOWNLOAD_MODE != "direct":
+        key = storage.local_key(ref)
+        if key is not None:
+            if settings.DOWNLOAD_MODE == "x-accel":
+                headers["X-Accel-Redirect"] = settings.DOWNLOAD_ACCEL_PREFIX.rstrip("/") + "/" + quote(key)
+            else:
+                headers["X-Sendfile"] = str(storage.local_path(ref) or Path(ref).resolve())
+            return Response(media_type=media_type, headers=headers)
+
+    size = storage.size(ref)
+    if size is None:
+        raise HTTPException(status_code=404, detail="文件未找到!")
+    etag = f'"{sha256}"' if sha256 else '"' + hashlib.md5(f"{ref}:{size}".encode()).hexdigest() + '"'
+    headers.update({"ETag": etag, "Accept-Ranges": "bytes"})
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # If-Range 和当前 ETag 不一致（文件已变）时忽略 Range，整文件重发
+    byte_range = None
+    if request.headers.get("range") and request.headers.get("if-range", etag) == etag:
+        byte_range = _byte_range(request.headers["range"], size)
+
+    if byte_range is None:
+        path = storage.local_path(ref)
+        if path is not None:
+            return FileResponse(str(path), media_type=media_type, headers=headers)
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(storage.iter_bytes(ref), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers.update({"Content-Range": f"bytes {start}-{end}/{size}", "Content-Length": str(end - start + 1)})
+    return StreamingResponse(storage.iter_bytes(ref, start, end), status_code=206, media_type=media_type, headers=headers)
\ No newline at end of file
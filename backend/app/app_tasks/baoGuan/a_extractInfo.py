@@ -1,58 +1,38 @@
+import mmap
 import pandas as pd
 from io import BytesIO
-from typing import Dict, Callable, Any, List
+from typing import Dict, Any, List
+
+from app.app_tasks.baoGuan.z_manifest import Manifest
 
 class ExcelReader:
-    def __init__(self, data: bytes):
+    def __init__(self, data: bytes | mmap.mmap):
         """
-        :param data: Excel 二进制内容（例如 FastAPI 的 UploadFile.file.read() 的结果）
+        :param data: Excel 二进制内容（UploadFile.file.read() 的结果，或 storage.open_input 给出的只读 mmap）
         """
-        if not isinstance(data, (bytes, bytearray)):
-            raise TypeError("data 必须是 bytes/bytearray")
+        if not isinstance(data, (bytes, bytearray, mmap.mmap)):
+            raise TypeError("data 必须是 bytes/bytearray/mmap")
         self.data = data
 
-    def read_as_dicts(self, sheet_name: Any = 0) -> List[Dict[str, Any]]:
+    def read_manifest(self, sheet_name: Any = 0) -> Manifest:
         """
-        读取 Excel 二进制数据，返回 list[dict]
+        读取 Excel 二进制数据，返回带类型的列式 Manifest（只解析一次，供所有构建器共享）
         :param sheet_name: sheet 名称或索引，默认第一个
         """
-        # 用 BytesIO 包装二进制
-        bio = BytesIO(self.data)
+        # bytes 用 BytesIO 包装；mmap 本身就是可 seek 的文件对象，直接读，避免再复制一份
+        bio = self.data if isinstance(self.data, mmap.mmap) else BytesIO(self.data)
 
-        # 全部读成字符串，避免 NaN 带来的类型问题
+        # 全部读成字符串，避免 NaN 带来的类型问题；数值列在 Manifest 里统一向量化转换
         df = pd.read_excel(bio, sheet_name=sheet_name, dtype=str)
         df = df.fillna("")  # 空值替换为空字符串
-        res = df.to_dict(orient="records")
+        return Manifest.from_frame(df)
 
-        num_dict: Dict[str, Callable[[str], Any]] = {
-            '数量': int,
-            '系数': int,
-            '箱数': int,
-            '体积': float,
-            '净重': float,
-            '毛重': float,
-            '项目': int,
-            '单价': int,
-            '总价': int,
-            '长': int,
-            '宽': int,
-            '高': int
-        }
-
-        for row in res:
-            for key, target_type in num_dict.items():
-                if key in row:
-                    val = row[key]
-                    if val is None or val == "":
-                        row[key] = 0 if target_type is int else (0.0 if target_type is float else "")
-                        continue
-                    try:
-                        # 直接转换
-                        row[key] = target_type(val)
-                    except Exception:
-                        # 转换失败给默认值或保留原值的字符串形态
-                        row[key] = 0 if target_type is int else (0.0 if target_type is float else str(val))
-        return res
+    def read_as_dicts(self, sheet_name: Any = 0) -> List[Dict[str, Any]]:
+        """
+        读取 Excel 二进制数据，返回 list[dict]（兼容旧调用方，新代码请用 read_manifest）
+        :param sheet_name: sheet 名称或索引，默认第一个
+        """
+        return self.read_manifest(sheet_name).records()
 
 
 # 使用示例（以二进制为输入）
@@ -7,23 +7,21 @@ from io import BytesIO
 
 from .z_tools import Direction
 from . import z_tools
+from . import z_styles
+from .z_writer import Book
 from .a_extractInfo import ExcelReader
 
 
 class ExcelASNBuilder:
-    def __init__(self, title="ASN"):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = title
+    def __init__(self, title="ASN", backend="openpyxl"):
+        # backend: openpyxl（内存工作簿）| streaming（按行写出，见 z_writer）
+        self.book = Book(title, backend)
+        self.wb = self.book.wb
+        self.ws = self.book.ws
 
         # 默认样式：细边框、黄色填充
-        self.thin_border = Border(
-            left=Side(style='thin', color="000000"),
-            right=Side(style='thin', color="000000"),
-            top=Side(style='thin', color="000000"),
-            bottom=Side(style='thin', color="000000"),
-        )
-        self.yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+        self.thin_border = z_styles.thin_border()
+        self.yellow_fill = z_styles.fill("FFFF00")
         self.row_height = [27.75, 21]
         self.col_weight = [9.88, 12.38, 21.23, 21.23, 12.73, 9.23, 9.23, 9.23, 10.63, 10.63, 11.28, 11.28, 5.52, 5.52, 5.52, 7.22]
 
@@ -43,10 +41,10 @@ class ExcelASNBuilder:
             ["Cargo delivery date:", "", "送货日期"]
         ]
 
-        titlefont = Font(name="楷体", size=20, bold=True)
-        title_alignment = Alignment(horizontal="center", vertical="center")
-        contentfont = Font(name="楷体", size=10, bold=True, underline="single")
-        content_alignment = Alignment(horizontal="left", vertical="center")
+        titlefont = z_styles.font(name="楷体", size=20, bold=True)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="楷体", size=10, bold=True, underline="single")
+        content_alignment = z_styles.alignment(horizontal="left", vertical="center")
 
         rowindex = z_tools.record_sheet(self.ws, headers, 1, 1, titlefont, title_alignment)
         rowindex = z_tools.record_sheet(self.ws, content, rowindex, 1, contentfont, content_alignment)
@@ -54,15 +52,15 @@ class ExcelASNBuilder:
         # 2. 数据标题行
         header_row_1 = [["PO#", 'SKU#', "中文品名", "英文品名", "HS CODE", "托数", "箱数", "件数", "单价", "总价", "净重", "毛重", "包装尺寸（m）", "", "", "体积"]]
         header_row_2 = [["",    "", "",     "",       "",           "pallet", "carton", "pc", "unit price", "amount", "", "", "长", "宽", "高", ""]]
-        contentfont = Font(name="楷体", size=10, bold=True)
+        contentfont = z_styles.font(name="楷体", size=10, bold=True)
         rowindex = z_tools.record_sheet(self.ws, header_row_1, rowindex, 1, contentfont, title_alignment, border=self.thin_border)
         rowindex = z_tools.record_sheet(self.ws, header_row_2, rowindex, 1, contentfont, title_alignment, Direction.VERTICAL, border=self.thin_border)
         return rowindex
 
     def input_data(self, data, startRow):
-        contentfont = Font(name="楷体", size=10)
-        title_alignment = Alignment(horizontal="center", vertical="center")
-        rowNum = z_tools.record_sheet(self.ws, data, startRow, 1, contentfont, title_alignment, Direction.VERTICAL, border=self.thin_border, isMerge=False)
+        contentfont = z_styles.font(name="楷体", size=10)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
+        rowNum = z_tools.record_sheet(self.ws, data, startRow, 1, contentfont, title_alignment, Direction.VERTICAL, border=self.thin_border, isMerge=False, stream=True)
         return rowNum
 
     def get_asn_data(self, extract_info):
@@ -85,53 +83,15 @@ class ExcelASNBuilder:
             '体积': {"yinshe": ['体积'], 'type': 'float'}
         }
 
-        total_data = []
-        for item in extract_info:  # 每一行提取结果
-            single_data = []
-            for key, config in show_data.items():
-                has_val = False
-                val = None
-                for val_item in config["yinshe"]:
-                    if val_item in item and item[val_item] not in [None, ""]:
-                        val = item[val_item]
-                        has_val = True
-                        break
-
-                if not has_val:
-                    if config["type"] == "str":
-                        val = ""
-                    elif config["type"] == "int":
-                        val = 0
-                    elif config["type"] == "float":
-                        val = 0.0
-                else:
-                    try:
-                        if config["type"] == "str":
-                            val = str(val).strip()
-                        elif config["type"] == "int":
-                            val = int(float(val))
-                        elif config["type"] == "float":
-                            val = float(val)
-                    except Exception:
-                        if config["type"] == "str":
-                            val = str(val)
-                        elif config["type"] == "int":
-                            val = 0
-                        elif config["type"] == "float":
-                            val = 0.0
-                single_data.append(val)
-            total_data.append(single_data)
-        return total_data
+        return z_tools.change_data_type(show_data, extract_info)
 
     def save_data(self, save_path: str):
         """仍然支持落地保存到文件（可选）"""
-        self.wb.save(save_path)
+        self.book.save(save_path)
 
     def save_bytes(self) -> bytes:
         """把当前工作簿导出为 xlsx 二进制"""
-        bio = BytesIO()
-        self.wb.save(bio)
-        return bio.getvalue()
+        return self.book.to_bytes()
 
     def calculate_total_data(self, start_row, data):
         show_data = {
@@ -185,14 +145,16 @@ class ExcelASNBuilder:
                 result[c] = round(total, 2)
         result[0] = "TOTAL:"
 
-        contentfont = Font(name="楷体", size=10, bold=True)
-        title_alignment = Alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="楷体", size=10, bold=True)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
         rowNum = z_tools.record_sheet(self.ws, [result], start_row, 1, contentfont, title_alignment, Direction.VERTICAL, border=self.thin_border, isMerge=False)
         return rowNum
 
     def build(self, oridata) -> bytes:
         """核心：构建并返回 xlsx 二进制"""
         asndata = self.get_asn_data(oridata)
+        # 先定好列宽和数据行行高，流式后端写出数据行时要用
+        z_tools.set_sheet_size(self.ws, self.col_weight, self.row_height, default_height=21)
         inputRow = self.get_fix_content()
         outputRow = self.input_data(asndata, inputRow)
         max_row = self.calculate_total_data(outputRow, asndata)
@@ -9,22 +9,20 @@ from openpyxl.drawing.image import Image
 # 建议：统一使用绝对导入，便于模块方式运行
 from app.app_tasks.baoGuan.z_tools import Direction
 from app.app_tasks.baoGuan import z_tools
+from app.app_tasks.baoGuan import z_styles
 from app.app_tasks.baoGuan.a_extractInfo import ExcelReader
+from app.app_tasks.baoGuan.z_writer import Book
 
 
 class FaPiaoBuilder:
-    def __init__(self, title: str = "fapiao"):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = title
-
-        self.thin_border = Border(
-            left=Side(style="thin", color="000000"),
-            right=Side(style="thin", color="000000"),
-            top=Side(style="thin", color="000000"),
-            bottom=Side(style="thin", color="000000"),
-        )
-        self.yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+    def __init__(self, title: str = "fapiao", backend: str = "openpyxl"):
+        # backend: openpyxl（内存工作簿）| streaming（按行写出，见 z_writer）
+        self.book = Book(title, backend)
+        self.wb = self.book.wb
+        self.ws = self.book.ws
+
+        self.thin_border = z_styles.thin_border()
+        self.yellow_fill = z_styles.fill("FFFF00")
         # 初始行高/列宽（后续会根据最大行数补齐）
         self.row_height: List[float] = [33, 33, 16.1, 16.1, 16.1, 16.1, 16.1, 33, 16.1]
         self.col_weight: List[float] = [16, 38.44, 14, 14, 22, 22]
@@ -97,32 +95,32 @@ class FaPiaoBuilder:
         ]]
 
         # 标题
-        titlefont = Font(name="等线", size=22)
-        center = Alignment(horizontal="center", vertical="center")
+        titlefont = z_styles.font(name="等线", size=22)
+        center = z_styles.alignment(horizontal="center", vertical="center")
         rowindex = z_tools.record_sheet(self.ws, header1, 1, 1, titlefont, center)
 
         # 英文标题
-        contentfont = Font(name="等线", size=20)
+        contentfont = z_styles.font(name="等线", size=20)
         rowindex = z_tools.record_sheet(self.ws, header2, rowindex, 1, contentfont, center)
 
         # 卖方/买方信息
-        smallfont = Font(name="等线", size=10)
-        left = Alignment(horizontal="left", vertical="center")
+        smallfont = z_styles.font(name="等线", size=10)
+        left = z_styles.alignment(horizontal="left", vertical="center")
         _ = z_tools.record_sheet(self.ws, content1, rowindex, 1, smallfont, left, border=self.thin_border)
         rowindex = z_tools.record_sheet(self.ws, content2, rowindex, 5, smallfont, left, border=self.thin_border)
 
         # 表头
-        midfont = Font(name="等线", size=11)
-        center_wrap = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        midfont = z_styles.font(name="等线", size=11)
+        center_wrap = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
         rowindex = z_tools.record_sheet(self.ws, header3, rowindex + 2, 1, midfont, center_wrap, border=self.thin_border)
         return rowindex
 
     def input_data(self, data: List[List[Any]], start_row: int) -> int:
-        contentfont = Font(name="微软雅黑", size=10)
-        center = Alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="微软雅黑", size=10)
+        center = z_styles.alignment(horizontal="center", vertical="center")
         rowNum = z_tools.record_sheet(
             self.ws, data, start_row, 1, contentfont, center,
-            Direction.VERTICAL, border=self.thin_border, isMerge=False
+            Direction.VERTICAL, border=self.thin_border, isMerge=False, stream=True
         )
         return rowNum
 
@@ -151,22 +149,20 @@ class FaPiaoBuilder:
         return cleaned
 
     def save_data(self, save_path: str) -> None:
-        self.wb.save(save_path)
+        self.book.save(save_path)
 
     def to_bytes(self) -> bytes:
-        bio = BytesIO()
-        self.wb.save(bio)
-        return bio.getvalue()
+        return self.book.to_bytes()
 
     def calculate_total_data(self, start_row: int, data: List[List[Any]]) -> int:
         """
         写入“合计 TOTAL”与“唛头 Marks”两行，并返回写入后的下一行行号。
         需要合计：数量(索引2)、总数额(索引5)
         """
-        center = Alignment(horizontal="center", vertical="center")
-        bold = Font(name="等线", size=12, bold=True)
-        normal = Font(name="等线", size=12)
-        wrap_center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        center = z_styles.alignment(horizontal="center", vertical="center")
+        bold = z_styles.font(name="等线", size=12, bold=True)
+        normal = z_styles.font(name="等线", size=12)
+        wrap_center = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
 
         if not data:
             # 没有数据也要写出结构，避免后续尺寸/盖章定位异常
@@ -174,7 +170,7 @@ class FaPiaoBuilder:
             rowNum = z_tools.record_sheet(
                 self.ws, total_row, start_row, 1, bold, center, Direction.HORIZONTAL, border=self.thin_border
             )
-            self.ws.cell(row=rowNum - 1, column=1).alignment = Alignment(horizontal="right", vertical="center")
+            self.ws.cell(row=rowNum - 1, column=1).alignment = z_styles.alignment(horizontal="right", vertical="center")
 
             marks = [["唛头\nMarks", "3V6S7", "", "", "", ""]]
             rowNum = z_tools.record_sheet(
@@ -192,7 +188,7 @@ class FaPiaoBuilder:
             self.ws, total_row, start_row, 1, bold, center, Direction.HORIZONTAL, border=self.thin_border
         )
         # “合计 TOTAL” 右对齐
-        self.ws.cell(row=rowNum - 1, column=1).alignment = Alignment(horizontal="right", vertical="center")
+        self.ws.cell(row=rowNum - 1, column=1).alignment = z_styles.alignment(horizontal="right", vertical="center")
 
         marks = [["唛头\nMarks", "3V6S7", "", "", "", ""]]
         rowNum = z_tools.record_sheet(
@@ -210,6 +206,8 @@ class FaPiaoBuilder:
 
     # ---------- main ----------
     def detect(self, oridata: Iterable[Dict[str, Any]], hetongstr: str, gongzhang_source: Optional[Union[str, bytes, bytearray, BytesIO]]) -> bytes:
+        # 先定好列宽和数据行行高，流式后端写出数据行时要用
+        z_tools.set_sheet_size(self.ws, self.col_weight, self.row_height, default_height=16.1)
         rowNum = self.get_fix_content(hetongstr)
         total_data = self.get_fapiao_data(oridata)
         rowNum = self.input_data(total_data, rowNum)
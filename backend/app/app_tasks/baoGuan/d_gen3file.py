@@ -9,22 +9,20 @@ from openpyxl.drawing.image import Image
 # ✅ 统一用绝对导入，模块方式运行更稳
 from app.app_tasks.baoGuan.z_tools import Direction
 from app.app_tasks.baoGuan import z_tools
+from app.app_tasks.baoGuan import z_styles
 from app.app_tasks.baoGuan.a_extractInfo import ExcelReader
+from app.app_tasks.baoGuan.z_writer import Book
 
 
 class ZhuangXiangBuilder:
-    def __init__(self, title: str = "PackingList"):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = title
-
-        self.thin_border = Border(
-            left=Side(style="thin", color="000000"),
-            right=Side(style="thin", color="000000"),
-            top=Side(style="thin", color="000000"),
-            bottom=Side(style="thin", color="000000"),
-        )
-        self.yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+    def __init__(self, title: str = "PackingList", backend: str = "openpyxl"):
+        # backend: openpyxl（内存工作簿）| streaming（按行写出，见 z_writer）
+        self.book = Book(title, backend)
+        self.wb = self.book.wb
+        self.ws = self.book.ws
+
+        self.thin_border = z_styles.thin_border()
+        self.yellow_fill = z_styles.fill("FFFF00")
         self.row_height: List[float] = [33, 33, 16.1, 16.1, 16.1, 16.1, 16.1, 16.1, 16.1, 33, 16.1]
         self.col_weight: List[float] = [16, 39, 16, 16, 22, 22]
 
@@ -99,24 +97,24 @@ class ZhuangXiangBuilder:
         ]]
 
         # 中文/英文大标题
-        font_title = Font(name="等线", size=22)
-        center = Alignment(horizontal="center", vertical="center")
+        font_title = z_styles.font(name="等线", size=22)
+        center = z_styles.alignment(horizontal="center", vertical="center")
         rowindex = z_tools.record_sheet(self.ws, header1, 1, 1, font_title, center)
 
-        font_title_en = Font(name="等线", size=20)
+        font_title_en = z_styles.font(name="等线", size=20)
         rowindex = z_tools.record_sheet(self.ws, header2, rowindex, 1, font_title_en, center)
 
         # 卖方/买方信息
-        font_small = Font(name="等线", size=10)
-        left = Alignment(horizontal="left", vertical="center")
+        font_small = z_styles.font(name="等线", size=10)
+        left = z_styles.alignment(horizontal="left", vertical="center")
         _ = z_tools.record_sheet(self.ws, content1, rowindex, 1, font_small, left, border=self.thin_border)
         rowindex = z_tools.record_sheet(self.ws, content2, rowindex, 5, font_small, left, border=self.thin_border)
 
         # 船名 + 付款条件
-        font_cn = Font(name="等线", size=12)
-        left_wrap = Alignment(horizontal="left", vertical="center", wrap_text=True)
+        font_cn = z_styles.font(name="等线", size=12)
+        left_wrap = z_styles.alignment(horizontal="left", vertical="center", wrap_text=True)
         rowindex = z_tools.record_sheet(self.ws, contente3, rowindex + 2, 1, font_cn, left_wrap)
-        font_en = Font(name="等线", size=9)
+        font_en = z_styles.font(name="等线", size=9)
         rowindex = z_tools.record_sheet(self.ws, contente4, rowindex, 1, font_en, left_wrap)
         # 外边框（两行）
         z_tools.add_outer_border(self.ws, rowindex - 2, rowindex - 1, 1, 6)
@@ -124,17 +122,17 @@ class ZhuangXiangBuilder:
         z_tools.add_outer_border(self.ws, rowindex - 2, rowindex - 1, 4, 4)
 
         # 列标题
-        font_header = Font(name="等线", size=11)
-        center_wrap = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        font_header = z_styles.font(name="等线", size=11)
+        center_wrap = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
         rowindex = z_tools.record_sheet(self.ws, contente5, rowindex, 1, font_header, center_wrap, border=self.thin_border)
         return rowindex
 
     def input_data(self, data: List[List[Any]], startRow: int) -> int:
-        font = Font(name="微软雅黑", size=10)
-        center = Alignment(horizontal="center", vertical="center")
+        font = z_styles.font(name="微软雅黑", size=10)
+        center = z_styles.alignment(horizontal="center", vertical="center")
         rowNum = z_tools.record_sheet(
             self.ws, data, startRow, 1, font, center,
-            Direction.VERTICAL, border=self.thin_border, isMerge=False
+            Direction.VERTICAL, border=self.thin_border, isMerge=False, stream=True
         )
         return rowNum
 
@@ -160,28 +158,26 @@ class ZhuangXiangBuilder:
         return cleaned
 
     def save_data(self, save_path: str) -> None:
-        self.wb.save(save_path)
+        self.book.save(save_path)
 
     def to_bytes(self) -> bytes:
-        bio = BytesIO()
-        self.wb.save(bio)
-        return bio.getvalue()
+        return self.book.to_bytes()
 
     def calculate_total_data(self, start_row: int, data: List[List[Any]]) -> int:
         """
         合计列：2 总数(件)、3 总数量、4 总毛重、5 总净重
         """
-        center = Alignment(horizontal="center", vertical="center")
-        bold = Font(name="等线", size=12, bold=True)
-        normal = Font(name="等线", size=12)
-        wrap_center = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        center = z_styles.alignment(horizontal="center", vertical="center")
+        bold = z_styles.font(name="等线", size=12, bold=True)
+        normal = z_styles.font(name="等线", size=12)
+        wrap_center = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
 
         if not data:
             total_row = [["合计 TOTAL", "", "0", "0", "0", "0"]]
             rowNum = z_tools.record_sheet(
                 self.ws, total_row, start_row, 1, bold, center, Direction.HORIZONTAL, border=self.thin_border
             )
-            self.ws.cell(row=rowNum - 1, column=1).alignment = Alignment(horizontal="right", vertical="center")
+            self.ws.cell(row=rowNum - 1, column=1).alignment = z_styles.alignment(horizontal="right", vertical="center")
 
             marks = [["唛头\nMarks", "3V6S7", "", "", "", ""]]
             rowNum = z_tools.record_sheet(
@@ -203,7 +199,7 @@ class ZhuangXiangBuilder:
         rowNum = z_tools.record_sheet(
             self.ws, total_row, start_row, 1, bold, center, Direction.HORIZONTAL, border=self.thin_border
         )
-        self.ws.cell(row=rowNum - 1, column=1).alignment = Alignment(horizontal="right", vertical="center")
+        self.ws.cell(row=rowNum - 1, column=1).alignment = z_styles.alignment(horizontal="right", vertical="center")
 
         marks = [["唛头\nMarks", "3V6S7", "", "", "", ""]]
         rowNum = z_tools.record_sheet(
@@ -221,6 +217,8 @@ class ZhuangXiangBuilder:
 
     # ---------- main ----------
     def detect(self, oridata: Iterable[Dict[str, Any]], hetongstr: str, gongzhang_source: Optional[Union[str, bytes, bytearray, BytesIO]]) -> bytes:
+        # 先定好列宽和数据行行高，流式后端写出数据行时要用
+        z_tools.set_sheet_size(self.ws, self.col_weight, self.row_height, default_height=16.1)
         rowNum = self.get_fix_content(hetongstr)
         data = self.get_zhuangxiang_data(oridata)
         rowNum = self.input_data(data, rowNum)
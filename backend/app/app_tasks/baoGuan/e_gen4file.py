@@ -5,25 +5,25 @@ from openpyxl.utils import get_column_letter
 from enum import Enum
 from app.app_tasks.baoGuan.z_tools import Direction
 from app.app_tasks.baoGuan import z_tools
+from app.app_tasks.baoGuan import z_styles
 from typing import List, Any
 from .a_extractInfo import ExcelReader
+from .z_manifest import Manifest
+from .z_aggregate import aggregate
+from .z_writer import Book
 from openpyxl.drawing.image import Image
 
 
 class HeTongBuilder:
-    def __init__(self, title="ZhangXiang"):
-        self.wb = Workbook()
-        self.ws = self.wb.active
-        self.ws.title = title
+    def __init__(self, title="ZhangXiang", backend="openpyxl"):
+        # backend: openpyxl（内存工作簿）| streaming（按行写出，见 z_writer）
+        self.book = Book(title, backend)
+        self.wb = self.book.wb
+        self.ws = self.book.ws
 
         # 默认样式：细边框、黄色填充
-        self.thin_border = Border(
-            left=Side(style='thin', color="000000"),
-            right=Side(style='thin', color="000000"),
-            top=Side(style='thin', color="000000"),
-            bottom=Side(style='thin', color="000000"),
-        )
-        self.yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+        self.thin_border = z_styles.thin_border()
+        self.yellow_fill = z_styles.fill("FFFF00")
         self.row_height = [52.5, 12, 13.5, 15.8, 13.5, 
                            15, 16.5, 13.5, 16.5, 13.5, 
                            16.5, 13.5, 13.5, 13.5, 13.5,
@@ -56,12 +56,12 @@ class HeTongBuilder:
             ['TEL:', ' ', 'FAX:'],
         ]
 
-        titlefont = Font(name="等线", size=22)
-        title_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        titlefont = z_styles.font(name="等线", size=22)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
         rowindex = z_tools.record_sheet(self.ws, header1, 1, 1, titlefont, title_alignment)
 
-        contentfont = Font(name="等线", size=11)
-        title_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        contentfont = z_styles.font(name="等线", size=11)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
         rowindex = z_tools.record_sheet(self.ws, content1, 3, 1, contentfont, title_alignment,Direction.VERTICAL)
         self.ws.merge_cells("B3:D4")
         z_tools.add_outer_border(self.ws, 3, 4, 2, 4, border_type = 'bottom')
@@ -88,36 +88,36 @@ class HeTongBuilder:
         z_tools.add_outer_border(self.ws, 11, 11, 6, 7, border_type = 'bottom')
 
         cell = self.ws.cell(row=3, column=2)  # E列 = 第5列
-        cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+        cell.alignment = z_styles.alignment(horizontal="left", vertical="center", wrap_text=True)
 
         cell = self.ws.cell(row=5, column=2)  # E列 = 第5列
-        cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+        cell.alignment = z_styles.alignment(horizontal="left", vertical="center", wrap_text=True)
 
         cell = self.ws.cell(row=7, column=2)  # E列 = 第5列
-        cell.alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+        cell.alignment = z_styles.alignment(horizontal="left", vertical="center", wrap_text=True)
 
         content2 = [
             ['经买卖双方确认根据下列条款订立本合同', ''],
             ['This contract is made out by the Selers and Buyers as per the following terms and conditions mutuilly confirmed:', '', '', '', '', ''],
         ]
-        contentfont = Font(name="等线", size=10)
-        title_alignment = Alignment(horizontal="left", vertical="center", wrap_text=True)
+        contentfont = z_styles.font(name="等线", size=10)
+        title_alignment = z_styles.alignment(horizontal="left", vertical="center", wrap_text=True)
         rowNum = z_tools.record_sheet(self.ws, content2, 15, 1, contentfont, title_alignment)
 
         content3 = [
             ['(1) 货物名称及规格', '', '(2) 数 量', '(3) 单 位', '(4) 单 价', '(5) 金 额', ''],
             ['Name of commodity ', '', 'Quantity', 'Unit', 'Unit Price', 'Amount', '']
         ]
-        contentfont = Font(name="等线", size=11)
-        title_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        contentfont = z_styles.font(name="等线", size=11)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center", wrap_text=True)
         rowNum = z_tools.record_sheet(self.ws, content3, rowNum, 1, contentfont, title_alignment, border=self.thin_border)
 
         return rowNum
 
 
     def input_data(self, data, startRow):
-        contentfont = Font(name="等线", size=11)
-        title_alignment = Alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="等线", size=11)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
 
         changeRow = startRow
         for key, value in data.items():
@@ -126,10 +126,10 @@ class HeTongBuilder:
             content_list.append('')
             content_list.append(value['数量'])
             content_list.append(value['单位'])
-            content_list.append(value['单价'])
-            content_list.append(value['金额'])
+            content_list.append("{:,.4f}".format(value['单价']))
+            content_list.append("{:,.2f}".format(value['金额']))
             content_list.append("JPY")
-            changeRow = z_tools.record_sheet(self.ws, [content_list], changeRow, 1, contentfont, title_alignment, border=self.thin_border)
+            changeRow = z_tools.record_sheet(self.ws, [content_list], changeRow, 1, contentfont, title_alignment, border=self.thin_border, stream=True)
         return changeRow
     
 
@@ -138,47 +138,26 @@ class HeTongBuilder:
         根据 extract_info 构建包装数据字典：
         - 相同 show_name 且单价相同的归为一类，数量和总金额累加
         - show_name 或单价不同视为不同类
-        - 单价和金额格式化为千分位 + 四位小数
+        - 单价、金额保持数值，写入单元格时再格式化为千分位
         """
-        total_data = {}
-
-        for item in extract_info:
-            ywenstr = item.get('英文品名', '')
-            zwenstr = item.get('中文品名', '')
-            show_name = f"{ywenstr} {zwenstr}"
-
-            # 单价和总价
-            price = item.get('单价', 0)
-            amount = item.get('总价', 0)
-
-            # key 使用 (show_name, 单价) 来区分不同类
-            key = (show_name, price)
-
-            if key not in total_data:
-                total_data[key] = {
-                    '数量': item.get('数量', 0),
-                    '单位': '条',
-                    '单价': "{:,.4f}".format(price),
-                    '金额': "{:,.2f}".format(amount)
-                }
-            else:
-                # 累加数量和金额
-                total_data[key]['数量'] += item.get('数量', 0)
-                old_amount = float(total_data[key]['金额'].replace(',', ''))
-                total_data[key]['金额'] = "{:,.2f}".format(old_amount + amount)
-
-        return total_data
+        grouped = aggregate(
+            Manifest.coerce(extract_info),
+            keys=[{"concat": ['英文品名', '中文品名'], "sep": " "}, '单价'],
+            sums={'数量': '数量', '金额': '总价'},
+        )
+        return {
+            key: {'数量': value['数量'], '单位': '条', '单价': key[1], '金额': value['金额']}
+            for key, value in grouped.items()
+        }
 
 
     def save_data(self, save_path):
         # 保存文件（保留原方法，按需使用）
-        self.wb.save(save_path)
+        self.book.save(save_path)
 
     def to_bytes(self) -> bytes:
         """★ 新增：把当前工作簿写入内存并返回 bytes"""
-        bio = BytesIO()
-        self.wb.save(bio)
-        return bio.getvalue()
+        return self.book.to_bytes()
 
     def calculate_total_data(self, start_row, data):
         total_data = []
@@ -187,17 +166,17 @@ class HeTongBuilder:
 
         for key, value in data.items():
             total_num += value['数量']
-            total_money += int(float(value['金额'].replace(',', '')))
+            total_money += int(value['金额'])
 
-        contentfont = Font(name="等线", size=11)
-        title_alignment = Alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="等线", size=11)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
         formatted = "{:,.2f}".format(total_money)
         total_data = [['Total', '', total_num, ' ', ' ', formatted, 'JPY']]
         rowNum = z_tools.record_sheet(self.ws, total_data, start_row, 1, contentfont, title_alignment, border=self.thin_border)
 
         cell = self.ws.cell(row=rowNum-1, column=1)
-        cell.font = Font(name="等线", size=11, bold=True)
-        cell.alignment = Alignment(horizontal="right", vertical="center")
+        cell.font = z_styles.font(name="等线", size=11, bold=True)
+        cell.alignment = z_styles.alignment(horizontal="right", vertical="center")
 
         content = [
             ['数量及总值允许有  2    %的增减。', '', ''],
@@ -216,29 +195,31 @@ class HeTongBuilder:
             ['Shipping Marks:  ', '', '', '', ''],
             ['  ']
         ]
-        contentfont = Font(name="等线", size=12)
-        title_alignment = Alignment(horizontal="left", vertical="center")
+        contentfont = z_styles.font(name="等线", size=12)
+        title_alignment = z_styles.alignment(horizontal="left", vertical="center")
         finalRow = z_tools.record_sheet(self.ws, content, rowNum + 1, 1, contentfont, title_alignment)
 
         rowIndex = [rowNum + 1, rowNum + 2, rowNum + 4, rowNum + 6, rowNum + 8, rowNum + 10, rowNum + 12, rowNum + 14]
         for item in rowIndex:
             cell = self.ws.cell(row=item, column=1)
-            cell.font = Font(name="等线", size=10)
-            cell.alignment = Alignment(horizontal="left", vertical="center")
+            cell.font = z_styles.font(name="等线", size=10)
+            cell.alignment = z_styles.alignment(horizontal="left", vertical="center")
 
         data = [
             ['卖  方', '', ' ', '买  方', ''],
             ['  '],
             ['THE SELLERS', '', ' ', 'THE BUYERS', '']
         ]
-        contentfont = Font(name="等线", size=12)
-        title_alignment = Alignment(horizontal="center", vertical="center")
+        contentfont = z_styles.font(name="等线", size=12)
+        title_alignment = z_styles.alignment(horizontal="center", vertical="center")
         finalRow = z_tools.record_sheet(self.ws, data, finalRow, 1, contentfont, title_alignment)
         return finalRow
     
     
-    def insert_image(self, row_index, image_path):
-        stamp = Image(image_path)
+    def insert_image(self, row_index, image_source):
+        if isinstance(image_source, (bytes, bytearray)):
+            image_source = BytesIO(image_source)
+        stamp = Image(image_source)  # str 路径或 BytesIO
         stamp.width = 300
         stamp.height = 300
         posite = f"B{row_index-11}"
@@ -247,6 +228,8 @@ class HeTongBuilder:
 
     # ★ 改造点：detect 返回 bytes，不再落盘，不再需要 save_path 参数
     def detect(self, oridata, hetongstr, gongzhang_path) -> bytes:
+        # 先定好列宽和数据行行高，流式后端写出数据行时要用
+        z_tools.set_sheet_size(self.ws, self.col_weight, self.row_height, default_height=16.1)
         rowNum = self.get_fix_content(hetongstr)
         zhuangxiang_data = self.get_zhuangxiang_data(oridata)
         rowNum1 = self.input_data(zhuangxiang_data, rowNum)
@@ -1,7 +1,10 @@
 from io import BytesIO  # ★ 新增
-from openpyxl import load_workbook
 from .a_extractInfo import ExcelReader
+from .z_manifest import Manifest
+from .z_aggregate import aggregate
 from . import z_tools
+from . import z_styles
+from . import z_resources
 from openpyxl import Workbook
 from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
 import logging
@@ -14,16 +17,11 @@ logger = logging.getLogger('报关资料5')
 class BaoGuanBuilder():
     def __init__(self, sourcepath= "./app/app_tasks/resource/baoguan.xlsx"):
         self.title = 'baoguan'
-        self.wb = load_workbook(sourcepath)
+        self.wb = z_resources.template_workbook(sourcepath)  # 进程内缓存的模板副本
         self.ws = self.wb.active
         self.ws.title = self.title
-        self.thin_border = Border(
-            left=Side(style='thin', color="000000"),
-            right=Side(style='thin', color="000000"),
-            top=Side(style='thin', color="000000"),
-            bottom=Side(style='thin', color="000000"),
-        )
-        self.yellow_fill = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+        self.thin_border = z_styles.thin_border()
+        self.yellow_fill = z_styles.fill("FFFF00")
 
     def add_detial_info(self, itemInfo):
         total_jin = 0
@@ -50,8 +48,8 @@ class BaoGuanBuilder():
                     '最终目的国（地区）', '','',
                     '单价/总价/币制  征免', '']]
         
-        titlefont = Font(name="仿宋_GB2312", size=9)
-        title_alignment = Alignment(horizontal="left", vertical="center")
+        titlefont = z_styles.font(name="仿宋_GB2312", size=9)
+        title_alignment = z_styles.alignment(horizontal="left", vertical="center")
         row_num = z_tools.record_sheet(self.ws, content, 22, 1, titlefont, title_alignment)
         z_tools.add_outer_border(self.ws, row_num-1, row_num-1, 1, 12)
 
@@ -69,24 +67,24 @@ class BaoGuanBuilder():
                 [None, None, None, None, None, None, None, None, None, None, "日本元", None]
             ]
 
-            titlefont = Font(name="Times New Roman", size=10, bold=True)
-            title_alignment = Alignment(horizontal="left", vertical="center")
+            titlefont = z_styles.font(name="Times New Roman", size=10, bold=True)
+            title_alignment = z_styles.alignment(horizontal="left", vertical="center")
             row_num = z_tools.record_sheet(self.ws, inputContent, row_num, 1, titlefont, title_alignment)
             merge_str = f'B{row_num-2}:D{row_num-1}'
             self.ws.merge_cells(merge_str)
             cell = self.ws.cell(row=row_num-2, column=2)
-            cell.font = Font(name="Times New Roman", size=8, bold=True)
-            cell.alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+            cell.font = z_styles.font(name="Times New Roman", size=8, bold=True)
+            cell.alignment = z_styles.alignment(horizontal='left', vertical='top', wrap_text=True)
 
             rigtCellList = [(row_num-3, 6), (row_num-2, 6), (row_num-3, 11), (row_num-2, 10), (row_num-1, 11)]
             for rigtCell in rigtCellList:
-                self.ws.cell(row=rigtCell[0], column=rigtCell[1]).alignment = Alignment(horizontal='right', vertical='center')
+                self.ws.cell(row=rigtCell[0], column=rigtCell[1]).alignment = z_styles.alignment(horizontal='right', vertical='center')
 
-            self.ws.cell(row=row_num-3, column=12).alignment = Alignment(horizontal='center', vertical='center')
+            self.ws.cell(row=row_num-3, column=12).alignment = z_styles.alignment(horizontal='center', vertical='center')
 
             self.ws.merge_cells(f'E{row_num-2}:F{row_num-2}')
             self.ws.cell(row=row_num-2, column=5).number_format = '0.00'
-            self.ws.cell(row=row_num-2, column=5).alignment = Alignment(horizontal='right', vertical='center')
+            self.ws.cell(row=row_num-2, column=5).alignment = z_styles.alignment(horizontal='right', vertical='center')
 
             z_tools.add_outer_border(self.ws, row_num-3, row_num-1, 1, 12)
             for rowIdx in range(row_num-3, row_num):
@@ -120,8 +118,8 @@ class BaoGuanBuilder():
             [None],
             [None, None, None, None, None, None, None, None, None, '海关编制', ''],
         ]
-        font = Font(name="仿宋_GB2312", size=9)
-        alignment = Alignment(horizontal="left", vertical="bottom")
+        font = z_styles.font(name="仿宋_GB2312", size=9)
+        alignment = z_styles.alignment(horizontal="left", vertical="bottom")
         endRow = z_tools.record_sheet(self.ws, content, row_num, 1, font, alignment)
         endRow -= 1
         z_tools.add_outer_border(self.ws, row_num, endRow, 1, 12)
@@ -138,48 +136,22 @@ class BaoGuanBuilder():
         z_tools.add_outer_border(self.ws, row_num + 8, row_num + 8, 1, 2, border_type='bottom')
 
     def save_data(self, save_path):
-        self.wb.save(save_path)
+        z_styles.timed_save(self.wb, save_path)
 
     def to_bytes(self) -> bytes:
         """★ 新增：把当前工作簿写入内存并返回 bytes"""
         bio = BytesIO()
-        self.wb.save(bio)
+        z_styles.timed_save(self.wb, bio)
         return bio.getvalue()
 
     def process_data(self, extract_info):
-        total_data = {}
-        for item in extract_info:
-            ywenstr = item.get('英文品名', '')
-            zwenstr = item.get('中文品名', '')
-            hsCode  = item.get('HS CODE', '')
-            show_name = f"{hsCode}{zwenstr}"
-
-            price       = item.get('单价', 0)
-            amount      = item.get('总价', 0)
-            jinWeight   = item.get('净重', 0)
-            maoWeight   = item.get('毛重', 0)
-            number      = item.get('数量', 0)
-            xinghao     = item.get('产品型号', '')
-            xiangshu    = item.get('箱数', 0)
-
-            key = (show_name, price, xinghao)
-            if key not in total_data:
-                total_data[key] = {
-                    '数量': number,
-                    '总价': amount,
-                    '净重': jinWeight,
-                    '毛重': maoWeight,
-                    '箱数': xiangshu,
-                    '境内货源地': item.get('发货地', ''),
-                    '预约号': item.get('合同号码', ''),
-                }
-            else:
-                total_data[key]['数量'] += number
-                total_data[key]['总价'] += amount
-                total_data[key]['净重'] += jinWeight
-                total_data[key]['毛重'] += maoWeight
-                total_data[key]['箱数'] += xiangshu
-        return total_data
+        # 按 (HS CODE+中文品名, 单价, 产品型号) 分组汇总
+        return aggregate(
+            Manifest.coerce(extract_info),
+            keys=[{"concat": ['HS CODE', '中文品名']}, '单价', '产品型号'],
+            sums={'数量': '数量', '总价': '总价', '净重': '净重', '毛重': '毛重', '箱数': '箱数'},
+            firsts={'境内货源地': '发货地', '预约号': '合同号码'},
+        )
     
     # ★ 改造点：返回 bytes；为兼容旧用法，save_path 设为可选
     def detect(self, dataDict, save_path: str | None = None) -> bytes:
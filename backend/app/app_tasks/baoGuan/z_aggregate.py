@@ -0,0 +1,86 @@
+"""
+报关资料共用的分组汇总。
+
+构建器只声明分组键和度量，例如合同：
+    keys  = [{"concat": ["英文品名", "中文品名"], "sep": " "}, "单价"]
+    sums  = {"数量": "数量", "金额": "总价"}
+分组、求和都在数值列上向量化完成，千分位等格式化留到写单元格时再做。
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from app.app_tasks.baoGuan.z_manifest import Manifest, NUMERIC_COLUMNS
+
+# 列名，或 {"concat": [列名...], "sep": 分隔符} 拼接出的派生键
+KeySpec = Union[str, Dict[str, Any]]
+
+
+def _default(col: str) -> Any:
+    return 0 if col in NUMERIC_COLUMNS else ""
+
+
+def _series(manifest: Manifest, col: str) -> pd.Series:
+    if col in manifest.columns:
+        return manifest.df[col].reset_index(drop=True)
+    return pd.Series([_default(col)] * len(manifest))
+
+
+def _key_series(manifest: Manifest, key: KeySpec) -> pd.Series:
+    if isinstance(key, str):
+        return _series(manifest, key)
+    parts = [_series(manifest, c).astype(str) for c in key["concat"]]
+    sep = key.get("sep", "")
+    out = parts[0]
+    for p in parts[1:]:
+        out = out + sep + p
+    return out
+
+
+def _group_sum(codes: np.ndarray, n_groups: int, values: pd.Series) -> List[Any]:
+    """按出现顺序逐行累加（与逐行 += 的结果一致）：整数列精确求和，浮点列用 bincount。"""
+    if pd.api.types.is_integer_dtype(values):
+        out = np.zeros(n_groups, dtype="int64")
+        np.add.at(out, codes, values.to_numpy(dtype="int64"))
+        return out.tolist()
+    weights = pd.to_numeric(values, errors="coerce").fillna(0.0).to_numpy(dtype="float64")
+    return np.bincount(codes, weights=weights, minlength=n_groups).tolist()
+
+
+def aggregate(
+    manifest: Manifest,
+    keys: List[KeySpec],
+    sums: Dict[str, str],
+    firsts: Dict[str, str] | None = None,
+) -> Dict[Tuple[Any, ...], Dict[str, Any]]:
+    """
+    按 keys 分组（组的顺序 = 首次出现的顺序），返回 {键元组: {度量名: 值}}：
+    - sums：{输出名: 列名}，组内求和
+    - firsts：{输出名: 列名}，取组内第一行的值
+    """
+    firsts = firsts or {}
+    if len(manifest) == 0:
+        return {}
+
+    key_cols = [_key_series(manifest, k) for k in keys]
+    codes, _ = pd.factorize(pd.MultiIndex.from_arrays(key_cols))
+    _, first_rows = np.unique(codes, return_index=True)
+    n_groups = len(first_rows)
+
+    key_lists = [k.tolist() for k in key_cols]
+    group_keys = [tuple(col[i] for col in key_lists) for i in first_rows]
+
+    measures: Dict[str, List[Any]] = {}
+    for out_name, col in sums.items():
+        measures[out_name] = _group_sum(codes, n_groups, _series(manifest, col))
+    for out_name, col in firsts.items():
+        values = manifest.column(col, _default(col))
+        measures[out_name] = [values[i] for i in first_rows]
+
+    return {
+        key: {name: vals[g] for name, vals in measures.items()}
+        for g, key in enumerate(group_keys)
+    }
@@ -0,0 +1,192 @@
+"""
+一次解析、列式存储的报关清单。
+
+ExcelReader 解析后得到 Manifest（底层是带类型的 pandas.DataFrame），
+各个构建器不再各自遍历 list[dict] 做 int(float(val)) / float(val)，
+而是通过 project() / column() 取自己需要的列投影。
+
+to_bytes() / from_bytes()：列式 JSON + zlib 的紧凑序列化，任务拆成多个 RQ 任务时写入存储的 _dag/<task_id>/ 下传递，
+列类型（int64 / float64 / 字符串）原样保留，接收方不需要重新解析 Excel。
+"""
+from __future__ import annotations
+
+import json
+import zlib
+from typing import Any, Callable, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# 解析时就确定类型的数值列（与原 ExcelReader.read_as_dicts 的转换规则一致）
+NUMERIC_COLUMNS: Dict[str, Callable[[str], Any]] = {
+    '数量': int,
+    '系数': int,
+    '箱数': int,
+    '体积': float,
+    '净重': float,
+    '毛重': float,
+    '项目': int,
+    '单价': int,
+    '总价': int,
+    '长': int,
+    '宽': int,
+    '高': int
+}
+
+_DEFAULTS = {"str": "", "int": 0, "float": 0.0}
+
+_WIRE_MAGIC = b"MF1"
+
+
+def _parse_int(s: pd.Series) -> pd.Series:
+    """等价于逐个 int(val)：只接受整数字面量，其余（含小数字符串）记 0。"""
+    s = s.astype(str).str.strip()
+    ok = s.str.fullmatch(r"[+-]?\d+")
+    out = pd.Series(0, index=s.index, dtype="int64")
+    out[ok] = s[ok].astype("int64")
+    return out
+
+
+def _parse_float(s: pd.Series) -> pd.Series:
+    """等价于逐个 float(val)，转换失败记 0.0。"""
+    out = pd.to_numeric(s.astype(str).str.strip(), errors="coerce")
+    return out.fillna(0.0).astype("float64")
+
+
+def _as_kind(s: pd.Series, kind: str) -> pd.Series:
+    """把一列转换为目标类型，规则与 z_tools.change_data_type 的 str().strip() / int(float()) / float() 一致。"""
+    numeric = pd.api.types.is_numeric_dtype(s)
+    if kind == "str":
+        return s.astype(str) if numeric else s.astype(str).str.strip()
+    if kind == "int":
+        if pd.api.types.is_integer_dtype(s):
+            return s
+        v = s.astype("float64") if numeric else pd.to_numeric(s.astype(str).str.strip(), errors="coerce")
+        v = v.where(np.isfinite(v), 0.0)
+        return np.trunc(v).astype("int64")
+    if kind == "float":
+        if numeric:
+            return s.astype("float64")
+        return _parse_float(s)
+    raise ValueError(f"未知列类型: {kind}")
+
+
+class Manifest:
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+    # ---------- 构造 ----------
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "Manifest":
+        """df：read_excel(dtype=str).fillna("") 的结果；按 NUMERIC_COLUMNS 一次性向量化转换类型。"""
+        for col, target_type in NUMERIC_COLUMNS.items():
+            if col in df.columns:
+                df[col] = _parse_int(df[col]) if target_type is int else _parse_float(df[col])
+        return cls(df)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]]) -> "Manifest":
+        """兼容旧调用方传入的 list[dict]。"""
+        df = pd.DataFrame.from_records(list(records))
+        for col in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = df[col].fillna("")
+        return cls(df)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Manifest":
+        if data[:len(_WIRE_MAGIC)] != _WIRE_MAGIC:
+            raise ValueError("不是 Manifest 序列化数据")
+        payload = json.loads(zlib.decompress(data[len(_WIRE_MAGIC):]))
+        df = pd.DataFrame({
+            name: pd.Series(values, dtype=dtype)
+            for name, dtype, values in zip(payload["columns"], payload["dtypes"], payload["data"])
+        }, columns=payload["columns"])
+        return cls(df)
+
+    def to_bytes(self) -> bytes:
+        payload = {
+            "columns": self.columns,
+            "dtypes": [str(t) for t in self.df.dtypes],
+            "data": [self.df[c].tolist() for c in self.df.columns],
+        }
+        raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+        return _WIRE_MAGIC + zlib.compress(raw, 6)
+
+    @classmethod
+    def coerce(cls, data: "Manifest | Iterable[Dict[str, Any]]") -> "Manifest":
+        return data if isinstance(data, Manifest) else cls.from_records(data)
+
+    # ---------- 访问 ----------
+    def __len__(self) -> int:
+        return len(self.df)
+
+    @property
+    def columns(self) -> List[str]:
+        return [str(c) for c in self.df.columns]
+
+    def column(self, name: str, default: Any = "") -> List[Any]:
+        """原样取一列（解析时的类型），列不存在时用 default 填充。"""
+        if name not in self.df.columns:
+            return [default] * len(self.df)
+        return self.df[name].tolist()
+
+    def first(self, name: str, default: Any = "") -> Any:
+        if len(self.df) == 0 or name not in self.df.columns:
+            return default
+        return self.df[name].iat[0]
+
+    def partition(self, name: str) -> List[tuple]:
+        """
+        按某列的取值（去掉首尾空白）拆分，返回 [(取值, Manifest), ...]，按首次出现的顺序；
+        列不存在或只有一个取值时返回 [(取值, self)]，不复制数据。
+        """
+        if name not in self.df.columns or len(self.df) == 0:
+            return [(str(self.first(name, "")).strip(), self)]
+        keys = self.df[name].astype(str).str.strip()
+        if keys.nunique() == 1:
+            return [(keys.iat[0], self)]
+        return [
+            (key, Manifest(part.reset_index(drop=True)))
+            for key, part in self.df.groupby(keys, sort=False)
+        ]
+
+    def records(self) -> List[Dict[str, Any]]:
+        return [dict(zip(self.columns, row)) for row in zip(*(self.df[c].tolist() for c in self.df.columns))]
+
+    def typed_column(self, names: List[str], kind: str) -> List[Any]:
+        """
+        按候选列名依次取值并转换为 kind（str/int/float）：
+        逐行取第一个非空的候选列，全部为空时给默认值 "" / 0 / 0.0。
+        """
+        result: pd.Series | None = None
+        filled = pd.Series(False, index=self.df.index)
+        for name in names:
+            if name not in self.df.columns:
+                continue
+            src = self.df[name]
+            has_val = pd.Series(True, index=self.df.index) if pd.api.types.is_numeric_dtype(src) else src.astype(str) != ""
+            take = has_val & ~filled
+            if not take.any():
+                continue
+            converted = _as_kind(src, kind)
+            result = converted.where(take) if result is None else result.where(~take, converted)
+            filled |= take
+        if result is None:
+            return [_DEFAULTS[kind]] * len(self.df)
+        result = result.where(filled, _DEFAULTS[kind])
+        if kind == "int":
+            result = result.astype("int64")
+        elif kind == "float":
+            result = result.astype("float64")
+        return result.tolist()
+
+    def project(self, format_dict: Dict[str, Dict[str, Any]]) -> List[List[Any]]:
+        """
+        按 {输出列: {"yinshe": [候选列名...], "type": "str|int|float"}} 取列投影，返回行优先的二维列表，
+        结果与 z_tools.change_data_type 逐行转换一致。
+        """
+        cols = [self.typed_column(cfg["yinshe"], cfg["type"]) for cfg in format_dict.values()]
+        if not cols:
+            return [[] for _ in range(len(self.df))]
+        return [list(row) for row in zip(*cols)]
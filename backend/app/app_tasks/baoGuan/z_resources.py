@@ -0,0 +1,104 @@
+"""
+worker 进程级的资源缓存：模板工作簿、公章图片每个进程只从磁盘解析一次，
+之后每个任务拿到的是独立副本；文件的 mtime / 大小变化时自动重新加载。
+
+- template_workbook(path)：模板工作簿的副本。缓存里存的是解析好的 Workbook，每个任务拿到的是它的
+  pickle 往返副本（约为重新解析 xlsx 耗时的 1/5），副本之间互不影响。不用 copy.deepcopy：
+  openpyxl 的样式表（IndexedList）deepcopy 后是空的，保存时报 IndexError；
+  行高 / 列宽表（BoundDictionary）的构造参数和 defaultdict 不同，pickle 时单独处理（_WorkbookPickler）。
+- stamp_png(path, size)：缩放到实际放置尺寸（size 像素）并重新编码的 PNG bytes，
+  构建器用 BytesIO 包一层即可（openpyxl 写出图片后会关闭传入的文件对象，不能共用）。
+"""
+from __future__ import annotations
+
+import logging
+import pickle
+from collections import Counter, defaultdict
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.utils.bound_dictionary import BoundDictionary
+
+logger = logging.getLogger(__name__)
+
+# (种类, 绝对路径, 参数) -> ((mtime_ns, size), 缓存值)
+_cache: Dict[tuple, Tuple[Tuple[int, int], Any]] = {}
+_counters: Counter = Counter()
+
+
+def _cached(kind: str, path: str | Path, params: tuple, loader: Callable[[Path], Any]) -> Any:
+    p = Path(path).resolve()
+    st = p.stat()
+    sig = (st.st_mtime_ns, st.st_size)
+    key = (kind, str(p), params)
+    entry = _cache.get(key)
+    if entry is not None and entry[0] == sig:
+        _counters[f"{kind}_hits"] += 1
+        return entry[1]
+
+    value = loader(p)
+    _cache[key] = (sig, value)
+    _counters[f"{kind}_loads"] += 1
+    logger.info(f"{'重新' if entry is not None else ''}加载资源 {p.name} ({kind}{params or ''})")
+    return value
+
+
+def _load_template(p: Path) -> Workbook:
+    return load_workbook(BytesIO(p.read_bytes()))
+
+
+def _new_bound(cls: type, default_factory):
+    d = cls.__new__(cls)
+    defaultdict.__init__(d, default_factory)
+    return d
+
+
+class _WorkbookPickler(pickle.Pickler):
+    # BoundDictionary（及子类 DimensionHolder）的构造参数和 defaultdict 不同，默认的 reduce 会把
+    # default_factory 传错位置，副本里 ws.row_dimensions[新行号] 直接 KeyError；这里绕过 __init__ 重建
+    def reducer_override(self, obj):
+        if isinstance(obj, BoundDictionary):
+            return _new_bound, (type(obj), obj.default_factory), vars(obj), None, iter(obj.items())
+        return NotImplemented
+
+
+def _copy_workbook(wb: Workbook) -> Workbook:
+    bio = BytesIO()
+    _WorkbookPickler(bio, pickle.HIGHEST_PROTOCOL).dump(wb)
+    return pickle.loads(bio.getbuffer())
+
+
+def template_workbook(path: str | Path) -> Workbook:
+    """返回模板工作簿的一个独立副本，可随意修改。"""
+    return _copy_workbook(_cached("template", path, (), _load_template))
+
+
+def _load_stamp(p: Path, size: int) -> bytes:
+    from PIL import Image as PILImage
+
+    original = p.read_bytes()
+    with PILImage.open(BytesIO(original)) as im:
+        im.load()
+        resized = max(im.size) > size
+        if resized:
+            im.thumbnail((size, size), PILImage.LANCZOS)
+        bio = BytesIO()
+        im.save(bio, format="PNG", optimize=True)
+    encoded = bio.getvalue()
+    # 没有缩放且重新编码也没变小时，沿用原文件
+    if not resized and len(encoded) >= len(original):
+        return original
+    return encoded
+
+
+def stamp_png(path: str | Path, size: int) -> bytes:
+    """公章等贴图：按放置尺寸缩放后的 PNG bytes。"""
+    return _cached("image", path, (size,), lambda p: _load_stamp(p, size))
+
+
+def stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = dict(_counters)
+    out["entries"] = len(_cache)
+    return out
@@ -0,0 +1,118 @@
+"""
+构建器共用的样式注册表（每个 worker 进程一份）。
+
+- font() / alignment() / side() / border() / fill()：相同参数只构造一次，之后直接复用同一个对象。
+  返回的对象在进程内共享，只能赋值给单元格，不要原地修改（需要变化时用新参数再取一个）。
+- StyleStamp：把一组 font/alignment/border/fill 在某个工作簿的样式表里登记一次，
+  之后逐个单元格只写入样式编号，不再对每个单元格重复做样式对象的哈希和查表。
+- stats()：对象复用、盖章单元格数、最近一次保存的样式表大小和保存耗时，用于确认大清单上的效果。
+"""
+from __future__ import annotations
+
+import time
+from collections import Counter
+from typing import Any, Dict
+
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.styles.cell_style import StyleArray
+
+_objects: Dict[tuple, Any] = {}
+_counters: Counter = Counter()
+_last_save: Dict[str, Any] = {}
+
+
+def _intern(kind: str, factory, kwargs: Dict[str, Any]):
+    key = (kind, tuple(sorted(kwargs.items())))
+    obj = _objects.get(key)
+    if obj is None:
+        obj = _objects[key] = factory(**kwargs)
+        _counters[f"{kind}_created"] += 1
+    else:
+        _counters[f"{kind}_reused"] += 1
+    return obj
+
+
+def font(**kwargs) -> Font:
+    return _intern("font", Font, kwargs)
+
+
+def alignment(**kwargs) -> Alignment:
+    return _intern("alignment", Alignment, kwargs)
+
+
+def side(style: str = "thin", color: str = "000000") -> Side:
+    return _intern("side", Side, {"border_style": style, "color": color})
+
+
+def border(left: Side | None = None, right: Side | None = None,
+           top: Side | None = None, bottom: Side | None = None) -> Border:
+    return _intern("border", Border, {"left": left, "right": right, "top": top, "bottom": bottom})
+
+
+def fill(color: str, fill_type: str = "solid") -> PatternFill:
+    return _intern("fill", PatternFill, {"start_color": color, "end_color": color, "fill_type": fill_type})
+
+
+def thin_border(color: str = "000000") -> Border:
+    s = side("thin", color)
+    return border(left=s, right=s, top=s, bottom=s)
+
+
+class StyleStamp:
+    """
+    一组样式在某个工作簿里的编号。第一次 apply 时才登记到工作簿的样式表
+    （没有写入任何单元格时不会多出样式），之后每个单元格只改 StyleArray 里的编号，
+    效果与逐个赋值 cell.font / cell.alignment / cell.border / cell.fill 相同。
+    """
+
+    def __init__(self, font: Font | None = None, alignment: Alignment | None = None,
+                 border: Border | None = None, fill: PatternFill | None = None):
+        self._styles = (("fontId", "_fonts", font), ("alignmentId", "_alignments", alignment),
+                        ("borderId", "_borders", border), ("fillId", "_fills", fill))
+        self._ids: Dict[tuple, list] = {}
+
+    def _resolve(self, wb, with_fill: bool) -> list:
+        ids = self._ids.get((id(wb), with_fill))
+        if ids is None:
+            ids = self._ids[(id(wb), with_fill)] = [
+                (key, getattr(wb, coll).add(obj))
+                for key, coll, obj in self._styles
+                if obj is not None and (with_fill or key != "fillId")
+            ]
+        return ids
+
+    def apply(self, cell, with_fill: bool = True) -> None:
+        style = cell._style
+        if not style:
+            style = cell._style = StyleArray()
+        for key, idx in self._resolve(cell.parent.parent, with_fill):
+            setattr(style, key, idx)
+        _counters["cells_stamped"] += 1
+
+
+def record_save(wb, seconds: float) -> None:
+    """构建器保存工作簿后调用，记录样式表大小和保存耗时。"""
+    _counters["saves"] += 1
+    _last_save.clear()
+    _last_save.update(
+        fonts=len(wb._fonts),
+        alignments=len(wb._alignments),
+        borders=len(wb._borders),
+        fills=len(wb._fills),
+        cell_styles=len(wb._cell_styles),
+        save_seconds=round(seconds, 4),
+    )
+
+
+def timed_save(wb, target) -> None:
+    t0 = time.perf_counter()
+    wb.save(target)
+    record_save(wb, time.perf_counter() - t0)
+
+
+def stats() -> Dict[str, Any]:
+    """当前进程的累计计数，外加最近一次保存的样式表大小（last_save）。"""
+    out: Dict[str, Any] = dict(_counters)
+    out["distinct"] = len(_objects)
+    out["last_save"] = dict(_last_save)
+    return out
@@ -3,20 +3,33 @@ from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
 from openpyxl.utils import get_column_letter
 from enum import Enum
 
+from app.app_tasks.baoGuan.z_manifest import Manifest
+from app.app_tasks.baoGuan import z_styles
+
 class Direction(Enum):
     HORIZONTAL = "horizontal"
     VERTICAL = "vertical"
 
 
-def set_sheet_size(sheetobj, widthlist, heightlist):
+def set_sheet_size(sheetobj, widthlist, heightlist, default_height=None):
+    """
+    default_height：行高列表之外的行使用的行高，仅流式工作表（z_writer.StreamingSheet）写出数据行时使用；
+    流式工作表上已写出的行会被跳过。
+    """
     for idx, width in enumerate(widthlist, start=1):
         col_letter = get_column_letter(idx)
         sheetobj.column_dimensions[col_letter].width = width
 
     # 设置行高（row = 数字）
+    first_row = getattr(sheetobj, "min_writable_row", 1)
     for idx, height in enumerate(heightlist, start=1):
+        if idx < first_row:
+            continue
         sheetobj.row_dimensions[idx].height = height
 
+    if default_height is not None and hasattr(sheetobj, "default_row_height"):
+        sheetobj.default_row_height = default_height
+
 
 def add_outer_border(ws, min_row, max_row, min_col, max_col, style="thin", color="000000", border_type="outer"):
     """
@@ -28,7 +41,7 @@ def add_outer_border(ws, min_row, max_row, min_col, max_col, style="thin", color
     color: 边框颜色，十六进制字符串
     border_type: "top", "bottom", "left", "right", "outer"
     """
-    side = Side(border_style=style, color=color)
+    side = z_styles.side(style, color)
 
     for row in range(min_row, max_row + 1):
         for col in range(min_col, max_col + 1):
@@ -39,12 +52,77 @@ def add_outer_border(ws, min_row, max_row, min_col, max_col, style="thin", color
             left = side if (border_type in ["left", "outer"] and col == min_col) else None
             right = side if (border_type in ["right", "outer"] and col == max_col) else None
             
-            cell.border = Border(top=top, bottom=bottom, left=left, right=right)
+            cell.border = z_styles.border(top=top, bottom=bottom, left=left, right=right)
+
+
+
+def _existing_value(sheetobj, row, col):
+    """读取表中已有的值，不像 sheetobj.cell() 那样顺手创建空单元格。"""
+    if row < 1 or col < 1:
+        raise ValueError("Row or column values must be at least 1")
+    cell = sheetobj._cells.get((row, col))
+    return cell.value if cell is not None else None
+
+
+def plan_merges(sheetobj, erweiData, start_row, start_col, konggeDirect=Direction.HORIZONTAL):
+    """
+    根据内存中的二维数据一次性算出需要合并的区域，返回 [(起始行, 起始列, 结束行, 结束列), ...]。
 
+    规则：数据中每个 "" 单元格向左（HORIZONTAL）或向上（VERTICAL）延伸，
+    直到遇到第一个非空单元格，二者之间合并为一块；已被某次延伸覆盖的单元格不再作为起点。
+    数据块之外、以及 "" 位置（本次不写入）的值取表中已有内容。
+    每个单元格最多被扫描一次，整体线性。
+    """
+    def is_empty(row, col):
+        r_off = row - start_row
+        c_off = col - start_col
+        if 0 <= r_off < len(erweiData) and 0 <= c_off < len(erweiData[r_off]):
+            value = erweiData[r_off][c_off]
+            if value != "":
+                return value is None
+        value = _existing_value(sheetobj, row, col)
+        return value is None or value == ""
+
+    ranges = []
+    used = set()
+    # 与逐个处理的顺序一致：行从下往上、列从右往左
+    for r_offset in range(len(erweiData) - 1, -1, -1):
+        row = erweiData[r_offset]
+        idRow = start_row + r_offset
+        for c_offset in range(len(row) - 1, -1, -1):
+            if row[c_offset] != "":
+                continue
+            idCol = start_col + c_offset
+            if (idRow, idCol) in used:
+                continue
 
+            if konggeDirect == Direction.HORIZONTAL:
+                test_col = idCol - 1
+                while is_empty(idRow, test_col):
+                    used.add((idRow, test_col))
+                    test_col -= 1
+                ranges.append((idRow, test_col, idRow, idCol))
+            elif konggeDirect == Direction.VERTICAL:
+                test_row = idRow - 1
+                while is_empty(test_row, idCol):
+                    used.add((test_row, idCol))
+                    test_row -= 1
+                ranges.append((test_row, idCol, idRow, idCol))
+    return ranges
+
+
+def record_sheet(sheetobj, erweiData, start_row, start_col, fontConfig, alignment, konggeDirect=Direction.HORIZONTAL, border=None, color=None, isMerge=True, stream=False):
+    """
+    stream=True：声明这块数据写完后不再修改。流式工作表上会先写出 start_row 之前的行，
+    不合并时每写完一行就写出一行，内存里只保留当前行；普通工作表上没有任何影响。
+    样式通过 z_styles.StyleStamp 在工作簿里只登记一次，逐个单元格只写编号。
+    """
+    stamp = z_styles.StyleStamp(font=fontConfig, alignment=alignment, border=border or None, fill=color or None)
+    blank_stamp = z_styles.StyleStamp(border=border) if border is not None else None
+    flush_rows = getattr(sheetobj, "flush_rows", None) if stream else None
+    if flush_rows:
+        flush_rows(start_row)
 
-def record_sheet(sheetobj, erweiData, start_row, start_col, fontConfig, alignment, konggeDirect=Direction.HORIZONTAL, border=None, color=None, isMerge=True):
-    merged = set()  # 记录已处理过的单元格，避免重复合并
     maxRow = 0
     for r_offset, row in enumerate(erweiData):
         for c_offset, value in enumerate(row):
@@ -55,97 +133,32 @@ def record_sheet(sheetobj, erweiData, start_row, start_col, fontConfig, alignmen
             if value == "":
                 if not isMerge:
                     cell = sheetobj.cell(row=r_idx, column=c_idx, value=None)
-                    cell.border = border
-                merged.add((r_idx, c_idx))
+                    if blank_stamp is not None:
+                        blank_stamp.apply(cell)
+                    else:
+                        cell.border = border
                 continue
-            
+
             # 正常写入当前非空单元格
             cell = sheetobj.cell(row=r_idx, column=c_idx, value=value)
-            cell.font = fontConfig
-            cell.alignment = alignment
-            if border:
-                cell.border = border
-            if color and value != 0:
-                cell.fill = color
+            stamp.apply(cell, with_fill=bool(color) and value != 0)
+        if flush_rows and not isMerge:
+            flush_rows(start_row + r_offset + 1)
 
     if not isMerge:
         return maxRow + 1
 
-    sorted_merged = sorted(merged, key=lambda x: (-x[0], -x[1]))
-    used_item = []
-    for kong_item in sorted_merged:
-        idRow, idCol = kong_item
-        if kong_item in used_item:
-            continue
-
-        if konggeDirect == Direction.HORIZONTAL:
-            st_row = idRow
-            ed_row = idRow
-            test_col = idCol - 1
-            while True:
-                if sheetobj.cell(row=idRow, column=test_col).value != None and sheetobj.cell(row=idRow, column=test_col).value != "":
-                    break
-                used_item.append((idRow, test_col))
-                test_col = test_col - 1
-            # print(f"合并: R{st_row}C{test_col} -> R{ed_row}C{idCol}")
-            sheetobj.merge_cells(start_row=st_row, start_column=test_col, end_row=ed_row, end_column=idCol)
-        elif konggeDirect == Direction.VERTICAL:
-            st_col = idCol
-            ed_col = idCol
-            test_row = idRow -1
-            while True:
-                if sheetobj.cell(row=test_row, column=st_col).value != None and sheetobj.cell(row=test_row, column=st_col).value != "":
-                    break
-                used_item.append((test_row, st_col))
-                test_row = test_row - 1
-            sheetobj.merge_cells(start_row=test_row, start_column=st_col, end_row=idRow, end_column=ed_col)
-            # print(f"合并: R{test_row}C{st_col} -> R{idRow}C{ed_col}")
+    # 数据全部写入后，再按规划结果批量合并
+    for st_row, st_col, ed_row, ed_col in plan_merges(sheetobj, erweiData, start_row, start_col, konggeDirect):
+        sheetobj.merge_cells(start_row=st_row, start_column=st_col, end_row=ed_row, end_column=ed_col)
+    if flush_rows:
+        flush_rows(maxRow + 1)
     return maxRow + 1
 
 
 def change_data_type(format_dict, data):
-    total_data = []
-
-    for item in data:  # 每一行提取结果
-        single_data = []
-        for key, config in format_dict.items():
-            has_val = False
-            val = None
-            # 遍历映射字段
-            for val_item in config["yinshe"]:
-                if val_item in item and item[val_item] not in [None, ""]:
-                    val = item[val_item]
-                    has_val = True
-                    break
-
-            # 如果没有取到，默认值为 0 或 ""
-            if not has_val:
-                if config["type"] == "str":
-                    val = ""
-                elif config["type"] == "int":
-                    val = 0
-                elif config["type"] == "float":
-                    val = 0.0
-            else:
-                # 做类型转换
-                try:
-                    if config["type"] == "str":
-                        val = str(val).strip()
-                    elif config["type"] == "int":
-                        val = int(float(val))  # 兼容小数字符串
-                    elif config["type"] == "float":
-                        val = float(val)
-                except Exception:
-                    # 转换失败兜底
-                    if config["type"] == "str":
-                        val = str(val)
-                    elif config["type"] == "int":
-                        val = 0
-                    elif config["type"] == "float":
-                        val = 0.0
-
-            single_data.append(val)
-
-        total_data.append(single_data)
-
-    return total_data
\ No newline at end of file
+    """
+    按 format_dict 把清单映射为二维数据（行优先）。
+    data 可以是 Manifest（推荐，列式向量化转换），也可以是旧的 list[dict]。
+    """
+    return Manifest.coerce(data).project(format_dict)
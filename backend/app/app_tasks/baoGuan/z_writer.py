@@ -0,0 +1,119 @@
+"""
+构建器使用的工作簿后端。
+
+- openpyxl（默认）：普通内存 Workbook，整张表的单元格都留在内存里，保存时一次写出。
+- streaming：openpyxl write_only 工作簿。构建器和 z_tools 面对的仍是一个普通 Worksheet（行缓冲），
+  调用 flush_rows() 后，已完成的行按顺序写入 write_only 工作表（落在临时文件上）并从内存移除，
+  数万行的清单内存占用也保持平稳。
+
+流式模式的约束：已写出的行不能再修改；列宽必须在第一次写出前设置，
+数据行的行高取 default_row_height（见 z_tools.set_sheet_size 的 default_height）。
+"""
+from __future__ import annotations
+
+import copy
+from collections import defaultdict
+from io import BytesIO
+
+from openpyxl import Workbook
+from openpyxl.cell.cell import Cell, MergedCell
+from openpyxl.worksheet.worksheet import Worksheet
+
+from app.app_tasks.baoGuan import z_styles
+
+BACKENDS = ("openpyxl", "streaming")
+
+
+def _as_cell(cell):
+    # write_only 工作表只接受 Cell；合并区域里的 MergedCell 只带样式（边框），转成同样式的空 Cell
+    if isinstance(cell, MergedCell):
+        out = Cell(cell.parent, row=cell.row, column=cell.column)
+        out._style = copy.copy(cell._style)
+        return out
+    return cell
+
+
+class StreamingSheet(Worksheet):
+    """行缓冲工作表：未写出的行和普通 Worksheet 一样读写，flush_rows() 之后按行流式写出。"""
+
+    def __init__(self, parent: Workbook, target, title: str):
+        super().__init__(parent, f"{title}_buffer")
+        self._target = target
+        self.min_writable_row = 1
+        self.default_row_height: float | None = None
+
+    def _get_cell(self, row, column):
+        if row < self.min_writable_row:
+            raise ValueError(f"第 {row} 行已写出，流式工作表不能再修改")
+        return super()._get_cell(row, column)
+
+    def flush_rows(self, upto_row: int) -> None:
+        """把 upto_row 之前（不含）的所有行写出并从内存移除。"""
+        if upto_row <= self.min_writable_row:
+            return
+
+        if self._target._writer is None:
+            # 列宽写在 sheetData 之前，第一次写出时一并带过去
+            for key, dim in self.column_dimensions.items():
+                if dim.width:
+                    self._target.column_dimensions[key].width = dim.width
+
+        rows = defaultdict(dict)
+        for key in [k for k in self._cells if k[0] < upto_row]:
+            rows[key[0]][key[1]] = self._cells.pop(key)
+
+        for r in range(self.min_writable_row, upto_row):
+            dim = self.row_dimensions.pop(r, None)
+            height = dim.height if dim is not None and dim.height else self.default_row_height
+            if height:
+                self._target.row_dimensions[r].height = height
+            cells = rows.get(r, {})
+            line = [None] * (max(cells) if cells else 0)
+            for c, cell in cells.items():
+                line[c - 1] = _as_cell(cell)
+            self._target.append(line)
+        self.min_writable_row = upto_row
+
+    def finish(self) -> None:
+        """写出剩余的行，并把合并区域、图片交给 write_only 工作表（保存时写在 sheetData 之后）。"""
+        last = max((r for r, _ in self._cells), default=0)
+        last = max([last] + [r for r in self.row_dimensions if r >= self.min_writable_row])
+        self.flush_rows(last + 1)
+        for mcr in self.merged_cells.ranges:
+            self._target.merged_cells.add(mcr.coord)
+        self._target._images.extend(self._images)
+
+
+class Book:
+    """按 backend 创建工作簿；构建器通过 .wb / .ws 操作，通过 to_bytes()/save() 导出。"""
+
+    def __init__(self, title: str, backend: str = "openpyxl"):
+        if backend not in BACKENDS:
+            raise ValueError(f"未知工作簿后端: {backend}，可选 {BACKENDS}")
+        self.backend = backend
+        if backend == "streaming":
+            self.wb = Workbook(write_only=True)
+            target = self.wb.create_sheet(title)
+            self.ws = StreamingSheet(self.wb, target, title)
+        else:
+            self.wb = Workbook()
+            self.ws = self.wb.active
+            self.ws.title = title
+
+    @property
+    def streaming(self) -> bool:
+        return self.backend == "streaming"
+
+    def _finish(self) -> None:
+        if self.streaming:
+            self.ws.finish()
+
+    def save(self, save_path: str) -> None:
+        self._finish()
+        z_styles.timed_save(self.wb, save_path)
+
+    def to_bytes(self) -> bytes:
+        self._finish()
+        bio = BytesIO()
+        z_styles.timed_save(self.wb, bio)
+        return bio.getvalue()
@@ -0,0 +1,310 @@
+"""
+报关资料的任务图：解析 -> 5 个构建器 -> 打包，各是一个 RQ 任务，用 depends_on 串起来。
+
+- parse：读入上传的清单，解析并按合同号码拆分，每个合同的 Manifest 以紧凑格式（Manifest.to_bytes）写入存储
+- build<i>：依次为每个合同构建第 i 个报关资料，xlsx 写入存储；5 个构建任务可以被不同机器上的 worker 并行领取，
+  构建出错时按 BAOGUAN_DAG_RETRIES 单独重试，不重新解析，已写入的合同跳过；
+  解析失败或清单已过期时重试也读不到清单，直接失败（UpstreamFailed）
+- zip：job_id 就是上传返回的 task_id，收齐各合同的 xlsx 后打包落盘（多合同时每个合同一个文件夹）；/status、/download、结果缓存和准入回调都挂在它上面
+
+执行耗时（上传准入的单任务耗时估计）按任务记一条：各阶段成功后把自己的执行秒数累加到 Redis，
+打包任务成功时连同自己的一起记一次，与整体任务（process_BaoGuan）的一次执行可比，不把各阶段耗时混进同一个平均里。
+
+依赖都带 allow_failure：上游失败时下游照常运行，读不到中间结果就带着上游的错误信息失败，
+最终在 task_id 这个任务上体现为 failed，不会一直停在 deferred。
+中间结果放在存储的 _dag/<task_id>/ 下（storage.put_scratch），Redis 里只记它们的 key（带 BAOGUAN_DAG_TTL）；
+打包任务结束时不论成败都删除，遗留的由保留期清理删除。
+"""
+from __future__ import annotations
+
+import json
+import logging
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+from redis import Redis
+from redis.client import Pipeline
+from rq import Queue, Retry, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Dependency, Job, JobStatus
+
+from app.app_tasks import process_BaoGuan as pb
+from app.app_tasks.baoGuan.z_manifest import Manifest
+from app.app_tasks.process import _record_service, _record_wait, _stage_of
+from app.core.config import get_settings
+from app.infrastructure import job_events, progress, queues, stage_timing
+from app.infrastructure.storage import (open_input, put_scratch, read_scratch, remove_input, remove_scratch,
+                                        save_output)
+
+logger = logging.getLogger("erp.worker.dag")
+settings = get_settings()
+
+TASK_TYPE = "baoguan"
+
+
+def _key(task_id: str, part: str) -> str:
+    return f"baoguan_dag:{task_id}:{part}"
+
+
+def _parse_id(task_id: str) -> str:
+    return f"{task_id}-parse"
+
+
+def _build_id(task_id: str, index: int) -> str:
+    return f"{task_id}-build{index}"
+
+
+class UpstreamFailed(RuntimeError):
+    """上游阶段的结果读不到（解析失败、中间结果已过期），重试本阶段也不会成功。"""
+
+
+def _contracts(conn: Redis, task_id: str) -> list[str]:
+    raw = conn.get(_key(task_id, "contracts"))
+    if raw is None:
+        raise UpstreamFailed(f"清单解析失败: {_failure_of(conn, _parse_id(task_id))}")
+    return json.loads(raw)
+
+
+def _part_key(task_id: str, index: int, contract_index: int) -> str:
+    return _key(task_id, f"part{index}:{contract_index}")
+
+
+def _add_spent(conn: Redis, task_id: str, seconds: float) -> None:
+    """累加本任务各阶段的执行秒数，打包任务汇总后记一次执行耗时；失败不影响任务本身。"""
+    key = _key(task_id, "spent")
+    try:
+        pipe = conn.pipeline()
+        pipe.incrbyfloat(key, round(seconds, 3))
+        pipe.expire(key, settings.BAOGUAN_DAG_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning("记录阶段耗时失败 (task_id=%s): %s", task_id, e)
+
+
+def _cleanup(conn: Redis, task_id: str) -> None:
+    """删掉任务图的中间结果：存储里的对象和 Redis 里对它们的引用。打包任务结束时调用，不论成败。"""
+    raw = conn.get(_key(task_id, "contracts"))
+    n = len(json.loads(raw)) if raw else 0
+    conn.delete(
+        _key(task_id, "contracts"),
+        _key(task_id, "spent"),
+        *[_key(task_id, f"manifest:{ci}") for ci in range(n)],
+        *[_part_key(task_id, i, ci) for i in range(len(pb.DOCUMENT_BUILDERS)) for ci in range(n)],
+    )
+    try:
+        remove_scratch(task_id)
+    except Exception as e:
+        logger.warning("删除任务图中间结果失败 (task_id=%s): %s", task_id, e)
+
+
+def _stages(conn: Redis, task_id: str, job: Job | None = None) -> stage_timing.StageProgress:
+    """阶段进度都合并写到 task_id（打包任务）的 meta 上。"""
+    return stage_timing.StageProgress(conn, task_id, TASK_TYPE, pb.PIPELINE_GROUPS, job=job)
+
+
+def _failure_of(conn: Redis, job_id: str) -> str:
+    try:
+        job = Job.fetch(job_id, connection=conn)
+    except NoSuchJobError:
+        return "任务记录已过期"
+    return job.meta.get("error_message") or f"状态 {job.get_status()}"
+
+
+def _fail(job, e: Exception, input_key: str | None = None) -> None:
+    """
+    记下错误信息；上游失败（UpstreamFailed）时清掉剩余重试次数，RQ 直接记为失败。
+    input_key：解析失败且不会再重试时删掉 spool 输入（成功时在 parse_task 里删）。
+    """
+    if job:
+        if isinstance(e, UpstreamFailed):
+            job.retries_left = 0
+        job.meta["error_message"] = str(e)[:500]
+        job.save_meta()
+    if input_key and not (job and job.retries_left):
+        try:
+            remove_input(input_key)
+        except Exception as err:
+            logger.warning("删除上传输入失败 (task_id=%s): %s", getattr(job, "id", None), err)
+
+
+# ---------- 各阶段任务（在 worker 里执行） ----------
+def parse_task(task_id: str, raw: bytes | None, input_key: str | None = None) -> dict:
+    job = get_current_job()
+    _record_wait(job)
+    conn = job.connection
+    stages = _stages(conn, task_id)
+    stages.start("parse")
+    job_events.emit(conn, task_id, "started", "parsing")
+    started = time.perf_counter()
+    source = open_input(input_key) if input_key else nullcontext(raw)
+    try:
+        with source as raw:
+            manifest = pb._read_manifest(raw)
+        stages.finish("parse", time.perf_counter() - started, len(manifest))
+        contracts = pb.split_contracts(manifest)
+        pipe = conn.pipeline()
+        payload_size = 0
+        for ci, (_, part) in enumerate(contracts):
+            payload = part.to_bytes()
+            payload_size += len(payload)
+            ref = put_scratch(task_id, f"manifest-{ci}.bin", payload)
+            pipe.set(_key(task_id, f"manifest:{ci}"), ref, ex=settings.BAOGUAN_DAG_TTL)
+        names = [c for c, _ in contracts]
+        pipe.set(_key(task_id, "contracts"), json.dumps(names, ensure_ascii=False), ex=settings.BAOGUAN_DAG_TTL)
+        pipe.execute()
+        # 5 个构建任务各自由一个 worker 领取，按同时运行估计 ETA
+        reporter = progress.Reporter(conn, task_id, lambda step: job_events.emit(conn, task_id, "started", _stage_of(step)),
+                                     stages=stages, doc_stages=pb.DOCUMENT_STAGES)
+        reporter.start([(c, len(m)) for c, m in contracts], len(pb.DOCUMENT_BUILDERS), workers=len(pb.DOCUMENT_BUILDERS))
+    except Exception as e:
+        logger.exception("清单解析失败 (task_id=%s): %s", task_id, e)
+        _fail(job, e, input_key)
+        raise
+
+    if input_key:
+        remove_input(input_key)
+    _add_spent(conn, task_id, time.perf_counter() - started)
+    logger.info("清单解析完成 task_id=%s rows=%d contracts=%d manifest=%d bytes",
+                task_id, len(manifest), len(contracts), payload_size)
+    return {"rows": len(manifest), "contracts": names, "manifest_bytes": payload_size}
+
+
+def build_task(task_id: str, index: int) -> dict:
+    job = get_current_job()
+    _record_wait(job)
+    conn = job.connection
+    fname, stage = pb.DOCUMENT_BUILDERS[index][0], pb.DOCUMENT_STAGES[index]
+    reporter = progress.Reporter(conn, task_id, lambda step: job_events.emit(conn, task_id, "started", "building"))
+    stages = _stages(conn, task_id)
+    started = time.perf_counter()
+    sizes = []
+    spent, rows = 0.0, 0  # 本次实际构建的合同的耗时和行数（重试时跳过的不算）
+    try:
+        contracts = _contracts(conn, task_id)
+        stages.start(stage)  # 解析成功后才算开始，上游失败时进度停在原处
+        for ci, hetong_no in enumerate(contracts):
+            key = _part_key(task_id, index, ci)
+            if not conn.exists(key):  # 重试时跳过已经写入的合同
+                ref = conn.get(_key(task_id, f"manifest:{ci}"))
+                payload = read_scratch(ref.decode()) if ref else None
+                if payload is None:
+                    raise UpstreamFailed(f"合同 {hetong_no} 的清单已过期")
+                manifest = Manifest.from_bytes(payload)
+                blob, dt, style_stats = pb._build_document(index, manifest, hetong_no)
+                # 先写存储再记引用：引用存在时对象一定已经完整写入（重试据此跳过）
+                conn.set(key, put_scratch(task_id, f"part{index}-{ci}.xlsx", blob), ex=settings.BAOGUAN_DAG_TTL)
+                sizes.append(len(blob))
+                spent, rows = spent + dt, rows + len(manifest)
+                logger.info(f"[{hetong_no}] 生成 {fname} 完成, 大小 {len(blob)} bytes, 用时 {dt:.2f}s, 样式表 {style_stats}")
+            stages.advance(stage, (ci + 1) / len(contracts))
+            reporter.done(ci, index)
+        # 全部是重试前就写好的合同时只标记完成，不计入耗时统计
+        stages.finish(stage, spent if rows else None, rows)
+    except Exception as e:
+        logger.exception("生成 %s 失败 (task_id=%s): %s", fname, task_id, e)
+        _fail(job, e)
+        raise
+
+    _add_spent(conn, task_id, time.perf_counter() - started)
+    return {"file": fname, "contracts": len(sizes), "size": sum(sizes)}
+
+
+def zip_task(task_id: str) -> dict:
+    job = get_current_job()
+    _record_wait(job)
+    started = time.perf_counter()
+    conn = job.connection
+    stages = _stages(conn, task_id, job=job)
+    job_events.emit(conn, task_id, "started", "packing", job=job)
+    n_docs = len(pb.DOCUMENT_BUILDERS)
+    try:
+        contracts = _contracts(conn, task_id)
+        # 单个合同时 zip 根目录就是 5 个 xlsx；多个合同时每个合同一个文件夹
+        folders = pb.contract_folders(contracts) if len(contracts) > 1 else [""]
+        outputs = []
+        for ci, folder in enumerate(folders):
+            refs = conn.mget([_part_key(task_id, i, ci) for i in range(n_docs)])
+            for i, ((fname, _), ref) in enumerate(zip(pb.DOCUMENT_BUILDERS, refs)):
+                blob = read_scratch(ref.decode()) if ref else None
+                if blob is None:
+                    raise RuntimeError(f"{fname} 生成失败: {_failure_of(conn, _build_id(task_id, i))}")
+                outputs.append((f"{folder}/{fname}" if folder else fname, blob))
+        stages.start("zip")  # 各 xlsx 都收齐后才算开始
+        zipped = time.perf_counter()
+        zip_bytes = pb._zip_outputs(outputs)
+        stages.finish("zip", time.perf_counter() - zipped)
+
+        path = save_output(task_id, "zip", zip_bytes, TASK_TYPE)
+        logger.info("文件已保存: %s (size=%d)", path, len(zip_bytes))
+        spent = float(conn.get(_key(task_id, "spent")) or 0)  # 解析和构建阶段的执行秒数，_cleanup 会删掉
+    except Exception as e:
+        logger.exception("任务处理失败 (task_id=%s, type=%s): %s", task_id, TASK_TYPE, e)
+        _fail(job, e)
+        raise
+    finally:
+        _cleanup(conn, task_id)
+
+    job.meta["output_ext"] = "zip"
+    job.meta["filename"] = f"baoguan_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    job.save_meta()
+    _record_service(job, TASK_TYPE, spent + time.perf_counter() - started)
+    return {"path": path, "ext": "zip"}
+
+
+# ---------- 投递（在 API 里执行） ----------
+def _job_ids(task_id: str) -> list[str]:
+    return [_parse_id(task_id), *(_build_id(task_id, i) for i in range(len(pb.DOCUMENT_BUILDERS))), task_id]
+
+
+def enqueue(queue: Queue, task_id: str, raw: bytes | None, input_key: str | None, pipeline: Pipeline,
+            **final_kwargs) -> Job:
+    """
+    把整张任务图的写入加进 pipeline（事务型），返回 job_id=task_id 的打包任务。
+    调用方可以往同一个 pipeline 追加其他写入（状态快照、准入登记等），execute 时一起生效：
+    worker 不会在图还没建完时就领到解析任务。
+    final_kwargs 原样传给打包任务的 create_job（meta / result_ttl / on_success / on_failure 等）。
+    """
+    retry = Retry(max=settings.BAOGUAN_DAG_RETRIES) if settings.BAOGUAN_DAG_RETRIES > 0 else None
+    # 失败的阶段任务要和打包任务的失败记录保留一样久，打包任务的错误信息从它们的 meta 里取
+    stage_kwargs = {"failure_ttl": final_kwargs["failure_ttl"]} if "failure_ttl" in final_kwargs else {}
+
+    parse = queue.create_job(
+        parse_task, args=(task_id, raw), kwargs={"input_key": input_key},
+        job_id=_parse_id(task_id),
+        description=f"baoguan parse {task_id}",
+        **stage_kwargs,
+    )
+    builds = [
+        queue.create_job(
+            build_task, args=(task_id, index),
+            job_id=_build_id(task_id, index),
+            description=f"baoguan build {fname} {task_id}",
+            depends_on=Dependency(jobs=[parse], allow_failure=True),
+            retry=retry,
+            **stage_kwargs,
+        )
+        for index, (fname, _) in enumerate(pb.DOCUMENT_BUILDERS)
+    ]
+    final = queue.create_job(
+        zip_task, args=(task_id,),
+        job_id=task_id,
+        description=f"baoguan zip {task_id}",
+        depends_on=Dependency(jobs=builds, allow_failure=True),
+        **final_kwargs,
+    )
+    # 解析任务先入队（enqueue_job 会把 pipeline 切到 MULTI，必须是第一批命令），构建和打包都依赖它，直接记为 deferred
+    queue.enqueue_job(parse, pipeline=pipeline)
+    for job in (*builds, final):
+        queues.defer_job(queue, job, pipeline)
+    return final
+
+
+def discard(conn: Redis, task_id: str) -> None:
+    """
+    投递失败时删掉任务图里已经写入的任务。
+    事务里某条命令执行出错时 EXEC 不会回滚其余命令，图可能只建了一部分。
+    """
+    for job in Job.fetch_many(_job_ids(task_id), connection=conn):
+        if job is not None:
+            job.delete()
@@ -1,11 +1,15 @@
-from app.infrastructure.storage import output_path
+from app.infrastructure.storage import save_output, open_input, remove_input
+from app.infrastructure import result_cache, queues, admission, progress, job_events, webhooks, stage_timing
 from app.core.loggers import setup_logging
-from pathlib import Path
+from contextlib import nullcontext
 from rq import get_current_job
 from datetime import datetime
 import logging
+import time
+import traceback
 # 避免同名递归：把导入的函数改名
 from app.app_tasks.process_BaoGuan import _handle_excel_with_baoguan as build_baoguan_zip
+from app.app_tasks.process_BaoGuan import DOCUMENT_STAGES, PIPELINE_GROUPS
 
 
 setup_logging("INFO")  # 关键：在 worker 进程里也调用
@@ -24,50 +28,102 @@ def _handle_excel_to_pdf(raw: bytes) -> bytes:
     logger.info("进入 _handle_excel_to_pdf, 输入大小=%d bytes", len(raw))
     return raw
 
-def _handle_excel_with_baoguan(raw: bytes) -> bytes:
+def _handle_excel_with_baoguan(raw: bytes, reporter: progress.Reporter | None = None) -> bytes:
     """
-    Excel -> 生成5个xlsx -> 打包zip（二进制返回）
+    Excel -> 每个合同生成5个xlsx -> 打包zip（二进制返回）
     实际工作交给 build_baoguan_zip（来自 process_BaoGuan）
     """
     logger.info("进入 _handle_excel_with_baoguan, 输入大小=%d bytes", len(raw))
-    return build_baoguan_zip(raw)  # ← 调用真正实现
+    return build_baoguan_zip(raw, progress=reporter)  # ← 调用真正实现
 
 
-def process_file_task(task_id: str, raw: bytes, task_type: str, ext: str = "txt"):
-    job = get_current_job()
-    in_size = len(raw) if isinstance(raw, (bytes, bytearray)) else -1
-    logger.info(
-        "进入 process_file_task job_id=%s type=%s ext=%s in_size=%s",
-        getattr(job, "id", None), task_type, ext, in_size
-    )
+def _record_wait(job) -> None:
+    """记录本任务的排队等待时间（入队 -> 开始执行），供 /files/queues 统计；失败不影响任务本身。"""
+    if job is None:
+        return
+    try:
+        waited = queues.wait_seconds(job, until=job.started_at)
+        if waited is not None:
+            queues.record_wait(job.connection, job.origin, waited)
+    except Exception as e:
+        logger.warning("记录排队等待时间失败: %s", e)
+
+
+def _record_service(job, task_type: str, seconds: float) -> None:
+    """记录本次执行耗时，上传准入按任务类型估计排队时间用；失败不影响任务本身。"""
+    if job is None:
+        return
+    try:
+        queues.record_service(job.connection, task_type, seconds)
+    except Exception as e:
+        logger.warning("记录执行耗时失败: %s", e)
+
+
+# 报关资料流水线的阶段 -> 推送的阶段；5 个构建器都是 building
+_STAGE_OF_STEP = {"parse": "parsing", "zip": "packing"}
+
+
+def _stage_of(step: str | None) -> str:
+    return _STAGE_OF_STEP.get(step, "building")
+
+
+def _emit(job, stage: str) -> None:
+    """推送执行中的阶段（SSE / WebSocket 订阅者、/status 都读这份快照）。"""
+    if job is not None:
+        job_events.emit(job.connection, job.id, "started", stage, job=job)
+
 
+def process_file_task(task_id: str, raw: bytes | None, task_type: str, ext: str = "txt", input_key: str | None = None):
+    """
+    raw：inline 模式下随任务投递的原始内容；
+    input_key：spool 模式下 API 已落盘的输入引用，此时 raw 为 None，输入经 mmap 只读映射进来。
+    """
+    job = get_current_job()
+    _record_wait(job)
+    _emit(job, "processing")
+    source = open_input(input_key) if input_key else nullcontext(raw)
     changes_name = None
+    started = time.perf_counter()
     try:
-        # ---- 分发处理 ----
-        if task_type == "image":
-            processed = _handle_image(raw)
-            ext = "png"
-        elif task_type == "excel":
-            processed = _handle_excel(raw)
-            ext = "xlsx"
-        elif task_type == "excel_to_pdf":
-            processed = _handle_excel_to_pdf(raw)
-            ext = "pdf"
-        elif task_type == "baoguan":
-            processed = _handle_excel_with_baoguan(raw)
-            today_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-            changes_name = f"baoguan_{today_str}.zip"
-            ext = "zip"
-        else:
-            processed = raw
-            ext = ext or "txt"
-
-        # ---- 落盘 ----
-        path: Path = output_path(task_id, ext=ext)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(processed)
-        logger.info("文件已保存: %s (size=%d)", path.resolve(), path.stat().st_size)
+        with source as raw:
+            in_size = len(raw) if raw is not None else -1
+            logger.info(
+                "进入 process_file_task job_id=%s type=%s ext=%s in_size=%s input_key=%s",
+                getattr(job, "id", None), task_type, ext, in_size, input_key
+            )
+
+            # ---- 分发处理 ----
+            if task_type == "image":
+                processed = _handle_image(raw)
+                ext = "png"
+            elif task_type == "excel":
+                processed = _handle_excel(raw)
+                ext = "xlsx"
+            elif task_type == "excel_to_pdf":
+                processed = _handle_excel_to_pdf(raw)
+                ext = "pdf"
+            elif task_type == "baoguan":
+                reporter = progress.Reporter(
+                    job.connection, task_id, lambda step: _emit(job, _stage_of(step)),
+                    stages=stage_timing.StageProgress(job.connection, task_id, task_type, PIPELINE_GROUPS, job=job),
+                    doc_stages=DOCUMENT_STAGES,
+                ) if job else None
+                processed = _handle_excel_with_baoguan(raw, reporter)
+                today_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+                changes_name = f"baoguan_{today_str}.zip"
+                ext = "zip"
+            else:
+                processed = raw
+                ext = ext or "txt"
+
+            # ---- 落盘 ----（透传类任务 processed 可能就是 mmap，必须在映射关闭前写完）
+            _emit(job, "saving")
+            path = save_output(task_id, ext, processed, task_type)
+            logger.info("文件已保存: %s (size=%d)", path, len(processed))
+
+        # 产物已落盘，spool 输入不再需要
+        if input_key:
+            remove_input(input_key)
 
         # ---- 回写元信息 ----
         if job:
@@ -76,7 +132,8 @@ def process_file_task(task_id: str, raw: bytes, task_type: str, ext: str = "txt"
                 job.meta["filename"] = changes_name
             job.save_meta()
 
-        return {"path": str(path), "ext": ext}
+        _record_service(job, task_type, time.perf_counter() - started)
+        return {"path": path, "ext": ext}
 
     except Exception as e:
         # 记录异常 + 简短错误信息回写到 job.meta
@@ -86,4 +143,32 @@ def process_file_task(task_id: str, raw: bytes, task_type: str, ext: str = "txt"
             job.save_meta()
 
         # 方案A（推荐）：重新抛出，让 RQ 标记为 failed，并保留完整 exc_info
-        raise
\ No newline at end of file
+        raise
+
+
+# ---- RQ 回调（在 worker 进程里、任务结束后执行） ----
+def on_job_success(job, connection, result, *args, **kwargs):
+    result_cache.on_job_success(job, connection, result)
+    admission.on_job_done(job, connection)
+    job_events.emit(connection, job.id, "finished", "done", job=job, result=result)
+    webhooks.on_job_success(job, connection, result)
+
+
+def _remove_input_of(job) -> None:
+    """任务最终失败（不会再重试）时删掉 spool 输入；成功时在 process_file_task 里删。"""
+    input_key = job.kwargs.get("input_key")
+    if not input_key or job.retries_left:
+        return
+    try:
+        remove_input(input_key)
+    except Exception as e:
+        logger.warning("删除上传输入失败 (task_id=%s): %s", job.id, e)
+
+
+def on_job_failure(job, connection, *exc_info, **kwargs):
+    _remove_input_of(job)
+    result_cache.on_job_failure(job, connection)
+    admission.on_job_done(job, connection)
+    job_events.emit(connection, job.id, "failed", "failed", job=job,
+                    exc_info="".join(traceback.format_exception(*exc_info)) if len(exc_info) == 3 else None)
+    webhooks.on_job_failure(job, connection)
@@ -4,11 +4,19 @@ from app.app_tasks.baoGuan.c_gen2file import FaPiaoBuilder
 from app.app_tasks.baoGuan.d_gen3file import ZhuangXiangBuilder
 from app.app_tasks.baoGuan.e_gen4file import HeTongBuilder
 from app.app_tasks.baoGuan.f_gen5file import BaoGuanBuilder
+from app.app_tasks.baoGuan.z_manifest import Manifest
+from app.app_tasks.baoGuan import z_styles, z_resources
 import io, zipfile, os, logging
+import re
 import shutil
 import traceback
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from typing import Any, Callable
+
+from app.core.config import get_settings
 
 
 # ---- Logging --------------------------------------------------------
@@ -22,66 +30,264 @@ if not logger.handlers:
 logger.setLevel(logging.INFO)
 
 
-def _handle_excel_with_baoguan(raw: bytes) -> bytes:
+GONGZHANG_PATH = "app/app_tasks/resource/gonzhang.png"
+BAOGUAN_TEMPLATE_PATH = "app/app_tasks/resource/baoguan.xlsx"
+
+
+# ---- 5 个报关资料的构建函数 --------------------------------------------
+# 模块级函数，才能被 ProcessPoolExecutor pickle 到子进程执行
+def _backend(name: str) -> str:
+    return get_settings().BAOGUAN_WRITER_BACKENDS.get(name, "openpyxl")
+
+
+def _build_asn(manifest: Manifest, hetong_no: str) -> bytes:
+    return ExcelASNBuilder(backend=_backend("asn")).detect(manifest)
+
+
+def _build_fapiao(manifest: Manifest, hetong_no: str) -> bytes:
+    return FaPiaoBuilder(backend=_backend("fapiao")).detect(manifest, hetong_no, gongzhang_source=z_resources.stamp_png(GONGZHANG_PATH, 320))
+
+
+def _build_zhuangxiang(manifest: Manifest, hetong_no: str) -> bytes:
+    return ZhuangXiangBuilder(backend=_backend("zhuangxiang")).detect(manifest, hetong_no, gongzhang_source=z_resources.stamp_png(GONGZHANG_PATH, 320))
+
+
+def _build_hetong(manifest: Manifest, hetong_no: str) -> bytes:
+    return HeTongBuilder(backend=_backend("hetong")).detect(manifest, hetong_no, gongzhang_path=z_resources.stamp_png(GONGZHANG_PATH, 300))
+
+
+def _build_baoguan(manifest: Manifest, hetong_no: str) -> bytes:
+    return BaoGuanBuilder(BAOGUAN_TEMPLATE_PATH).detect(manifest)
+
+
+# zip 内文件顺序固定，与构建完成的先后无关
+DOCUMENT_BUILDERS: list[tuple[str, Callable[[Manifest, str], bytes]]] = [
+    ("报关资料1-ASN.xlsx", _build_asn),
+    ("报关资料2-发票.xlsx", _build_fapiao),
+    ("报关资料3-装箱单.xlsx", _build_zhuangxiang),
+    ("报关资料4-合同.xlsx", _build_hetong),
+    ("报关资料5-出口报关单.xlsx", _build_baoguan),
+]
+# 流水线的阶段名（进度 / ETA / 耗时统计按阶段记，见 app.infrastructure.stage_timing）：
+# DOCUMENT_STAGES[i] 对应 DOCUMENT_BUILDERS[i]；5 个构建器是同一组，可以同时运行
+DOCUMENT_STAGES = ["asn", "fapiao", "zhuangxiang", "hetong", "baoguan"]
+PIPELINE_GROUPS = [["parse"], DOCUMENT_STAGES, ["zip"]]
+
+
+def _build_document(index: int, manifest: Manifest, hetong_no: str) -> tuple[bytes, float, dict]:
+    _, func = DOCUMENT_BUILDERS[index]
+    t0 = time.perf_counter()
+    blob = func(manifest, hetong_no)
+    # 样式表大小/保存耗时在构建它的进程里统计，随结果一起带回
+    return blob, time.perf_counter() - t0, z_styles.stats()["last_save"]
+
+
+# ---- 构建进程池 ------------------------------------------------------
+# 每个进程一个，第一次并行构建时创建、之后跨任务复用：每个任务新建进程池的启动开销比并行省下的时间还多。
+# app.worker 在 fork 之后的工作子进程里才会用到它（创建时记下 pid，不沿用 fork 前父进程的池），退出前 shutdown_pool()
+_pool: ProcessPoolExecutor | None = None
+_pool_pid: int | None = None
+
+
+def _batch_workers() -> int:
+    """多合同并行构建的进程数；未配置时把 CPU 核数平分给 WORKER_PROCESSES 个工作子进程（各有一个进程池）。"""
+    settings = get_settings()
+    if settings.BAOGUAN_BATCH_WORKERS:
+        return settings.BAOGUAN_BATCH_WORKERS
+    return max(1, (os.cpu_count() or 1) // max(1, settings.WORKER_PROCESSES))
+
+
+def _pool_size() -> int:
+    """单合同并行（BAOGUAN_PARALLEL 开启时）和多合同并行共用一个池，取两者需要的较大值。"""
+    settings = get_settings()
+    single = min(settings.BAOGUAN_POOL_SIZE, len(DOCUMENT_BUILDERS)) if settings.BAOGUAN_PARALLEL else 1
+    return max(1, single, _batch_workers())
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=_pool_size())
+        _pool_pid = os.getpid()
+        logger.info(f"构建进程池已创建, size={_pool_size()}")
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+def _run_in_pool(tasks: list[tuple[tuple[int, int], int, Manifest, str]], progress=None) -> dict[tuple[int, int], Any]:
     """
-    输入：Excel 原始二进制
-    输出：包含 5 个报关资料 xlsx 的 zip 二进制
+    tasks：[((合同下标, 构建器下标), 构建器下标, manifest, 合同号)]，在共享进程池里并行执行 _build_document。
+    某个构建器失败时取消还没开始的，进程池坏掉（子进程被杀）时丢弃，下次用到时重建。
     """
-    logger.info("进入 _handle_excel_with_baoguan")
-    logger.info(f"原始 Excel 大小: {len(raw)} bytes")
+    pool = _get_pool()
+    futures = {pool.submit(_build_document, idx, manifest, hetong_no): key
+               for key, idx, manifest, hetong_no in tasks}
+    results: dict[tuple[int, int], Any] = {}
+    try:
+        for f in as_completed(futures):
+            results[futures[f]] = f.result()
+            if progress:
+                progress.done(*futures[f], results[futures[f]][1])
+    except BrokenProcessPool:
+        shutdown_pool()
+        raise
+    except BaseException:
+        for f in futures:
+            f.cancel()
+        raise
+    return results
 
-    # 1) 解析 Excel 数据
-    reader = ExcelReader(raw)
-    data_dicts = reader.read_as_dicts()
-    hetong_no = data_dicts[0].get("合同号码", "") if data_dicts else ""
-    logger.info(f"解析完成，共 {len(data_dicts)} 行数据")
-    if data_dicts:
-        preview = {k: data_dicts[0].get(k) for k in list(data_dicts[0].keys())[:5]}
-        logger.info(f"首行预览: {preview}")
-    logger.info(f"合同号码: {hetong_no}")
 
-    # 2) 构建 5 个 xlsx 二进制
+def _parallel_enabled(rows: int, parallel: bool | None, configured: bool) -> bool:
+    """parallel 为 None 时按配置；清单少于 BAOGUAN_PARALLEL_MIN_ROWS 行时串行（传递数据的开销大于并行省下的时间）。"""
+    if parallel is not None:
+        return parallel
+    return configured and rows >= get_settings().BAOGUAN_PARALLEL_MIN_ROWS
+
+
+def _build_documents(manifest: Manifest, hetong_no: str, parallel: bool | None = None,
+                     progress=None, contract_index: int = 0) -> list[tuple[str, bytes]]:
+    """
+    串行或进程池并行构建 5 个 xlsx，按 DOCUMENT_BUILDERS 的固定顺序返回。
+    并行模式下总耗时约等于最慢的那个构建器；Manifest 是列式 DataFrame，传给子进程的序列化开销也小。
+    parallel 为 None 时按 BAOGUAN_PARALLEL 配置，清单行数少时串行。
+    """
+    settings = get_settings()
+    pool_size = min(settings.BAOGUAN_POOL_SIZE, len(DOCUMENT_BUILDERS))
+    parallel = _parallel_enabled(len(manifest), parallel, settings.BAOGUAN_PARALLEL) and pool_size > 1
+
+    results: list[Any] = [None] * len(DOCUMENT_BUILDERS)
+    if parallel:
+        done = _run_in_pool([((contract_index, idx), idx, manifest, hetong_no)
+                             for idx in range(len(DOCUMENT_BUILDERS))], progress)
+        for (_, idx), result in done.items():
+            results[idx] = result
+    else:
+        for idx in range(len(DOCUMENT_BUILDERS)):
+            results[idx] = _build_document(idx, manifest, hetong_no)
+            if progress:
+                progress.done(contract_index, idx, results[idx][1])
+
+    outputs: list[tuple[str, bytes]] = []
+    for (fname, _), (blob, dt, style_stats) in zip(DOCUMENT_BUILDERS, results):
+        logger.info(f"生成 {fname} 完成, 大小 {len(blob)} bytes, 用时 {dt:.2f}s, 样式表 {style_stats}")
+        outputs.append((fname, blob))
+    return outputs
+
+
+def _build_contracts(contracts: list[tuple[str, Manifest]], parallel: bool | None = None,
+                     progress=None) -> list[tuple[str, bytes]]:
+    """
+    多合同：所有 (合同, 报关资料) 组合一起交给共享进程池（BAOGUAN_BATCH_WORKERS 个进程，默认 CPU 核数 / WORKER_PROCESSES），
+    返回 [(合同文件夹/文件名, xlsx)]，按合同出现顺序 + DOCUMENT_BUILDERS 顺序排列。
+    """
+    workers = _batch_workers()
+    rows = sum(len(m) for _, m in contracts)
+    parallel = _parallel_enabled(rows, parallel, workers > 1)
+    results: dict[tuple[int, int], Any] = {}
+
+    if parallel:
+        results = _run_in_pool([((ci, idx), idx, manifest, hetong_no)
+                                for ci, (hetong_no, manifest) in enumerate(contracts)
+                                for idx in range(len(DOCUMENT_BUILDERS))], progress)
+    else:
+        for ci, (hetong_no, manifest) in enumerate(contracts):
+            for idx in range(len(DOCUMENT_BUILDERS)):
+                results[(ci, idx)] = _build_document(idx, manifest, hetong_no)
+                if progress:
+                    progress.done(ci, idx, results[(ci, idx)][1])
+
     outputs: list[tuple[str, bytes]] = []
+    for ci, folder in enumerate(contract_folders([c for c, _ in contracts])):
+        hetong_no = contracts[ci][0]
+        for idx, (fname, _) in enumerate(DOCUMENT_BUILDERS):
+            blob, dt, style_stats = results[(ci, idx)]
+            logger.info(f"[{hetong_no}] 生成 {fname} 完成, 大小 {len(blob)} bytes, 用时 {dt:.2f}s, 样式表 {style_stats}")
+            outputs.append((f"{folder}/{fname}", blob))
+    return outputs
+
+
+def _builder_workers(n_contracts: int, rows: int, parallel: bool | None = None) -> int:
+    """构建阶段同时运行的构建器数（估计 ETA 用），与 _build_documents / _build_contracts 的判断一致。"""
+    settings = get_settings()
+    if n_contracts == 1:
+        pool_size = min(settings.BAOGUAN_POOL_SIZE, len(DOCUMENT_BUILDERS))
+        enabled = _parallel_enabled(rows, parallel, settings.BAOGUAN_PARALLEL)
+        return pool_size if enabled and pool_size > 1 else 1
+    workers = _batch_workers()
+    enabled = _parallel_enabled(rows, parallel, workers > 1)
+    return min(workers, n_contracts * len(DOCUMENT_BUILDERS)) if enabled else 1
+
+
+def contract_folder(hetong_no: str) -> str:
+    """zip 内合同文件夹名：去掉路径分隔符等非法字符，空合同号单独归一类。"""
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", hetong_no).strip(" .")
+    return name or "未填合同号"
+
+
+def contract_folders(contracts: list[str]) -> list[str]:
+    """每个合同的文件夹名；清理后重名的加序号区分。"""
+    out: list[str] = []
+    for ci, hetong_no in enumerate(contracts):
+        folder = contract_folder(hetong_no)
+        out.append(folder if folder not in out else f"{folder}_{ci + 1}")
+    return out
+
+
+def split_contracts(manifest: Manifest) -> list[tuple[str, Manifest]]:
+    """按合同号码拆分（BAOGUAN_SPLIT_CONTRACTS=false 时整张清单按首行合同号当作一个合同）。"""
+    if not get_settings().BAOGUAN_SPLIT_CONTRACTS:
+        return [(str(manifest.first("合同号码", "")), manifest)]
+    return manifest.partition("合同号码")
+
+
+def _read_manifest(raw: bytes) -> Manifest:
+    """解析 Excel 数据（只解析一次，5 个构建器共享同一个 Manifest）"""
+    manifest = ExcelReader(raw).read_manifest()
+    logger.info(f"解析完成，共 {len(manifest)} 行数据")
+    if len(manifest):
+        preview = {k: manifest.first(k) for k in manifest.columns[:5]}
+        logger.info(f"首行预览: {preview}")
+    return manifest
 
-    def _timeit(label: str, func):
-        t0 = time.perf_counter()
-        blob = func()
-        dt = time.perf_counter() - t0
-        logger.info(f"生成 {label} 完成, 大小 {len(blob)} bytes, 用时 {dt:.2f}s")
-        return blob
-
-    # ASN
-    asn_bytes = _timeit("报关资料1-ASN.xlsx",
-                        lambda: ExcelASNBuilder().detect(data_dicts))
-    outputs.append(("报关资料1-ASN.xlsx", asn_bytes))
-
-    # 发票
-    fapiao_bytes = _timeit("报关资料2-发票.xlsx",
-                           lambda: FaPiaoBuilder().detect(
-                               data_dicts, hetong_no,
-                               gongzhang_source="app/app_tasks/resource/gonzhang.png"))
-    outputs.append(("报关资料2-发票.xlsx", fapiao_bytes))
-
-    # 装箱单
-    zhuang_bytes = _timeit("报关资料3-装箱单.xlsx",
-                           lambda: ZhuangXiangBuilder().detect(
-                               data_dicts, hetong_no,
-                               gongzhang_source="app/app_tasks/resource/gonzhang.png"))
-    outputs.append(("报关资料3-装箱单.xlsx", zhuang_bytes))
-
-    # 合同
-    hetong_bytes = _timeit("报关资料4-合同.xlsx",
-                           lambda: HeTongBuilder().detect(
-                               data_dicts, hetong_no,
-                               gongzhang_path="app/app_tasks/resource/gonzhang.png"))
-    outputs.append(("报关资料4-合同.xlsx", hetong_bytes))
-
-    # 出口报关单
-    baoguan_bytes = _timeit("报关资料5-出口报关单.xlsx",
-                            lambda: BaoGuanBuilder("app/app_tasks/resource/baoguan.xlsx").detect(data_dicts))
-    outputs.append(("报关资料5-出口报关单.xlsx", baoguan_bytes))
-
-    # 3) 打包成 zip
+
+def _zip_manifest(manifest: Manifest, parallel: bool | None = None, progress=None) -> bytes:
+    """
+    构建报关资料并打包成 zip 二进制。
+    只有一个合同时 zip 根目录下就是 5 个 xlsx（与以前一致）；多个合同时每个合同一个文件夹。
+    """
+    contracts = split_contracts(manifest)
+    logger.info(f"合同号码: {[c for c, _ in contracts]}")
+    if progress:
+        progress.start([(c, len(m)) for c, m in contracts], len(DOCUMENT_BUILDERS),
+                       workers=_builder_workers(len(contracts), len(manifest), parallel))
+
+    # 1) 构建 xlsx 二进制
+    t0 = time.perf_counter()
+    if len(contracts) == 1:
+        hetong_no, part = contracts[0]
+        outputs = _build_documents(part, hetong_no, parallel, progress)
+    else:
+        outputs = _build_contracts(contracts, parallel, progress)
+    logger.info(f"{len(contracts)} 个合同的报关资料构建完成, 总用时 {time.perf_counter() - t0:.2f}s")
+
+    # 2) 打包成 zip
+    if progress:
+        progress.begin("zip")
+    t0 = time.perf_counter()
+    zip_bytes = _zip_outputs(outputs)
+    if progress:
+        progress.finish("zip", time.perf_counter() - t0, len(manifest))
+    return zip_bytes
+
+
+def _zip_outputs(outputs: list[tuple[str, bytes]]) -> bytes:
     bio = io.BytesIO()
     with zipfile.ZipFile(bio, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
         for fname, blob in outputs:
@@ -93,6 +299,36 @@ def _handle_excel_with_baoguan(raw: bytes) -> bytes:
     return zip_bytes
 
 
+def _handle_excel_with_baoguan(raw: bytes, progress=None) -> bytes:
+    """
+    输入：Excel 原始二进制
+    输出：zip 二进制，每个合同 5 个报关资料 xlsx（多合同时按合同分文件夹）
+    progress：可选的进度上报对象（start / done / begin / finish，见 app.infrastructure.progress.Reporter），
+              按 解析 -> 5 个构建器 -> 打包 上报各阶段进度和耗时
+    """
+    logger.info("进入 _handle_excel_with_baoguan")
+    logger.info(f"原始 Excel 大小: {len(raw)} bytes")
+    if progress:
+        progress.begin("parse")
+    t0 = time.perf_counter()
+    manifest = _read_manifest(raw)
+    if progress:
+        progress.finish("parse", time.perf_counter() - t0, len(manifest))
+    return _zip_manifest(manifest, progress=progress)
+
+
+def build_small_baoguan_zip(raw: bytes, max_rows: int) -> bytes | None:
+    """
+    同步快速通道（API 进程池里执行）：清单不超过 max_rows 行时串行构建并返回 zip，
+    超过时返回 None，由调用方改走队列。
+    """
+    manifest = _read_manifest(raw)
+    if len(manifest) > max_rows:
+        logger.info(f"清单 {len(manifest)} 行，超过同步上限 {max_rows} 行，改走队列")
+        return None
+    return _zip_manifest(manifest, parallel=False)
+
+
 
 if __name__ == '__main__':
     xlsx_path = r'D:\01-code\Erp-system\backend\app\app_tasks\resource\example.xlsx'
@@ -12,7 +12,7 @@ from __future__ import annotations
 import logging
 from functools import lru_cache
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import AnyUrl, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -59,8 +59,141 @@ class Settings(BaseSettings):
 
     # ---- Redis ----
     REDIS_URL: str = "redis://localhost:63889/0"
-    RQ_QUEUE_NAME: str = "default"
+    RQ_QUEUE_NAME: str = "default"   # 兜底队列：RQ_TASK_QUEUES 未列出的任务类型进这里
     OUTPUT_DIR: Path = Path("outputs")
+    # API 进程的异步连接池（redis.asyncio）：连接数上限、取不到连接时等待的秒数、读写 / 建连超时、空闲连接探活间隔
+    REDIS_ASYNC_MAX_CONNECTIONS: int = 50
+    REDIS_ASYNC_POOL_TIMEOUT_S: float = 5
+    REDIS_ASYNC_SOCKET_TIMEOUT_S: float = 5
+    REDIS_ASYNC_CONNECT_TIMEOUT_S: float = 3
+    REDIS_ASYNC_HEALTH_CHECK_S: int = 30
+
+    # ---- Queues（按任务类型分队列，worker 按权重公平取任务） ----
+    # 队列声明：{队列名: {"weight": 权重, "concurrency": 同时执行上限（0 = 不限）}}
+    RQ_QUEUES: Dict[str, Dict[str, int]] = {
+        "heavy": {"weight": 1, "concurrency": 2},
+        "light": {"weight": 4, "concurrency": 0},
+    }
+    # 任务类型 -> 队列名
+    RQ_TASK_QUEUES: Dict[str, str] = {
+        "baoguan": "heavy",
+        "excel_to_pdf": "heavy",
+        "image": "light",
+        "excel": "light",
+        "text": "light",
+    }
+
+    # ---- Inline（上传时带 sync=true，小清单报关资料在 API 旁的进程池里同步生成并直接返回 zip） ----
+    INLINE_ENABLED: bool = True
+    INLINE_MAX_BYTES: int = 256 * 1024      # 上传文件超过该大小直接走队列
+    INLINE_MAX_ROWS: int = 100              # 清单行数超过该值改走队列
+    INLINE_POOL_SIZE: int = 2               # 同时同步处理的任务数上限，满了改走队列
+    INLINE_MAX_TASKS_PER_CHILD: int = 100   # 池内子进程处理满这么多任务后替换（0 = 不限）
+
+    # ---- Admission（上传准入：预计排队时间超过预算、或用户未完成任务过多时返回 429 + Retry-After） ----
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_WAIT_BUDGET_S: float = 300                # 预计排队时间上限（秒）
+    ADMISSION_TASK_BUDGETS_S: Dict[str, float] = {}     # 按任务类型覆盖，例：{"baoguan": 600, "text": 60}
+    ADMISSION_USER_MAX_PENDING: int = 100               # 每个用户排队 + 执行中的任务数上限（0 = 不限）
+    ADMISSION_USER_LIMITS: Dict[str, int] = {}          # 按用户覆盖，例：{"admin": 0}
+    ADMISSION_USER_HEADER: str = "X-User"               # 取用户标识的请求头，缺省时按客户端 IP 计
+    ADMISSION_DEFAULT_SERVICE_S: float = 10             # 某任务类型还没有耗时样本时假定的单任务耗时（秒）
+    ADMISSION_EWMA_ALPHA: float = 0.2                   # 单任务耗时滑动平均里最新样本的权重
+    ADMISSION_PENDING_MAX_AGE: int = 6 * 3600           # 用户名下的任务登记最长保留秒数，防止 worker 崩溃后一直占用名额
+
+    # ---- Upload ----
+    # spool：上传内容分块落盘，任务只携带引用 | inline：整包读入内存随任务一起投递（旧行为）
+    UPLOAD_MODE: str = "spool"
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # 分块落盘的块大小（字节）
+    INPUT_DIR: Optional[Path] = None      # 上传文件落盘目录，未设置时使用 OUTPUT_DIR/_inputs
+
+    # ---- Storage（产物与上传输入存放位置：local = OUTPUT_DIR / INPUT_DIR，s3 = S3 兼容对象存储） ----
+    STORAGE_BACKEND: str = "local"
+    S3_ENDPOINT_URL: Optional[str] = None             # MinIO 等自建服务的地址；AWS S3 留空
+    S3_BUCKET: str = "erp-files"
+    S3_PREFIX: str = ""                               # 所有对象 key 的前缀，多套环境共用一个 bucket 时区分
+    S3_ACCESS_KEY: Optional[str] = None               # 留空时走 boto3 默认凭证链（环境变量 / 实例角色）
+    S3_SECRET_KEY: Optional[str] = None
+    S3_REGION: str = "us-east-1"
+    S3_CREATE_BUCKET: bool = False                    # bucket 不存在时自动创建（本地 MinIO 开发用）
+    S3_MULTIPART_THRESHOLD: int = 16 * 1024 * 1024    # 超过此大小走分片上传（字节）
+    S3_MULTIPART_CHUNKSIZE: int = 8 * 1024 * 1024     # 分片大小（字节，S3 要求至少 5MB）
+    # 产物索引（task_id -> 产物）的数据库，留空用 OUTPUT_DIR/_index.sqlite3；多机部署填 postgresql+psycopg://...
+    OUTPUT_INDEX_URL: Optional[str] = None
+
+    # ---- Download（direct：API 自己发送文件 | x-accel：交给 nginx（X-Accel-Redirect）| x-sendfile：交给 Apache / lighttpd） ----
+    DOWNLOAD_MODE: str = "direct"
+    DOWNLOAD_ACCEL_PREFIX: str = "/_outputs/"   # nginx 里指向 OUTPUT_DIR 的 internal location
+
+    # ---- Batch upload（POST /files/batch：多个文件或一个 zip 作为一个任务组） ----
+    BATCH_MAX_FILES: int = 50         # 单次批量上传的文件数上限（zip 按展开后的文件数计）
+    JOB_GROUP_TTL: int = 24 * 3600    # 任务组记录和组内任务记录的保留秒数
+
+    # ---- Baoguan pipeline ----
+    BAOGUAN_PARALLEL: bool = False   # True 时 5 个报关资料在进程池中并行构建
+    BAOGUAN_POOL_SIZE: int = 5       # 构建进程池大小（<=1 等同串行）
+    BAOGUAN_PARALLEL_MIN_ROWS: int = 500  # 清单少于这么多行时串行构建（进程间传递清单和结果的开销大于并行省下的时间）
+    # 各报关资料的工作簿后端：openpyxl（内存）| streaming（按行写出、内存平稳）
+    # 例：{"asn": "streaming", "fapiao": "streaming"}；未列出的用 openpyxl，出口报关单基于模板只支持 openpyxl
+    BAOGUAN_WRITER_BACKENDS: Dict[str, str] = {}
+    BAOGUAN_SPLIT_CONTRACTS: bool = True   # 清单含多个合同号码时按合同拆分，zip 内每个合同一个文件夹
+    BAOGUAN_BATCH_WORKERS: int = 0         # 多合同时并行构建的进程数（0 = CPU 核数 / WORKER_PROCESSES，1 = 串行）
+    # True：拆成 解析 -> 5 个构建 -> 打包 的 RQ 任务图（depends_on），构建可分散到多台 worker、失败单独重试
+    BAOGUAN_DAG: bool = False
+    BAOGUAN_DAG_RETRIES: int = 2     # 单个构建任务失败后的重试次数
+    BAOGUAN_DAG_TTL: int = 3600      # 中间结果（存储里的 Manifest、各 xlsx，以及 Redis 里对它们的引用）的最长保留秒数
+
+    # ---- Worker（python -m app.worker：预加载后 fork 工作子进程） ----
+    WORKER_PROCESSES: int = 1       # 工作子进程数
+    WORKER_MAX_JOBS: int = 200      # 子进程处理满这么多任务后退出，由主进程重新 fork（0 = 不限）
+    WORKER_MAX_RSS_MB: int = 1024   # 子进程 RSS 超过该值时，处理完当前任务即退出（0 = 不限）
+    WORKER_WARMUP: bool = True      # 启动时用 resource/example.xlsx 跑一遍报关资料，提前触发各处的延迟导入
+    WORKER_SCHEDULING: str = "weighted"  # weighted：按 RQ_QUEUES 权重公平取任务 | ordered：按队列顺序优先（rq 默认）
+
+    # ---- Job events（任务状态推送：/files/{task_id}/events（SSE）、/files/{task_id}/ws） ----
+    JOB_EVENTS_HEARTBEAT_S: int = 15   # 推送连接上多久没有新状态就发一次心跳（同时核对一次任务状态）
+    JOB_EVENTS_FRESH_S: int = 30       # 未结束任务的状态快照在这么多秒内视为最新，超过则重新读取 job 记录
+    JOB_STATUS_BATCH_MAX: int = 200    # POST /files/status:batch 一次最多查询的任务数
+
+    # ---- Stage timing（报关资料各阶段 解析 / 5 个构建器 / 打包 的每行耗时直方图，按 任务类型 + 阶段 滚动统计，用来算进度百分比和 ETA） ----
+    STAGE_TIMING_ENABLED: bool = True
+    STAGE_TIMING_WINDOW_S: int = 3600      # 每个直方图窗口的秒数
+    STAGE_TIMING_WINDOWS: int = 24         # 估计时合并最近多少个窗口（更早的自动过期）
+    STAGE_TIMING_QUANTILE: float = 0.5     # 取每行耗时的哪个分位数来估计
+    STAGE_TIMING_MIN_SAMPLES: int = 3      # 样本少于这个数的阶段不给估计（进度按阶段数平均，不给 ETA）
+
+    # ---- Webhook（上传时带 callback_url，任务结束后 POST 最终状态和下载地址；API 进程里的后台任务负责投递） ----
+    WEBHOOK_ENABLED: bool = True
+    WEBHOOK_PUBLIC_BASE_URL: str = ""          # 回调里下载地址的前缀（对外的 API 根地址，例 https://erp.example.com/api），空则给相对路径
+    WEBHOOK_SECRET: str = ""                   # 非空时对请求体做 HMAC-SHA256 签名，放在 X-Webhook-Signature
+    WEBHOOK_ALLOWED_HOSTS: List[str] = []      # 允许回调的主机名，空 = 不限
+    WEBHOOK_ALLOW_PRIVATE: bool = False        # 允许回调到内网 / 本机 / 链路本地地址（本地联调用）；在允许列表内的主机不查
+    WEBHOOK_TIMEOUT_S: int = 10                # 单次 POST 超时秒数
+    WEBHOOK_MAX_ATTEMPTS: int = 8              # 最多投递次数（含第一次）
+    WEBHOOK_BACKOFF_BASE_S: float = 5          # 重试间隔：BASE * 2^(第几次失败-1)，封顶 MAX，带 ±20% 抖动
+    WEBHOOK_BACKOFF_MAX_S: float = 600
+    WEBHOOK_QUEUE_MAX: int = 10000             # 待投递 / 等待重试的回调上限，满了新回调记为 dropped
+    WEBHOOK_CONCURRENCY: int = 8               # 每个 API 进程同时投递的回调数
+    WEBHOOK_POLL_S: float = 1                  # 没有到期回调时的轮询间隔
+    WEBHOOK_TTL_S: int = 24 * 3600             # 回调登记和投递记录的保留秒数
+
+    # ---- Retention（产物文件、RQ 任务记录的保留期；API 进程里的后台清理定期删除过期的部分） ----
+    RETENTION_ENABLED: bool = True
+    RETENTION_OUTPUT_TTL_S: int = 7 * 24 * 3600     # 产物文件保留秒数（0 = 不清理）
+    RETENTION_RESULT_TTL_S: int = 7 * 24 * 3600     # 成功任务的 job 记录保留秒数（RQ result_ttl，0 = 永久）
+    RETENTION_FAILURE_TTL_S: int = 3 * 24 * 3600    # 失败任务的 job 记录保留秒数（RQ failure_ttl，0 = 永久）
+    # 按任务类型覆盖，例：{"text": {"output": 86400, "result": 86400}}，未列出的项用上面的默认值
+    RETENTION_TASK_TTLS_S: Dict[str, Dict[str, int]] = {}
+    RETENTION_SWEEP_INTERVAL_S: int = 600           # 两次清理之间的间隔秒数
+    RETENTION_BATCH_SIZE: int = 500                 # 每批删除 / 扫描的条目数，批与批之间让出执行
+    RETENTION_ORPHAN_GRACE_S: int = 3600            # 找不到对应任务记录的输入文件 / 合并包，超过该时长才删除
+
+    # ---- Result cache（相同输入 + 任务类型 + 模板版本 直接复用已有产物） ----
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_TASK_TYPES: List[str] = ["baoguan"]        # 只缓存输出确定的任务类型
+    RESULT_CACHE_TTL: int = 24 * 3600                       # 缓存条目存活秒数（同时作为任务 result_ttl）
+    RESULT_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024    # 缓存引用的产物总大小上限，超出按 LRU 淘汰
+    RESULT_CACHE_INFLIGHT_TTL: int = 3600                   # in-flight 标记最长存活秒数，防止 worker 崩溃后一直占用
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -81,7 +214,9 @@ class Settings(BaseSettings):
             raise ValueError("DATABASE_URL_YIBU is not set (expected postgresql+asyncpg://...)")
         return str(self.DATABASE_URL_YIBU)
 
-    
+    @property
+    def input_dir(self) -> Path:
+        return Path(self.INPUT_DIR) if self.INPUT_DIR else Path(self.OUTPUT_DIR) / "_inputs"
 
     @field_validator("ENV")
     @classmethod
@@ -91,6 +226,47 @@ class Settings(BaseSettings):
             raise ValueError("ENV must be one of: dev | staging | prod")
         return v
 
+    @field_validator("WORKER_SCHEDULING")
+    @classmethod
+    def _normalize_worker_scheduling(cls, v: str) -> str:
+        v = v.lower()
+        if v not in {"weighted", "ordered"}:
+            raise ValueError("WORKER_SCHEDULING must be one of: weighted | ordered")
+        return v
+
+    @field_validator("UPLOAD_MODE")
+    @classmethod
+    def _normalize_upload_mode(cls, v: str) -> str:
+        v = v.lower()
+        if v not in {"spool", "inline"}:
+            raise ValueError("UPLOAD_MODE must be one of: spool | inline")
+        return v
+
+    @field_validator("STORAGE_BACKEND")
+    @classmethod
+    def _normalize_storage_backend(cls, v: str) -> str:
+        v = v.lower()
+        if v not in {"local", "s3"}:
+            raise ValueError("STORAGE_BACKEND must be one of: local | s3")
+        return v
+
+    @field_validator("DOWNLOAD_MODE")
+    @classmethod
+    def _normalize_download_mode(cls, v: str) -> str:
+        v = v.lower()
+        if v not in {"direct", "x-accel", "x-sendfile"}:
+            raise ValueError("DOWNLOAD_MODE must be one of: direct | x-accel | x-sendfile")
+        return v
+
+    @field_validator("RETENTION_TASK_TTLS_S")
+    @classmethod
+    def _check_retention_ttls(cls, v: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+        for task_type, ttls in v.items():
+            unknown = set(ttls) - {"output", "result", "failure"}
+            if unknown:
+                raise ValueError(f"RETENTION_TASK_TTLS_S[{task_type}] has unknown keys: {sorted(unknown)} (expected output | result | failure)")
+        return v
+
     def cors_params(self) -> dict:
         return {
             "allow_origins": self.ALLOWED_ORIGINS,
@@ -108,6 +284,7 @@ def get_settings() -> Settings:
     """
     settings = Settings()
     Path(settings.OUTPUT_DIR).mkdir(parents=True, exist_ok=True)
+    settings.input_dir.mkdir(parents=True, exist_ok=True)
     return settings
 
 
@@ -0,0 +1,134 @@
+"""
+上传准入控制：预计排队时间超过预算、或用户未完成的任务过多时，上传接口直接返回 429 + Retry-After。
+
+- 预计排队时间 = (队列积压 + 执行中任务数 / 2) × 该任务类型的单任务耗时估计 / 队列并行度
+  - 单任务耗时：最近若干次执行耗时的指数滑动平均（worker 每次成功后记录，见 queues.record_service）
+  - 并行度：监听该队列的 worker 数，再受 RQ_QUEUES 的 concurrency 上限约束，至少按 1 计
+- 预算：ADMISSION_WAIT_BUDGET_S，可按任务类型覆盖（ADMISSION_TASK_BUDGETS_S）
+- 用户并发：admission:pending:<user>（zset，task_id -> 投递时间），投递后登记，任务结束的回调里移除；
+  超过 ADMISSION_PENDING_MAX_AGE 的登记视为 worker 崩溃遗留，检查时顺带清掉
+- Retry-After：超出预算的部分按队列每秒消化 1 秒预计等待折算；用户超限按该类型单任务耗时估计
+"""
+from __future__ import annotations
+
+import logging
+import math
+import time
+from dataclasses import dataclass
+
+from redis import Redis
+from rq import Queue, Worker
+
+from app.core.config import get_settings
+from app.infrastructure import queues
+
+logger = logging.getLogger("infrastructure.admission")
+settings = get_settings()
+
+_PREFIX = "admission"
+
+
+def _pending_key(user: str) -> str:
+    return f"{_PREFIX}:pending:{user}"
+
+
+@dataclass
+class Decision:
+    admitted: bool
+    retry_after: int = 0            # 秒，admitted=False 时有意义
+    reason: str = ""
+    projected_wait: float = 0.0     # 预计排队秒数
+    service_estimate: float = 0.0   # 该任务类型的单任务耗时估计
+
+
+def budget_for(task_type: str) -> float:
+    return float(settings.ADMISSION_TASK_BUDGETS_S.get(task_type, settings.ADMISSION_WAIT_BUDGET_S))
+
+
+def user_limit(user: str) -> int:
+    """用户未完成任务数上限，0 表示不限。"""
+    return max(0, int(settings.ADMISSION_USER_LIMITS.get(user, settings.ADMISSION_USER_MAX_PENDING)))
+
+
+def service_estimate(conn: Redis, task_type: str) -> float:
+    return queues.service_estimate(
+        conn, task_type, settings.ADMISSION_EWMA_ALPHA, settings.ADMISSION_DEFAULT_SERVICE_S
+    )
+
+
+def projected_wait(conn: Redis, task_type: str) -> tuple[float, float]:
+    """返回 (预计排队秒数, 单任务耗时估计)。"""
+    name = queues.queue_name_for(task_type)
+    q = Queue(name, connection=conn)
+    pipe = conn.pipeline()
+    pipe.llen(q.key)
+    pipe.zcard(q.started_job_registry.key)
+    depth, running = pipe.execute()
+
+    workers = Worker.count(connection=conn, queue=q) or 1  # worker 重启期间按 1 个估计，不直接拒绝
+    limit = queues.concurrency_of(name)
+    parallel = max(1, min(workers, limit) if limit else workers)
+
+    est = service_estimate(conn, task_type)
+    return (depth + running / 2) * est / parallel, est
+
+
+def pending_count(conn: Redis, user: str) -> int:
+    key = _pending_key(user)
+    pipe = conn.pipeline()
+    pipe.zremrangebyscore(key, 0, time.time() - settings.ADMISSION_PENDING_MAX_AGE)
+    pipe.zcard(key)
+    return pipe.execute()[1]
+
+
+def check(conn: Redis, task_type: str, user: str, count: int = 1) -> Decision:
+    """count：本次要投递的任务数（批量上传时一次判断整批）。"""
+    if not settings.ADMISSION_ENABLED:
+        return Decision(True)
+
+    wait, est = projected_wait(conn, task_type)
+
+    limit = user_limit(user)
+    if limit:
+        pending = pending_count(conn, user)
+        if pending + count > limit:
+            return Decision(
+                False,
+                retry_after=max(1, math.ceil(est)),
+                reason=f"未完成的任务将超过上限（已有 {pending}，本次 {count}，上限 {limit}），请等已有任务完成后再上传",
+                projected_wait=wait,
+                service_estimate=est,
+            )
+
+    budget = budget_for(task_type)
+    if wait > budget:
+        return Decision(
+            False,
+            retry_after=max(1, math.ceil(wait - budget)),
+            reason=f"队列繁忙，预计排队 {wait:.0f}s，超过上限 {budget:.0f}s",
+            projected_wait=wait,
+            service_estimate=est,
+        )
+    return Decision(True, projected_wait=wait, service_estimate=est)
+
+
+# ---------- 用户未完成任务登记 ----------
+def track(conn: Redis, user: str, task_id: str, pipeline=None) -> None:
+    """任务投递成功后登记到用户名下；传入 pipeline 时只把命令加进去，由调用方执行。"""
+    key = _pending_key(user)
+    pipe = pipeline if pipeline is not None else conn.pipeline()
+    pipe.zadd(key, {task_id: time.time()})
+    pipe.expire(key, settings.ADMISSION_PENDING_MAX_AGE)
+    if pipeline is None:
+        pipe.execute()
+
+
+def release(conn: Redis, user: str, task_id: str) -> None:
+    conn.zrem(_pending_key(user), task_id)
+
+
+def on_job_done(job, connection: Redis) -> None:
+    """任务成功或失败的回调里调用：从用户名下移除。"""
+    user = job.meta.get("user")
+    if user:
+        release(connection, user, job.id)
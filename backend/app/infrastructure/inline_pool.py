@@ -0,0 +1,88 @@
+"""
+小清单报关资料的同步快速通道：在 API 进程旁的一个小进程池里直接构建，不经过 Redis / worker / 磁盘。
+
+- 池用 spawn 方式启动（API 进程里已有事件循环和线程，不宜 fork），第一次使用时才创建，
+  子进程启动时预热模板和公章缓存；每个子进程处理 INLINE_MAX_TASKS_PER_CHILD 个任务后替换，限制内存增长
+- 有界：同时执行的任务数达到 INLINE_POOL_SIZE 时不排队等待，调用方直接改走 RQ 队列
+- 清单行数超过 INLINE_MAX_ROWS 时子进程返回 None，调用方同样改走队列
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from app.core.config import get_settings
+
+logger = logging.getLogger("infrastructure.inline_pool")
+settings = get_settings()
+
+_pool: ProcessPoolExecutor | None = None
+_running = 0
+
+
+def _warm() -> None:
+    from app.app_tasks import process_BaoGuan as pb
+    from app.app_tasks.baoGuan import z_resources
+
+    z_resources.template_workbook(pb.BAOGUAN_TEMPLATE_PATH)
+    z_resources.stamp_png(pb.GONGZHANG_PATH, 320)
+    z_resources.stamp_png(pb.GONGZHANG_PATH, 300)
+
+
+def _build(raw: bytes, max_rows: int) -> bytes | None:
+    from app.app_tasks.process_BaoGuan import build_small_baoguan_zip
+
+    return build_small_baoguan_zip(raw, max_rows)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=max(1, settings.INLINE_POOL_SIZE),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm,
+            max_tasks_per_child=settings.INLINE_MAX_TASKS_PER_CHILD or None,
+        )
+        logger.info(f"同步快速通道进程池已创建, size={settings.INLINE_POOL_SIZE}")
+    return _pool
+
+
+def accepts(task_type: str, size: int | None) -> bool:
+    """是否值得尝试同步处理（大小未知时由调用方读入后再判断）。"""
+    if not settings.INLINE_ENABLED or task_type != "baoguan":
+        return False
+    return size is None or size <= settings.INLINE_MAX_BYTES
+
+
+async def run_baoguan(raw: bytes) -> bytes | None:
+    """
+    在进程池里构建报关资料 zip。返回 None 表示没有同步处理（池已满 / 清单行数超限 / 池异常），应改走队列；
+    构建本身的异常原样抛出。
+    """
+    global _running, _pool
+    if _running >= max(1, settings.INLINE_POOL_SIZE):
+        logger.info("同步快速通道已满，改走队列")
+        return None
+    _running += 1
+    try:
+        future = _get_pool().submit(_build, raw, settings.INLINE_MAX_ROWS)
+        return await asyncio.wrap_future(future)
+    except BrokenProcessPool:
+        logger.exception("同步快速通道进程池异常，重建后本次改走队列")
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        return None
+    finally:
+        _running -= 1
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
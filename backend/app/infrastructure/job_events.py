@@ -0,0 +1,314 @@
+"""
+任务状态事件：API 和 worker 在任务的各个阶段发布状态快照，/files/{task_id}/events（SSE）、/files/{task_id}/ws 推给前端，
+/files/{task_id}/status 也直接读快照。
+
+- job_events:<task_id>：pub/sub 频道，每条消息是一份完整快照（JSON），结构与 /status 的响应相同，另有 stage、ts
+- job_events:<task_id>:last：最新快照；结束后的 TTL 与 job 记录一致
+- stage：queued -> processing / parsing -> building -> packing / saving -> done | failed
+- step / percent / eta_s：报关资料流水线的细分阶段（parse、5 个构建器、zip）、完成百分比、相对 ts 的预计剩余秒数，
+  取自 job.meta["stage_progress"]（见 stage_timing）；其他任务类型为 None，完成后 percent 为 100
+快照在 JOB_EVENTS_FRESH_S 内、或者已经是结束状态时直接使用；过旧的（例如 worker 崩溃没能发出 failed）
+改为读一次 job 记录重建并重新发布，订阅者不会一直挂着。
+
+API 进程里只有一个订阅连接（psubscribe job_events:*，见 _Hub），按 task_id 分发给本进程的 SSE / WebSocket 客户端，
+连接数不随在线客户端增长。发布失败只记日志，不影响任务本身。
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import WatchError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from app.core.config import get_settings
+from app.infrastructure import progress
+
+logger = logging.getLogger("infrastructure.job_events")
+settings = get_settings()
+
+_PREFIX = "job_events"
+EVENTS_TTL = 24 * 3600  # 未结束任务的快照保留秒数
+TERMINAL = {"finished", "failed", "stopped", "canceled"}
+_META_FIELDS = ("task_type", "output_ext", "expect_ext", "filename", "content_type")
+# 从 job 记录重建快照时，按 RQ 状态推断阶段
+_STAGE_OF = {"queued": "queued", "deferred": "queued", "scheduled": "queued", "started": "processing",
+             "finished": "done", "failed": "failed", "stopped": "failed", "canceled": "failed"}
+
+
+def channel(task_id: str) -> str:
+    return f"{_PREFIX}:{task_id}"
+
+
+def _last_key(task_id: str) -> str:
+    return f"{_PREFIX}:{task_id}:last"
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+# ---------- 快照 ----------
+def snapshot(conn: Redis, job: Job, status: str, stage: str, result: Any = None, exc_info: str | None = None) -> dict:
+    return _build(job, status, stage, result, exc_info, progress.read(conn, job.id))
+
+
+def _build(job: Job, status: str, stage: str, result: Any, exc_info: str | None, rows: list | None) -> dict:
+    steps = job.meta.get("stage_progress") or {}
+    finished = status == "finished"
+    return {
+        "task_id": job.id,
+        "status": status,
+        "stage": stage,
+        "result": result,
+        "exc_info": exc_info,
+        "meta": {k: job.meta.get(k) for k in _META_FIELDS},
+        # 报关资料按合同的生成进度：[{contract, rows, done, total}]，其他任务类型为 None
+        "progress": rows,
+        "step": steps.get("stage"),
+        "percent": 100.0 if finished else steps.get("percent"),
+        "eta_s": 0.0 if finished else steps.get("eta_s"),
+        "ts": time.time(),
+    }
+
+
+def snapshot_of(conn: Redis, task_id: str) -> dict | None:
+    """从 job 记录重建快照；任务不存在返回 None。"""
+    try:
+        job = Job.fetch(task_id, connection=conn)
+    except NoSuchJobError:
+        return None
+    return _rebuild(job, progress.read(conn, job.id))
+
+
+def _rebuild(job: Job, rows: list | None) -> dict:
+    status = _s(job.get_status(refresh=False).value)
+    return _build(
+        job, status, _STAGE_OF.get(status, status),
+        result=job.return_value() if status == "finished" else None,
+        exc_info=job.exc_info if status == "failed" else None,
+        rows=rows,
+    )
+
+
+def _ttl_for(job: Job | None, status: str) -> int | None:
+    """结束后与 job 记录同时过期；-1（永久）返回 None。"""
+    if status not in TERMINAL or job is None:
+        return EVENTS_TTL
+    ttl = job.result_ttl if status == "finished" else job.failure_ttl
+    if ttl is None:
+        return EVENTS_TTL
+    return None if ttl < 0 else max(1, int(ttl))
+
+
+def queued(job: Job) -> dict:
+    """刚投递的任务的快照（不读 Redis，可以和入队放在同一个事务里写）。"""
+    status = _s(job.get_status(refresh=False).value)
+    return _build(job, status, "queued", None, None, None)
+
+
+def publish(conn: Redis, payload: dict, job: Job | None = None, pipeline=None) -> None:
+    """
+    写最新快照并发布。中间状态不覆盖已经是结束状态的快照（例如 API 的 queued 晚于快速完成的 worker 写入）。
+    传入 pipeline 时只把命令加进去，由调用方保证先后（例如与入队在同一个事务里）。
+    """
+    data = json.dumps(payload, ensure_ascii=False, default=str)
+    key = _last_key(payload["task_id"])
+    if pipeline is not None:
+        pipeline.set(key, data, ex=_ttl_for(job, payload["status"]))
+        pipeline.publish(channel(payload["task_id"]), data)
+        return
+    with conn.pipeline() as pipe:
+        while True:
+            try:
+                if payload["status"] not in TERMINAL:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    if raw and json.loads(raw)["status"] in TERMINAL:
+                        return
+                    pipe.multi()
+                pipe.set(key, data, ex=_ttl_for(job, payload["status"]))
+                pipe.publish(channel(payload["task_id"]), data)
+                pipe.execute()
+                return
+            except WatchError:
+                continue
+
+
+def emit(conn: Redis, task_id: str, status: str, stage: str, job: Job | None = None,
+         result: Any = None, exc_info: str | None = None) -> None:
+    """
+    发布一条状态。job：task_id 对应的 job（已在手上时传入，省一次读取）；
+    任务图的解析 / 构建阶段不是这个 job，传 None 由这里按 task_id 读取。
+    """
+    try:
+        if job is None:
+            job = Job.fetch(task_id, connection=conn)
+        publish(conn, snapshot(conn, job, status, stage, result, exc_info), job)
+    except Exception as e:
+        logger.warning("发布任务状态失败 (task_id=%s, stage=%s): %s", task_id, stage, e)
+
+
+def _fresh(snap: dict) -> bool:
+    return snap["status"] in TERMINAL or time.time() - snap.get("ts", 0) < settings.JOB_EVENTS_FRESH_S
+
+
+def current(conn: Redis, task_id: str) -> dict | None:
+    """当前状态：新鲜的快照直接返回，否则从 job 记录重建并重新发布；任务不存在返回 None。"""
+    raw = conn.get(_last_key(task_id))
+    if raw:
+        snap = json.loads(raw)
+        if _fresh(snap):
+            return snap
+    snap = snapshot_of(conn, task_id)
+    if snap is not None:
+        try:
+            publish(conn, snap)
+        except Exception as e:
+            logger.warning("发布任务状态失败 (task_id=%s): %s", task_id, e)
+    return snap
+
+
+def current_many(conn: Redis, task_ids: list[str]) -> dict[str, dict | None]:
+    """
+    批量版的 current：一次 MGET 取全部快照；过旧 / 缺失的用一次 fetch_many 和一次进度 pipeline 重建（不重新发布）。
+    不存在的任务为 None。
+    """
+    out, stale = _split(task_ids, conn.mget([_last_key(t) for t in task_ids]))
+    if stale:
+        out.update(_rebuild_many(conn, stale))
+    return out
+
+
+def _split(task_ids: list[str], raws: list) -> tuple[dict[str, dict | None], list[str]]:
+    """MGET 的结果分成 (新鲜的快照, 需要从 job 记录重建的 task_id)。"""
+    out: dict[str, dict | None] = {}
+    stale: list[str] = []
+    for task_id, raw in zip(task_ids, raws):
+        snap = json.loads(raw) if raw else None
+        if snap is not None and _fresh(snap):
+            out[task_id] = snap
+        else:
+            stale.append(task_id)
+    return out, stale
+
+
+def _rebuild_many(conn: Redis, task_ids: list[str]) -> dict[str, dict | None]:
+    jobs = dict(zip(task_ids, Job.fetch_many(task_ids, connection=conn)))
+    rows = progress.read_many(conn, [t for t, j in jobs.items() if j is not None])
+    return {t: _rebuild(j, rows[t]) if j is not None else None for t, j in jobs.items()}
+
+
+# ---------- API 端：异步读取 ----------
+# 快照在 redis.asyncio 上读；只有过旧 / 缺失、要用 RQ（同步客户端）读 job 记录重建时才进线程。
+async def current_async(aconn: AsyncRedis, conn: Redis, task_id: str) -> dict | None:
+    raw = await aconn.get(_last_key(task_id))
+    if raw:
+        snap = json.loads(raw)
+        if _fresh(snap):
+            return snap
+    return await asyncio.to_thread(current, conn, task_id)
+
+
+async def current_many_async(aconn: AsyncRedis, conn: Redis, task_ids: list[str]) -> dict[str, dict | None]:
+    out, stale = _split(task_ids, await aconn.mget([_last_key(t) for t in task_ids]))
+    if stale:
+        out.update(await asyncio.to_thread(_rebuild_many, conn, stale))
+    return out
+
+
+# ---------- API 端：订阅 ----------
+class _Hub:
+    """本进程唯一的订阅连接，按 task_id 把消息分发给各个客户端的队列。"""
+
+    def __init__(self):
+        self.subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self.task: asyncio.Task | None = None
+        self.ready = asyncio.Event()
+
+    async def _run(self) -> None:
+        from app.infrastructure.redis_client import async_pubsub_conn
+
+        while True:
+            pubsub = async_pubsub_conn.pubsub()
+            try:
+                await pubsub.psubscribe(f"{_PREFIX}:*")
+                self.ready.set()
+                async for msg in pubsub.listen():
+                    if msg["type"] != "pmessage":
+                        continue
+                    task_id = _s(msg["channel"]).split(":", 1)[1]
+                    for q in self.subscribers.get(task_id, ()):
+                        if q.full():
+                            q.get_nowait()  # 客户端跟不上时丢掉最旧的一条，快照是全量的，只看最新即可
+                        q.put_nowait(json.loads(msg["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("任务状态订阅断开，1 秒后重连: %s", e)
+                self.ready.clear()
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+
+    @asynccontextmanager
+    async def subscribe(self, task_id: str) -> AsyncIterator[asyncio.Queue]:
+        if self.task is None or self.task.done():
+            self.ready = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        await self.ready.wait()
+        q: asyncio.Queue = asyncio.Queue(maxsize=16)
+        self.subscribers[task_id].add(q)
+        try:
+            yield q
+        finally:
+            self.subscribers[task_id].discard(q)
+            if not self.subscribers[task_id]:
+                del self.subscribers[task_id]
+
+
+_hub: _Hub | None = None
+
+
+async def stream(aconn: AsyncRedis, conn: Redis, task_id: str) -> AsyncIterator[dict | None]:
+    """
+    逐条给出状态快照，到结束状态为止；每 JOB_EVENTS_HEARTBEAT_S 没有新消息给出一个 None（心跳）。
+    先订阅再读当前状态，两者之间发布的消息不会丢。conn 是同步连接，只在需要重建快照时在线程里用。
+    """
+    global _hub
+    if _hub is None:
+        _hub = _Hub()
+    async with _hub.subscribe(task_id) as q:
+        snap = await current_async(aconn, conn, task_id)
+        if snap is None:
+            return
+        yield snap
+        while snap["status"] not in TERMINAL:
+            try:
+                msg = await asyncio.wait_for(q.get(), timeout=settings.JOB_EVENTS_HEARTBEAT_S)
+                if msg.get("ts", 0) <= snap.get("ts", 0):
+                    continue  # 已经给出过的快照（例如 current() 自己重新发布的那份）
+                snap = msg
+            except asyncio.TimeoutError:
+                # 长时间没有消息：确认一次任务还活着（worker 崩溃时由这里发现并推送 failed）
+                latest = await current_async(aconn, conn, task_id)
+                if latest is None:
+                    return
+                if latest["status"] != snap["status"] or latest["stage"] != snap["stage"]:
+                    snap = latest
+                    yield snap
+                else:
+                    yield None
+                continue
+            yield snap
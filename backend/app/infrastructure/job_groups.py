@@ -0,0 +1,182 @@
+"""
+批量上传的任务组：一次请求里的多个文件（或一个 zip 里的多个文件）共用一个 group_id。
+
+- job_group:<gid>：{task_type, user, total, created}
+- job_group:<gid>:items：每个文件一项 {task_id, filename, name, error}（JSON list，name 是合并包里的目录/文件名）
+- 合并包不落盘：各任务的产物照常单独保存，下载时（stream_zip）按上传顺序把已完成的条目边读边写成 zip 流出去，
+  不需要加锁，也不会留下写了一半的合并包；命中结果缓存等途径完成的条目同样包含在内
+产物本身是 zip 的（报关资料）展开到 name/ 目录下，其余以 name + 扩展名放在根目录。
+"""
+from __future__ import annotations
+
+import json
+import time
+import zipfile
+from collections import Counter
+from pathlib import Path
+from typing import Any, Iterator
+
+from redis import Redis
+from rq.job import Job, JobStatus
+
+from app.core.config import get_settings
+from app.infrastructure import storage
+
+settings = get_settings()
+
+_PREFIX = "job_group"
+_STORED_SUFFIXES = {".xlsx", ".zip", ".png", ".jpg", ".jpeg", ".pdf"}  # 本身已压缩，合并包里不再压一遍
+_CHUNK = 1 << 20
+
+
+def _key(group_id: str, part: str | None = None) -> str:
+    return f"{_PREFIX}:{group_id}:{part}" if part else f"{_PREFIX}:{group_id}"
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+def group_key(group_id: str) -> str:
+    return _key(group_id)
+
+
+def entry_name(filename: str, used: set[str]) -> str:
+    """合并包里每个文件的名字：原文件名去掉扩展名，重名时加序号。"""
+    stem = Path(filename or "file").stem.strip() or "file"
+    name, n = stem, 1
+    while name in used:
+        n += 1
+        name = f"{stem}_{n}"
+    used.add(name)
+    return name
+
+
+def create(conn: Redis, group_id: str, task_type: str, user: str, items: list[dict]) -> None:
+    pipe = conn.pipeline()
+    pipe.hset(_key(group_id), mapping={
+        "task_type": task_type, "user": user, "total": len(items), "created": time.time(),
+    })
+    pipe.set(_key(group_id, "items"), json.dumps(items, ensure_ascii=False))
+    for k in (_key(group_id), _key(group_id, "items")):
+        pipe.expire(k, settings.JOB_GROUP_TTL)
+    pipe.execute()
+
+
+def items_of(conn: Redis, group_id: str) -> list[dict] | None:
+    raw = conn.get(_key(group_id, "items"))
+    return json.loads(raw) if raw else None
+
+
+def _output_of(job: Job) -> str | None:
+    result = job.return_value()
+    if isinstance(result, dict) and result.get("path"):
+        return result["path"]
+    rec = storage.find_output(job.id)
+    return rec.ref if rec else None
+
+
+def ready_items(conn: Redis, group_id: str) -> list[tuple[str, str]] | None:
+    """已完成且产物还在的条目 [(合并包里的名字, 产物 ref)]，按上传顺序；组不存在（或已过期）时返回 None。"""
+    items = items_of(conn, group_id)
+    if items is None:
+        return None
+    todo = [it for it in items if it.get("task_id")]
+    jobs = Job.fetch_many([it["task_id"] for it in todo], connection=conn)
+    out = []
+    for it, job in zip(todo, jobs):
+        if job is None or job.get_status(refresh=False) != JobStatus.FINISHED:
+            continue
+        ref = _output_of(job)
+        if ref and storage.exists(ref):
+            out.append((it["name"], ref))
+    return out
+
+
+class _Sink:
+    """zipfile 的输出端（不可 seek，zipfile 会改用数据描述符），写入的字节由 stream_zip 分段取走。"""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _member(name: str, size: int) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.file_size = size  # 事先给出大小，超过 4GB 的条目才会按 zip64 写
+    info.compress_type = zipfile.ZIP_STORED if Path(name).suffix.lower() in _STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+    return info
+
+
+def stream_zip(entries: list[tuple[str, str]]) -> Iterator[bytes]:
+    """把 ready_items 给出的条目边读边写成一个 zip，逐段产出；内存里只有当前这一段。"""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w") as zf:
+        for name, ref in entries:
+            if Path(ref).suffix.lower() == ".zip":
+                with storage.local_copy(ref) as path, zipfile.ZipFile(path) as inner:
+                    for info in inner.infolist():
+                        if info.is_dir():
+                            continue
+                        with inner.open(info) as src, zf.open(_member(f"{name}/{info.filename}", info.file_size), "w") as dst:
+                            for chunk in iter(lambda: src.read(_CHUNK), b""):
+                                dst.write(chunk)
+                                yield sink.take()
+            else:
+                with zf.open(_member(f"{name}{Path(ref).suffix}", storage.size(ref) or 0), "w") as dst:
+                    for chunk in storage.iter_bytes(ref):
+                        dst.write(chunk)
+                        yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def summary(conn: Redis, group_id: str) -> dict | None:
+    """组内每个文件的状态和汇总计数；组不存在（或已过期）时返回 None。"""
+    items = items_of(conn, group_id)
+    if items is None:
+        return None
+    ids = [it.get("task_id") for it in items]
+    jobs = dict(zip(
+        [i for i in ids if i],
+        Job.fetch_many([i for i in ids if i], connection=conn),
+    ))
+    rows = []
+    for it in items:
+        job = jobs.get(it.get("task_id"))
+        if it.get("error"):
+            status = "rejected"
+        elif job is None:
+            status = "expired"
+        else:
+            status = _s(job.get_status(refresh=False).value)
+        rows.append({
+            "task_id": it.get("task_id"),
+            "filename": it["filename"],
+            "status": status,
+            "error": it.get("error") or (job.meta.get("error_message") if job is not None and status == "failed" else None),
+        })
+
+    counts = Counter(r["status"] for r in rows)
+    terminal = {"finished", "failed", "rejected", "expired", "stopped", "canceled"}
+    done = sum(n for s, n in counts.items() if s in terminal)
+    return {
+        "group_id": group_id,
+        "total": len(rows),
+        "done": done,
+        "complete": done == len(rows),
+        "counts": dict(counts),
+        "items": rows,
+    }
+
@@ -0,0 +1,131 @@
+"""
+产物索引：task_id -> 产物 ref / 大小 / 扩展名 / sha256 / 任务类型 / 创建时间。
+
+worker 落盘（storage.save_output）时写入一行，下载、合并包按 task_id 主键直接查，不再扫描产物目录。
+OUTPUT_INDEX_URL 留空时使用 OUTPUT_DIR/_index.sqlite3（API 和 worker 共享 OUTPUT_DIR 的单机部署）；
+API 和 worker 不共享磁盘（例如 STORAGE_BACKEND=s3）时指向 Postgres（postgresql+psycopg://...）。
+表在首次使用时自动创建。
+"""
+from __future__ import annotations
+
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Engine, MetaData, String, Table, Text,
+    create_engine, delete, event, insert, select,
+)
+
+from app.core.config import get_settings
+
+logger = logging.getLogger("infrastructure.output_index")
+settings = get_settings()
+
+metadata = MetaData()
+
+task_outputs = Table(
+    "task_outputs",
+    metadata,
+    Column("task_id", String(64), primary_key=True),
+    Column("ref", Text, nullable=False),               # storage 的产物引用：本地路径或 s3://bucket/key
+    Column("size", BigInteger, nullable=False),
+    Column("ext", String(16), nullable=False),
+    Column("sha256", String(64), nullable=False),
+    Column("task_type", String(32)),
+    Column("created_at", DateTime(timezone=True), nullable=False, index=True),
+)
+
+
+@dataclass
+class OutputRecord:
+    task_id: str
+    ref: str
+    size: int
+    ext: str
+    sha256: str
+    task_type: str | None
+    created_at: datetime
+
+
+def _url() -> str:
+    if settings.OUTPUT_INDEX_URL:
+        return settings.OUTPUT_INDEX_URL
+    return f"sqlite:///{Path(settings.OUTPUT_DIR).resolve() / '_index.sqlite3'}"
+
+
+@lru_cache(maxsize=1)
+def _engine() -> Engine:
+    url = _url()
+    if url.startswith("sqlite"):
+        engine = create_engine(url, connect_args={"check_same_thread": False, "timeout": 10})
+
+        @event.listens_for(engine, "connect")
+        def _pragmas(dbapi_conn, _):
+            # WAL：API 读、worker 写互不阻塞；多个 worker 子进程写入时排队等锁
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.close()
+    else:
+        engine = create_engine(url, pool_pre_ping=True, pool_size=2, max_overflow=4)
+    metadata.create_all(engine, checkfirst=True)
+    return engine
+
+
+def _after_fork() -> None:
+    # worker fork 出的子进程不能复用父进程连接池里的连接
+    if _engine.cache_info().currsize:
+        _engine().dispose(close=False)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def record(task_id: str, ref: str, size: int, ext: str, sha256: str, task_type: str | None = None) -> None:
+    """登记（或覆盖）一个任务的产物。"""
+    row = {
+        "task_id": task_id, "ref": ref, "size": size, "ext": ext, "sha256": sha256,
+        "task_type": task_type, "created_at": datetime.now(timezone.utc),
+    }
+    with _engine().begin() as conn:
+        conn.execute(delete(task_outputs).where(task_outputs.c.task_id == task_id))
+        conn.execute(insert(task_outputs).values(**row))
+
+
+def get(task_id: str) -> OutputRecord | None:
+    with _engine().connect() as conn:
+        row = conn.execute(select(task_outputs).where(task_outputs.c.task_id == task_id)).mappings().first()
+    return OutputRecord(**row) if row else None
+
+
+def remove(task_id: str) -> None:
+    with _engine().begin() as conn:
+        conn.execute(delete(task_outputs).where(task_outputs.c.task_id == task_id))
+
+
+def expired(before: datetime, task_types: list[str] | None = None, exclude: list[str] | None = None,
+            limit: int = 500) -> list[OutputRecord]:
+    """
+    created_at 早于 before 的产物，最早的在前。
+    task_types：只看这些任务类型；exclude：排除这些任务类型（未登记类型的产物也算在内）。
+    """
+    q = select(task_outputs).where(task_outputs.c.created_at < before)
+    if task_types is not None:
+        q = q.where(task_outputs.c.task_type.in_(task_types))
+    if exclude:
+        q = q.where(task_outputs.c.task_type.is_(None) | task_outputs.c.task_type.not_in(exclude))
+    q = q.order_by(task_outputs.c.created_at).limit(limit)
+    with _engine().connect() as conn:
+        return [OutputRecord(**row) for row in conn.execute(q).mappings()]
+
+
+def remove_many(task_ids: list[str]) -> None:
+    if not task_ids:
+        return
+    with _engine().begin() as conn:
+        conn.execute(delete(task_outputs).where(task_outputs.c.task_id.in_(task_ids)))
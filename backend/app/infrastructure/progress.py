@@ -0,0 +1,128 @@
+"""
+报关资料按合同的生成进度，供 /files/{task_id}/status 展示。
+
+- progress:<task_id>:contracts：[{"contract": 合同号, "rows": 行数}, ...]，开始构建前写一次
+- progress:<task_id>:done：已完成的 "合同序号:报关资料序号"（set），重复上报（任务重试）不会多计
+单任务模式和任务图模式（多个 worker 同时上报）共用这两个 key。
+带 stages（stage_timing.StageProgress）时同时上报流水线的阶段进度和各阶段耗时（百分比 / ETA）。
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Callable
+
+from redis import Redis
+
+from app.infrastructure.stage_timing import StageProgress
+
+logger = logging.getLogger("infrastructure.progress")
+
+PROGRESS_TTL = 24 * 3600
+
+
+def _contracts_key(task_id: str) -> str:
+    return f"progress:{task_id}:contracts"
+
+
+def _done_key(task_id: str) -> str:
+    return f"progress:{task_id}:done"
+
+
+class Reporter:
+    """构建端上报进度；Redis 出错只记日志，不影响任务本身。"""
+
+    def __init__(self, conn: Redis, task_id: str, notify: Callable[[str | None], None] | None = None,
+                 stages: StageProgress | None = None, doc_stages: list[str] | None = None):
+        """
+        notify：每次进度变化后调用，参数是流水线的当前阶段（没有 stages 时为 None），用于推送任务状态；
+        stages / doc_stages：阶段进度，以及第 i 个报关资料对应的阶段名。
+        """
+        self.conn = conn
+        self.task_id = task_id
+        self.total = 0
+        self.notify = notify
+        self.stages = stages
+        self.doc_stages = doc_stages or []
+        self._rows: list[int] = []
+        self._docs: dict[int, list[float]] = {}  # 报关资料序号 -> 已完成合同的构建耗时
+
+    def start(self, contracts: list[tuple[str, int]], total: int, workers: int = 1) -> None:
+        """contracts：[(合同号, 行数)]；total：每个合同要生成的文件数；workers：同时运行的构建器数（估计 ETA 用）。"""
+        self.total = total
+        payload = {"total": total, "contracts": [{"contract": c, "rows": r} for c, r in contracts]}
+        try:
+            self.conn.set(_contracts_key(self.task_id), json.dumps(payload, ensure_ascii=False), ex=PROGRESS_TTL)
+        except Exception as e:
+            logger.warning("写入进度失败 (task_id=%s): %s", self.task_id, e)
+        if self.stages is not None:
+            self._rows = [r for _, r in contracts]
+            self.stages.plan(sum(self._rows), workers)
+            self._notify(self.stages.start(*self.doc_stages))
+
+    def done(self, contract_index: int, doc_index: int, seconds: float | None = None) -> None:
+        """seconds：这个文件的构建耗时，同一报关资料的所有合同都完成后计入该阶段的耗时统计。"""
+        try:
+            pipe = self.conn.pipeline()
+            pipe.sadd(_done_key(self.task_id), f"{contract_index}:{doc_index}")
+            pipe.expire(_done_key(self.task_id), PROGRESS_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("写入进度失败 (task_id=%s): %s", self.task_id, e)
+            return
+        state = None
+        if self.stages is not None and self._rows and doc_index < len(self.doc_stages):
+            spent = self._docs.setdefault(doc_index, [])
+            spent.append(seconds or 0.0)
+            stage = self.doc_stages[doc_index]
+            if len(spent) >= len(self._rows):
+                state = self.stages.finish(stage, sum(spent), sum(self._rows))
+            else:
+                state = self.stages.advance(stage, len(spent) / len(self._rows))
+        self._notify(state)
+
+    def begin(self, stage: str) -> None:
+        """流水线的某个阶段（解析、打包）开始。"""
+        if self.stages is not None:
+            self._notify(self.stages.start(stage))
+
+    def finish(self, stage: str, seconds: float, rows: int | None = None) -> None:
+        if self.stages is not None:
+            self._notify(self.stages.finish(stage, seconds, rows))
+
+    def _notify(self, state: dict | None) -> None:
+        if self.notify:
+            self.notify(state["stage"] if state else None)
+
+
+def read(conn: Redis, task_id: str) -> list[dict[str, Any]] | None:
+    """[{contract, rows, done, total}, ...]；没有进度记录时返回 None。"""
+    return read_many(conn, [task_id])[task_id]
+
+
+def read_many(conn: Redis, task_ids: list[str]) -> dict[str, list[dict[str, Any]] | None]:
+    """多个任务的进度，一次 pipeline 读完。"""
+    pipe = conn.pipeline()
+    for task_id in task_ids:
+        pipe.get(_contracts_key(task_id))
+        pipe.smembers(_done_key(task_id))
+    answers = pipe.execute()
+    return {
+        task_id: _rows(raw, done)
+        for task_id, raw, done in zip(task_ids, answers[::2], answers[1::2])
+    }
+
+
+def _rows(raw: bytes | None, done: set) -> list[dict[str, Any]] | None:
+    if not raw:
+        return None
+    payload = json.loads(raw)
+    counts: dict[int, int] = {}
+    for member in done:
+        member = member.decode() if isinstance(member, bytes) else member
+        idx = int(member.split(":", 1)[0])
+        counts[idx] = counts.get(idx, 0) + 1
+    return [
+        {**c, "done": counts.get(i, 0), "total": payload["total"]}
+        for i, c in enumerate(payload["contracts"])
+    ]
@@ -0,0 +1,302 @@
+"""
+按任务类型分队列。
+
+- RQ_TASK_QUEUES：任务类型 -> 队列名，未列出的任务类型进 RQ_QUEUE_NAME
+- RQ_QUEUES：队列声明 {队列名: {"weight": 权重, "concurrency": 同时执行上限}}，
+  app.worker 的 weighted 模式按权重公平取任务；concurrency 由 CappedQueue 在领取时用 Redis 名额（租约）硬性保证
+- 排队等待时间由任务开始执行时记录（record_wait），queue_stats() 汇总每个队列的积压和等待情况
+- enqueue_async：API 进程在事件循环里投递，用 redis.asyncio 一个事务写完 job 和入队（RQ 只有同步客户端）
+- defer_job：依赖同一事务里新建任务的 job（任务图）直接记为 deferred，整张图和其他写入一起在一个 MULTI/EXEC 里生效
+"""
+from __future__ import annotations
+
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable
+from uuid import uuid4
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.client import Pipeline
+from redis.exceptions import ResponseError, WatchError
+from rq import Queue
+from rq.exceptions import DequeueTimeout
+from rq.job import Job, JobStatus
+
+from app.core.config import get_settings
+from app.infrastructure.redis_client import redis_conn
+
+settings = get_settings()
+
+_WAIT_KEY = "queue_stats:{}:waits"            # 最近 WAIT_SAMPLES 次排队等待秒数（list，新的在前）
+_SERVICE_KEY = "queue_stats:service:{}"       # 按任务类型，最近 SERVICE_SAMPLES 次执行耗时（list，新的在前）
+_SLOTS_KEY = "queue_slots:{}"                 # 有并发上限的队列：占用名额的 job id / 预留 -> 租约到期时间（zset）
+WAIT_SAMPLES = 200
+SERVICE_SAMPLES = 50
+SLOT_GRACE_S = 60          # 租约比任务超时多留的时间
+SLOT_POLL_S = 5            # 有队列因到上限被跳过时，最多阻塞这么久就重新检查名额
+_UNLIMITED_LEASE_S = 24 * 3600  # 任务不设超时（-1）时的租约
+
+
+def queue_name_for(task_type: str) -> str:
+    return settings.RQ_TASK_QUEUES.get(task_type, settings.RQ_QUEUE_NAME)
+
+
+def declared_queues() -> list[str]:
+    """所有声明的队列，外加兜底的 RQ_QUEUE_NAME（升级前投递进 default 的任务也能被处理）。"""
+    names = list(settings.RQ_QUEUES)
+    for name in settings.RQ_TASK_QUEUES.values():
+        if name not in names:
+            names.append(name)
+    if settings.RQ_QUEUE_NAME not in names:
+        names.append(settings.RQ_QUEUE_NAME)
+    return names
+
+
+def weight_of(name: str) -> int:
+    return max(1, int(settings.RQ_QUEUES.get(name, {}).get("weight", 1)))
+
+
+def concurrency_of(name: str) -> int:
+    """同时执行上限，0 表示不限。"""
+    return max(0, int(settings.RQ_QUEUES.get(name, {}).get("concurrency", 0)))
+
+
+@lru_cache(maxsize=None)
+def get_queue(name: str) -> Queue:
+    return Queue(name, connection=redis_conn)
+
+
+def queue_for(task_type: str) -> Queue:
+    return get_queue(queue_name_for(task_type))
+
+
+def defer_job(queue: Queue, job: Job, pipeline: Pipeline) -> Job:
+    """
+    把 job 以 deferred 状态写进 pipeline，等依赖完成后由 RQ 入队（即 Queue.setup_dependencies 在依赖未完成时做的那些写入）。
+    只用于依赖是同一事务里刚创建的任务：它们还没写进 Redis，enqueue_job 的 WATCH 检查无从做起，而且必然还没完成。
+    """
+    job.origin = queue.name
+    job.set_status(JobStatus.DEFERRED, pipeline=pipeline)
+    job.register_dependency(pipeline=pipeline)
+    job.save(pipeline=pipeline)
+    job.cleanup(ttl=job.ttl, pipeline=pipeline)
+    pipeline.sadd(queue.redis_queues_keys, queue.key)
+    return job
+
+
+# ---------- 异步投递 ----------
+_server_version: tuple[int, int, int] | None = None
+
+
+async def _redis_version(aconn: AsyncRedis) -> tuple[int, int, int]:
+    """RQ 入队时要写 redis_server_version；同步版每个连接读一次 INFO，这里每个进程读一次。"""
+    global _server_version
+    if _server_version is None:
+        try:
+            parts = [int(i) for i in str((await aconn.info("server"))["redis_version"]).split(".")[:3]]
+            _server_version = tuple(parts + [0] * (3 - len(parts)))
+        except ResponseError:  # 不支持 INFO 的兼容实现，与 rq.utils.get_version 的兜底相同
+            _server_version = (5, 0, 9)
+    return _server_version
+
+
+async def enqueue_async(
+    aconn: AsyncRedis,
+    queue: Queue,
+    func: Callable,
+    args: tuple = (),
+    kwargs: dict | None = None,
+    *,
+    extra: Callable[[Pipeline, Job], None] | None = None,
+    **options: Any,
+) -> Job:
+    """
+    queue.enqueue 的 redis.asyncio 版本，options 同 Queue.create_job（job_id / meta / result_ttl / on_success ...）。
+    job 在内存里构造，RQ 入队要写的命令先记进一个不执行的同步 pipeline，
+    连同 extra(pipe, job) 追加的命令（状态快照、准入登记等）在异步连接上以一个 MULTI/EXEC 发出：
+    一次往返，worker 看到任务时这些数据都已写好。
+    只用于没有依赖的任务；有依赖的要 WATCH 依赖的状态，仍用同步的 enqueue。
+    """
+    if queue.redis_server_version is None:
+        queue.redis_server_version = await _redis_version(aconn)
+    job = queue.create_job(func, args=args, kwargs=kwargs, **options)
+    if job._dependency_ids:
+        raise ValueError("enqueue_async 不支持有依赖的任务")
+
+    recorder = queue.connection.pipeline()  # 只记录命令，不执行
+    try:
+        queue.enqueue_job(job, pipeline=recorder)
+        if extra:
+            extra(recorder, job)
+        commands = list(recorder.command_stack)
+    finally:
+        recorder.reset()
+
+    async with aconn.pipeline(transaction=True) as pipe:
+        for cmd_args, cmd_options in commands:
+            pipe.execute_command(*cmd_args, **cmd_options)
+        await pipe.execute()
+    return job
+
+
+# ---------- 并发上限 ----------
+def _acquire_slot(conn: Redis, name: str, member: str, ttl: float) -> bool:
+    """在队列 name 的并发上限内占一个名额；过期的租约先清掉。WATCH 保证计数和写入之间没有别的 worker 插进来。"""
+    key = _SLOTS_KEY.format(name)
+    limit = concurrency_of(name)
+    with conn.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                now = time.time()
+                if pipe.zcount(key, f"({now}", "+inf") >= limit:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.zremrangebyscore(key, "-inf", now)
+                pipe.zadd(key, {member: now + ttl})
+                pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+
+def release_slot(conn: Redis, name: str, member: str) -> None:
+    conn.zrem(_SLOTS_KEY.format(name), member)
+
+
+def running_count(conn: Redis, name: str) -> int:
+    """占用名额（执行中或正在领取）的数量，不含已过期的租约。"""
+    return conn.zcount(_SLOTS_KEY.format(name), f"({time.time()}", "+inf")
+
+
+def _lease_seconds(job: Job) -> float:
+    timeout = job.timeout if job.timeout is not None else Queue.DEFAULT_TIMEOUT
+    return (timeout if timeout > 0 else _UNLIMITED_LEASE_S) + SLOT_GRACE_S
+
+
+class CappedQueue(Queue):
+    """
+    领取时保证 RQ_QUEUES 的 concurrency 上限（app.worker 的 WeightedWorker 用作 queue_class）。
+
+    每次 dequeue_any 先给每个有上限的队列预留一个名额，预留不到（已满）的队列这次不参与 LPOP / BLPOP；
+    取到任务后，任务所在队列的预留转成这个 job 的租约，其余预留退回。租约由 worker 在任务结束后释放，
+    worker 异常退出时按任务超时过期，名额自动回收。有队列被跳过时阻塞等待最多 SLOT_POLL_S 秒，
+    之后重新检查，名额空出来的队列就能再被取到。
+    """
+
+    @classmethod
+    def dequeue_any(cls, queues, timeout, connection, **kwargs):
+        queues = list(queues)
+        token = f"reserve:{uuid4().hex}"
+        eligible: list[Queue] = []
+        reserved: list[str] = []
+        for q in queues:
+            if not concurrency_of(q.name):
+                eligible.append(q)
+            elif _acquire_slot(connection, q.name, token, (timeout or 0) + SLOT_GRACE_S):
+                eligible.append(q)
+                reserved.append(q.name)
+
+        result = None
+        try:
+            if not eligible:
+                if timeout is None:
+                    return None
+                time.sleep(min(timeout, SLOT_POLL_S))
+                raise DequeueTimeout(timeout, [q.key for q in queues])
+            if len(eligible) < len(queues) and timeout is not None:
+                timeout = min(timeout, SLOT_POLL_S)
+            result = super().dequeue_any(eligible, timeout, connection, **kwargs)
+            return result
+        finally:
+            if reserved:
+                # 同一个事务里把预留换成 job 的租约，名额数不变
+                pipe = connection.pipeline()
+                for name in reserved:
+                    pipe.zrem(_SLOTS_KEY.format(name), token)
+                if result is not None and result[1].name in reserved:
+                    job, queue = result
+                    pipe.zadd(_SLOTS_KEY.format(queue.name), {job.id: time.time() + _lease_seconds(job)})
+                pipe.execute()
+
+
+# ---------- 统计 ----------
+def record_wait(conn: Redis, queue_name: str, seconds: float) -> None:
+    key = _WAIT_KEY.format(queue_name)
+    pipe = conn.pipeline()
+    pipe.lpush(key, f"{seconds:.3f}")
+    pipe.ltrim(key, 0, WAIT_SAMPLES - 1)
+    pipe.execute()
+
+
+def record_service(conn: Redis, task_type: str, seconds: float) -> None:
+    key = _SERVICE_KEY.format(task_type)
+    pipe = conn.pipeline()
+    pipe.lpush(key, f"{seconds:.3f}")
+    pipe.ltrim(key, 0, SERVICE_SAMPLES - 1)
+    pipe.execute()
+
+
+def service_estimate(conn: Redis, task_type: str, alpha: float, default: float) -> float:
+    """最近执行耗时的指数滑动平均（越新的样本权重越大）；还没有样本时返回 default。"""
+    samples = conn.lrange(_SERVICE_KEY.format(task_type), 0, -1)
+    if not samples:
+        return default
+    ewma = None
+    for raw in reversed(samples):  # 从旧到新
+        x = float(raw)
+        ewma = x if ewma is None else alpha * x + (1 - alpha) * ewma
+    return ewma
+
+
+def wait_seconds(job: Job, until: datetime | None = None) -> float | None:
+    """任务从入队到 until（默认现在）的秒数。"""
+    if not job.enqueued_at:
+        return None
+
+    def _utc(dt: datetime) -> datetime:
+        return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+    end = _utc(until) if until else datetime.now(timezone.utc)
+    return max(0.0, (end - _utc(job.enqueued_at)).total_seconds())
+
+
+def _percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+def queue_stats(conn: Redis = redis_conn) -> list[dict[str, Any]]:
+    """每个队列的积压、执行中数量、最老任务已等待秒数，以及最近若干次的排队等待时间。"""
+    out = []
+    for name in declared_queues():
+        q = Queue(name, connection=conn)
+        pipe = conn.pipeline()
+        pipe.llen(q.key)
+        pipe.lindex(q.key, 0)
+        pipe.lrange(_WAIT_KEY.format(name), 0, -1)
+        depth, head, waits = pipe.execute()
+
+        oldest = None
+        if head:
+            try:
+                oldest = wait_seconds(Job.fetch(head.decode(), connection=conn))
+            except Exception:
+                oldest = None
+
+        samples = [float(w) for w in waits]
+        out.append({
+            "queue": name,
+            "weight": weight_of(name),
+            "concurrency": concurrency_of(name),
+            "depth": depth,
+            "running": q.started_job_registry.count,
+            "oldest_wait_s": round(oldest, 3) if oldest is not None else None,
+            "wait_samples": len(samples),
+            "wait_avg_s": round(sum(samples) / len(samples), 3) if samples else None,
+            "wait_p95_s": round(_percentile(samples, 0.95), 3) if samples else None,
+        })
+    return out
@@ -1,4 +1,5 @@
 from redis import Redis
+from redis.asyncio import BlockingConnectionPool, Redis as AsyncRedis
 from rq import Queue
 from app.core.config import get_settings
 
@@ -6,10 +7,26 @@ from app.core.config import get_settings
 _settings = get_settings()
 
 redis_conn = Redis.from_url(_settings.REDIS_URL)
-default_queue = Queue(connection=redis_conn)
+default_queue = Queue(_settings.RQ_QUEUE_NAME, connection=redis_conn)
+
+# API 进程的路由里用（事件循环中不做同步 Redis 调用）：连接池满时最多等 POOL_TIMEOUT 秒，读写都有超时
+async_redis_conn = AsyncRedis(connection_pool=BlockingConnectionPool.from_url(
+    _settings.REDIS_URL,
+    max_connections=_settings.REDIS_ASYNC_MAX_CONNECTIONS,
+    timeout=_settings.REDIS_ASYNC_POOL_TIMEOUT_S,
+    socket_timeout=_settings.REDIS_ASYNC_SOCKET_TIMEOUT_S,
+    socket_connect_timeout=_settings.REDIS_ASYNC_CONNECT_TIMEOUT_S,
+    health_check_interval=_settings.REDIS_ASYNC_HEALTH_CHECK_S,
+))
+# 状态推送的订阅连接：长时间没有消息是正常的，不设读超时
+async_pubsub_conn = AsyncRedis.from_url(
+    _settings.REDIS_URL,
+    socket_connect_timeout=_settings.REDIS_ASYNC_CONNECT_TIMEOUT_S,
+    health_check_interval=_settings.REDIS_ASYNC_HEALTH_CHECK_S,
+)
 
 
 
 if __name__ == '__main__':
     print(_settings.REDIS_URL)
-    print("Ping:", redis_conn.ping())
\ No newline at end of file
+    print("Ping:", redis_conn.ping())
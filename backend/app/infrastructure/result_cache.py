@@ -0,0 +1,169 @@
+"""
+内容寻址的结果缓存。
+
+key = sha256(输入内容摘要 + task_type + 模板/资源版本)
+- 已完成的产物：result_cache:entry:<key> -> {task_id, path, size, created}，带 TTL
+- 正在处理的任务：result_cache:inflight:<key> -> task_id，SET NX，相同输入的并发上传直接加入这个任务
+- 容量控制：result_cache:lru（zset，按最近命中时间）+ result_cache:sizes（hash）+ result_cache:bytes（计数），
+  超过 RESULT_CACHE_MAX_BYTES 时按 LRU 淘汰缓存条目（只删索引，产物文件由任务本身的生命周期管理）
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import time
+from pathlib import Path
+from typing import Any
+
+from redis import Redis
+
+from app.core.config import get_settings
+from app.infrastructure import storage
+
+logger = logging.getLogger("infrastructure.result_cache")
+settings = get_settings()
+
+RESOURCE_DIR = Path(__file__).resolve().parents[1] / "app_tasks" / "resource"
+
+_PREFIX = "result_cache"
+_LRU = f"{_PREFIX}:lru"
+_SIZES = f"{_PREFIX}:sizes"
+_BYTES = f"{_PREFIX}:bytes"
+
+
+def _entry_key(key: str) -> str:
+    return f"{_PREFIX}:entry:{key}"
+
+
+def _inflight_key(key: str) -> str:
+    return f"{_PREFIX}:inflight:{key}"
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+def is_cacheable(task_type: str) -> bool:
+    return settings.RESULT_CACHE_ENABLED and task_type in settings.RESULT_CACHE_TASK_TYPES
+
+
+def resource_version() -> str:
+    """模板/资源版本：应用版本号 + resource 目录下文件的 (名称, 大小, mtime)。替换模板后旧缓存自动失效。"""
+    parts = [settings.VERSION]
+    if RESOURCE_DIR.exists():
+        for p in sorted(RESOURCE_DIR.iterdir()):
+            if p.is_file():
+                st = p.stat()
+                parts.append(f"{p.name}:{st.st_size}:{st.st_mtime_ns}")
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def make_key(content_sha256: str, task_type: str) -> str:
+    return hashlib.sha256(f"{content_sha256}:{task_type}:{resource_version()}".encode()).hexdigest()
+
+
+# ---------- API 端 ----------
+def lookup(conn: Redis, key: str) -> dict | None:
+    """命中返回 {task_id, path, size}，并刷新 LRU；产物文件已不存在则视为未命中并清掉条目。"""
+    raw = conn.hgetall(_entry_key(key))
+    if not raw:
+        return None
+    entry = {_s(k): _s(v) for k, v in raw.items()}
+    if not storage.exists(entry.get("path", "")):
+        _drop(conn, key)
+        return None
+    conn.zadd(_LRU, {key: time.time()})
+    return entry
+
+
+def claim(conn: Redis, key: str, task_id: str) -> str | None:
+    """
+    抢占 in-flight 标记。成功返回 None（调用方负责投递任务）；
+    已有相同输入在处理则返回那个任务的 task_id。
+    """
+    if conn.set(_inflight_key(key), task_id, nx=True, ex=settings.RESULT_CACHE_INFLIGHT_TTL):
+        return None
+    owner = conn.get(_inflight_key(key))
+    return _s(owner) if owner else None
+
+
+def force_claim(conn: Redis, key: str, task_id: str) -> None:
+    """in-flight 标记指向的任务已不存在 / 已失败时，覆盖为新任务。"""
+    conn.set(_inflight_key(key), task_id, ex=settings.RESULT_CACHE_INFLIGHT_TTL)
+
+
+def release(conn: Redis, key: str, task_id: str) -> None:
+    """只释放属于自己的 in-flight 标记。"""
+    owner = conn.get(_inflight_key(key))
+    if owner and _s(owner) == task_id:
+        conn.delete(_inflight_key(key))
+
+
+# ---------- worker 端 ----------
+def store(conn: Redis, key: str, task_id: str, path: str) -> None:
+    size = storage.size(path)
+    if size is None:
+        logger.warning("结果缓存写入跳过，产物不存在: %s", path)
+        return
+    if size > settings.RESULT_CACHE_MAX_BYTES:
+        return
+
+    if conn.hexists(_SIZES, key):
+        _drop(conn, key)  # 同一 key 重复写入时先扣掉旧条目的大小
+
+    now = time.time()
+    pipe = conn.pipeline()
+    pipe.hset(_entry_key(key), mapping={"task_id": task_id, "path": path, "size": size, "created": now})
+    pipe.expire(_entry_key(key), settings.RESULT_CACHE_TTL)
+    pipe.zadd(_LRU, {key: now})
+    pipe.hset(_SIZES, key, size)
+    pipe.incrby(_BYTES, size)
+    pipe.execute()
+    _evict(conn)
+
+
+def _drop(conn: Redis, key: str) -> None:
+    size = conn.hget(_SIZES, key)
+    pipe = conn.pipeline()
+    pipe.delete(_entry_key(key))
+    pipe.zrem(_LRU, key)
+    pipe.hdel(_SIZES, key)
+    if size is not None:
+        pipe.decrby(_BYTES, int(size))
+    pipe.execute()
+
+
+def _evict(conn: Redis, batch: int = 100) -> None:
+    """先清理已过期（TTL 到期）的条目，再按 LRU 淘汰到容量以内。"""
+    oldest = [_s(m) for m in conn.zrange(_LRU, 0, batch - 1)]
+    if oldest:
+        pipe = conn.pipeline()
+        for member in oldest:
+            pipe.exists(_entry_key(member))
+        alive = pipe.execute()
+        for member, ok in zip(oldest, alive):
+            if not ok:
+                _drop(conn, member)
+
+    while int(conn.get(_BYTES) or 0) > settings.RESULT_CACHE_MAX_BYTES:
+        victims = conn.zrange(_LRU, 0, 0)
+        if not victims:
+            conn.set(_BYTES, 0)
+            break
+        logger.info("结果缓存超出容量，淘汰: %s", _s(victims[0]))
+        _drop(conn, _s(victims[0]))
+
+
+def on_job_success(job, connection: Redis, result: Any) -> None:
+    key = job.meta.get("cache_key")
+    if not key:
+        return
+    if isinstance(result, dict) and result.get("path"):
+        store(connection, key, job.id, result["path"])
+    release(connection, key, job.id)
+
+
+def on_job_failure(job, connection: Redis) -> None:
+    key = job.meta.get("cache_key")
+    if key:
+        release(connection, key, job.id)
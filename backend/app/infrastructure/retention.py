@@ -0,0 +1,270 @@
+"""
+产物文件与 Redis 任务记录的保留期，以及后台清理。
+
+- 产物：产物索引里 created_at 超过该任务类型 output TTL 的，删除文件和索引行
+- RQ 任务记录：投递时按任务类型设置 result_ttl / failure_ttl（job_ttls），由 Redis 到期自动删除；
+  清理时再 SCAN 一遍 rq:job:* / rq:results:*，给没有过期时间（或过期时间比任何配置都长）的旧记录补上 TTL
+- 孤儿文件：任务记录已不存在的上传输入、旧版本落盘的合并包（任务组已过期），超过 RETENTION_ORPHAN_GRACE_S 后删除；
+  报关资料任务图遗留的中间结果（_dag/<task_id>/，正常在打包结束时删除）超过 BAOGUAN_DAG_TTL 后删除
+- 统计：retention:stats（hash）累计各类回收的对象数和字节数，以及最近一次清理的时间和耗时，见 /files/retention
+
+清理由 API 进程的后台任务每 RETENTION_SWEEP_INTERVAL_S 触发一次，在线程里分批执行，不占事件循环；
+多个 API 进程靠 Redis 锁保证每个间隔只有一个进程在清理。也可以 python -m app.infrastructure.retention 手动跑一次。
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from rq.job import Job
+
+from app.core.config import get_settings
+from app.infrastructure import job_groups, output_index, storage
+
+logger = logging.getLogger("infrastructure.retention")
+settings = get_settings()
+
+_STATS = "retention:stats"
+_LOCK = "retention:lock"
+_PAUSE = 0.05  # 批与批之间让出的秒数，避免清理期间持续占满 Redis / 数据库 / 磁盘
+_TERMINAL = {"finished": "result", "failed": "failure", "stopped": "failure", "canceled": "failure"}
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+# ---------- 保留期 ----------
+def ttl_of(task_type: str | None, kind: str) -> int:
+    """kind：output | result | failure；0 表示不过期。"""
+    default = {
+        "output": settings.RETENTION_OUTPUT_TTL_S,
+        "result": settings.RETENTION_RESULT_TTL_S,
+        "failure": settings.RETENTION_FAILURE_TTL_S,
+    }[kind]
+    return int(settings.RETENTION_TASK_TTLS_S.get(task_type or "", {}).get(kind, default))
+
+
+def job_ttls(task_type: str, at_least: int = 0) -> dict[str, int]:
+    """
+    投递时用的 {result_ttl, failure_ttl}。
+    at_least：结果缓存条目、任务组要查到这个 job，记录至少要活这么久。
+    """
+    def rq_ttl(kind: str) -> int:
+        ttl = ttl_of(task_type, kind)
+        return -1 if ttl <= 0 else max(ttl, at_least)  # RQ 里 -1 表示永久
+
+    return {"result_ttl": rq_ttl("result"), "failure_ttl": rq_ttl("failure")}
+
+
+def _max_job_ttl(kind: str) -> int:
+    """任何一种任务可能设置的最长记录保留期；有配置为永久的返回 0。"""
+    ttls = [ttl_of(None, kind)] + [ttl_of(t, kind) for t in settings.RETENTION_TASK_TTLS_S]
+    if min(ttls) <= 0:
+        return 0
+    return max(ttls + [settings.RESULT_CACHE_TTL, settings.JOB_GROUP_TTL])
+
+
+# ---------- 统计 ----------
+class _Tally:
+    def __init__(self):
+        self.counts: dict[str, dict[str, int]] = defaultdict(lambda: {"objects": 0, "bytes": 0})
+
+    def add(self, category: str, objects: int = 1, nbytes: int = 0) -> None:
+        self.counts[category]["objects"] += objects
+        self.counts[category]["bytes"] += nbytes
+
+
+def _save_stats(conn: Redis, tally: _Tally, started: float, duration: float) -> None:
+    pipe = conn.pipeline()
+    for category, c in tally.counts.items():
+        pipe.hincrby(_STATS, f"{category}:objects", c["objects"])
+        pipe.hincrby(_STATS, f"{category}:bytes", c["bytes"])
+    pipe.hset(_STATS, mapping={
+        "last_run": started,
+        "last_duration_s": round(duration, 3),
+        "last_objects": sum(c["objects"] for c in tally.counts.values()),
+        "last_bytes": sum(c["bytes"] for c in tally.counts.values()),
+    })
+    pipe.execute()
+
+
+async def stats_async(aconn: AsyncRedis) -> dict:
+    """{totals: {类别: {objects, bytes}}, last_run, last_duration_s, last_objects, last_bytes}。"""
+    raw = {_s(k): _s(v) for k, v in (await aconn.hgetall(_STATS)).items()}
+    totals: dict[str, dict[str, int]] = defaultdict(lambda: {"objects": 0, "bytes": 0})
+    data: dict[str, Any] = {}
+    for k, v in raw.items():
+        if ":" in k:
+            category, field = k.split(":", 1)
+            totals[category][field] = int(v)
+        else:
+            data[k] = float(v) if k in ("last_run", "last_duration_s") else int(v)
+    return {"totals": dict(totals), **data}
+
+
+# ---------- 各类清理 ----------
+def _sweep_outputs(tally: _Tally) -> None:
+    overrides = {t: v["output"] for t, v in settings.RETENTION_TASK_TTLS_S.items() if "output" in v}
+    scopes = [([t], None, ttl) for t, ttl in overrides.items()]
+    scopes.append((None, list(overrides), settings.RETENTION_OUTPUT_TTL_S))
+
+    now = datetime.now(timezone.utc)
+    for task_types, exclude, ttl in scopes:
+        if ttl <= 0:
+            continue
+        before = now - timedelta(seconds=ttl)
+        while True:
+            batch = output_index.expired(before, task_types, exclude, limit=settings.RETENTION_BATCH_SIZE)
+            removed = []
+            for rec in batch:
+                try:
+                    storage.delete(rec.ref)
+                except Exception as e:
+                    logger.warning("删除产物失败 (task_id=%s, ref=%s): %s", rec.task_id, rec.ref, e)
+                    continue
+                removed.append(rec.task_id)
+                tally.add("outputs", 1, rec.size)
+            output_index.remove_many(removed)
+            # 本批一个都没删掉（存储不可用）时停下，等下一轮
+            if len(batch) < settings.RETENTION_BATCH_SIZE or not removed:
+                break
+            time.sleep(_PAUSE)
+
+
+def _sweep_jobs(conn: Redis, tally: _Tally) -> None:
+    limits = {kind: _max_job_ttl(kind) for kind in ("result", "failure")}
+    cursor = 0
+    while True:
+        cursor, keys = conn.scan(cursor, match="rq:*", count=settings.RETENTION_BATCH_SIZE)
+        # 只看 rq:job:<id> 和 rq:results:<id>，不碰队列、注册表和 rq:job:<id>:dependents
+        keys = [k for k in map(_s, keys) if k.count(":") == 2 and k.split(":")[1] in ("job", "results")]
+        if keys:
+            pipe = conn.pipeline()
+            for k in keys:
+                pipe.ttl(k)
+                if k.startswith("rq:job:"):
+                    pipe.hget(k, "status")
+                else:
+                    pipe.exists(k)
+            answers = pipe.execute()
+
+            pipe = conn.pipeline()
+            for k, ttl, status in zip(keys, answers[::2], answers[1::2]):
+                kind = "result" if k.startswith("rq:results:") else _TERMINAL.get(_s(status) if status else "")
+                if not kind or not limits[kind]:
+                    continue  # 未结束的任务，或配置了永久保留
+                if ttl == -1 or ttl > limits[kind]:
+                    pipe.expire(k, ttl_of(None, kind) or limits[kind])
+                    tally.add("jobs")
+            pipe.execute()
+        if cursor == 0:
+            break
+        time.sleep(_PAUSE)
+
+
+def _sweep_orphans(conn: Redis, tally: _Tally) -> None:
+    cutoff = time.time() - settings.RETENTION_ORPHAN_GRACE_S
+
+    def drain(candidates: list[tuple[str, int, str]], exists_key, remove, category: str) -> None:
+        """candidates：[(对象 key, 字节数, 对应 Redis 记录的 id)]；Redis 记录已不存在的删除。"""
+        pipe = conn.pipeline()
+        for _, _, rid in candidates:
+            pipe.exists(exists_key(rid))
+        for (key, size, _), alive in zip(candidates, pipe.execute()):
+            if alive:
+                continue
+            try:
+                remove(key)
+            except Exception as e:
+                logger.warning("删除孤儿文件失败 (%s): %s", key, e)
+                continue
+            tally.add(category, 1, size)
+
+    def batched(items, exists_key, remove, category: str) -> None:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= settings.RETENTION_BATCH_SIZE:
+                drain(batch, exists_key, remove, category)
+                batch = []
+                time.sleep(_PAUSE)
+        if batch:
+            drain(batch, exists_key, remove, category)
+
+    # 上传输入：<task_id>.in，对应的 job 记录已过期（任务早已结束或投递失败）
+    batched(
+        ((key, size, Path(key).stem) for key, size, mtime in storage.scan_inputs() if mtime < cutoff),
+        Job.key_for, storage.remove_input, "inputs",
+    )
+    # 旧版本落盘的合并包：_groups/<group_id>.zip，任务组记录已过期（现在合并包下载时现场生成，不再写入）
+    store = storage.get_store()
+    batched(
+        ((key, size, Path(key).stem) for key, size, mtime in store.scan("_groups/") if mtime < cutoff),
+        job_groups.group_key, store.delete, "groups",
+    )
+    # 任务图中间结果：打包任务没能执行（例如被取消）时遗留下来，按写入时间过期
+    # 先列出再删：local 后端删掉最后一个文件会顺带删掉空目录，边遍历边删会打断遍历
+    dag_cutoff = time.time() - settings.BAOGUAN_DAG_TTL
+    stale = [(key, size) for key, size, mtime in storage.scan_scratch() if mtime < dag_cutoff]
+    for key, size in stale:
+        try:
+            store.delete(key)
+        except Exception as e:
+            logger.warning("删除任务图中间结果失败 (%s): %s", key, e)
+            continue
+        tally.add("dag", 1, size)
+
+
+def sweep(conn: Redis, force: bool = False) -> dict | None:
+    """
+    跑一轮清理，返回本轮各类回收的 {objects, bytes}。
+    force=False 时先抢锁，本间隔内已有进程清理过则直接返回 None。
+    """
+    if not force and not conn.set(_LOCK, "1", nx=True, ex=max(1, int(settings.RETENTION_SWEEP_INTERVAL_S * 0.9))):
+        return None
+
+    started, t0 = time.time(), time.perf_counter()
+    tally = _Tally()
+    for name, step in (
+        ("outputs", _sweep_outputs),
+        ("jobs", lambda t: _sweep_jobs(conn, t)),
+        ("orphans", lambda t: _sweep_orphans(conn, t)),
+    ):
+        try:
+            step(tally)
+        except Exception:
+            logger.exception("清理 %s 失败", name)
+
+    duration = time.perf_counter() - t0
+    _save_stats(conn, tally, started, duration)
+    result = {k: dict(v) for k, v in tally.counts.items()}
+    logger.info("保留期清理完成，用时 %.2fs: %s", duration, result or "无过期条目")
+    return result
+
+
+async def run_periodically(conn: Redis) -> None:
+    """API 进程 lifespan 里启动的后台任务：按间隔在线程里跑 sweep。"""
+    delay = min(60, settings.RETENTION_SWEEP_INTERVAL_S)  # 启动后先稍等，避免频繁重启时一直轮不到清理
+    while True:
+        await asyncio.sleep(delay)
+        delay = settings.RETENTION_SWEEP_INTERVAL_S
+        try:
+            await asyncio.to_thread(sweep, conn)
+        except Exception:
+            logger.exception("保留期清理失败")
+
+
+if __name__ == "__main__":
+    from app.core.loggers import setup_logging
+    from app.infrastructure.redis_client import redis_conn
+
+    setup_logging()
+    print(sweep(redis_conn, force=True))
@@ -0,0 +1,236 @@
+"""
+报关资料流水线（解析 -> 5 个构建器 -> 打包）的阶段进度和 ETA，以及按阶段统计的历史耗时。
+
+- 进度写在 task_id 对应 job 的 meta["stage_progress"]，/files/{task_id}/status 的快照里展示为 step / percent / eta_s：
+  {"stage": 当前阶段, "percent": 0~100, "eta_s": 预计剩余秒数（没有足够历史数据时为 None）,
+   "rows": 清单行数, "workers": 构建阶段同时运行的构建器数, "groups": [["parse"], [5 个构建器], ["zip"]],
+   "stages": {阶段: {"state": pending | running | done, "fraction": 0~1, "seconds": 实际耗时, "expect_s": 预计耗时}}}
+  任务图模式下各阶段是不同 worker 上的不同 job，都合并写到 task_id 这个 job 的 meta 上（WATCH job 记录，冲突时重试）；
+  RQ 保存 job 状态时不带 meta（include_meta=False），不会把它覆盖掉。
+- 历史耗时：stage_hist:<task_type>:<阶段>:<窗口号> 是每行耗时（秒 / 行）的对数分桶直方图（hash：桶号 -> 次数），
+  每个窗口 STAGE_TIMING_WINDOW_S 秒，估计时合并最近 STAGE_TIMING_WINDOWS 个窗口，更早的自动过期。
+  某阶段的预计耗时 = 每行耗时的 STAGE_TIMING_QUANTILE 分位数 × 行数。
+百分比按各阶段的预计耗时加权；有阶段缺少历史数据时按阶段数平均，并且不给 ETA。出错只记日志，不影响任务本身。
+"""
+from __future__ import annotations
+
+import logging
+import math
+import time
+from typing import Callable
+
+from redis import Redis
+from redis.exceptions import WatchError
+from rq.job import Job
+from rq.serializers import resolve_serializer
+
+from app.core.config import get_settings
+
+logger = logging.getLogger("infrastructure.stage_timing")
+settings = get_settings()
+
+# 每行耗时的分桶：桶 b 覆盖 (_BASE * _RATIO^(b-1), _BASE * _RATIO^b]，相邻桶相差约 19%
+_BASE = 1e-5
+_RATIO = 2 ** 0.25
+_BUCKETS = 128
+
+
+def _hist_key(task_type: str, stage: str, window: int) -> str:
+    return f"stage_hist:{task_type}:{stage}:{window}"
+
+
+def _bucket(rate: float) -> int:
+    if rate <= _BASE:
+        return 0
+    return min(_BUCKETS - 1, math.ceil(math.log(rate / _BASE, _RATIO)))
+
+
+def _rate_of(bucket: int) -> float:
+    """桶内的代表值（几何中点）。"""
+    return _BASE * _RATIO ** (bucket - 0.5) if bucket else _BASE
+
+
+# ---------- 历史耗时 ----------
+def record(conn: Redis, task_type: str, stage: str, seconds: float, rows: int) -> None:
+    """记一次阶段耗时（按行数折算成每行耗时）。"""
+    if not settings.STAGE_TIMING_ENABLED:
+        return
+    key = _hist_key(task_type, stage, int(time.time() // settings.STAGE_TIMING_WINDOW_S))
+    pipe = conn.pipeline(transaction=False)
+    pipe.hincrby(key, _bucket(seconds / max(rows, 1)), 1)
+    pipe.expire(key, settings.STAGE_TIMING_WINDOW_S * (settings.STAGE_TIMING_WINDOWS + 1))
+    pipe.execute()
+
+
+def histograms(conn: Redis, task_type: str, stages: list[str]) -> dict[str, dict[int, int]]:
+    """各阶段最近 STAGE_TIMING_WINDOWS 个窗口合并后的直方图 {阶段: {桶号: 次数}}，一次 pipeline 读完。"""
+    now = int(time.time() // settings.STAGE_TIMING_WINDOW_S)
+    windows = range(now - settings.STAGE_TIMING_WINDOWS + 1, now + 1)
+    pipe = conn.pipeline(transaction=False)
+    for stage in stages:
+        for w in windows:
+            pipe.hgetall(_hist_key(task_type, stage, w))
+    answers = iter(pipe.execute())
+    out: dict[str, dict[int, int]] = {}
+    for stage in stages:
+        merged: dict[int, int] = {}
+        for _ in windows:
+            for b, n in next(answers).items():
+                merged[int(b)] = merged.get(int(b), 0) + int(n)
+        out[stage] = merged
+    return out
+
+
+def _quantile(hist: dict[int, int], q: float) -> float | None:
+    total = sum(hist.values())
+    if total < max(settings.STAGE_TIMING_MIN_SAMPLES, 1):
+        return None
+    seen = 0
+    for b in sorted(hist):
+        seen += hist[b]
+        if seen >= q * total:
+            return _rate_of(b)
+    return _rate_of(max(hist))
+
+
+def estimate(conn: Redis, task_type: str, stages: list[str], rows: int) -> dict[str, float | None]:
+    """各阶段处理 rows 行的预计秒数；样本不足的阶段为 None。"""
+    if not settings.STAGE_TIMING_ENABLED:
+        return {s: None for s in stages}
+    out: dict[str, float | None] = {}
+    for stage, hist in histograms(conn, task_type, stages).items():
+        rate = _quantile(hist, settings.STAGE_TIMING_QUANTILE)
+        out[stage] = None if rate is None else round(rate * max(rows, 1), 3)
+    return out
+
+
+# ---------- 阶段进度 ----------
+def _new(groups: list[list[str]]) -> dict:
+    return {
+        "stage": groups[0][0], "percent": 0.0, "eta_s": None, "rows": None, "workers": 1,
+        "groups": groups,
+        "stages": {s: {"state": "pending", "fraction": 0.0, "seconds": None, "expect_s": None}
+                   for g in groups for s in g},
+    }
+
+
+def _summarize(state: dict) -> None:
+    """按各阶段的状态重新计算 stage / percent / eta_s。"""
+    groups, stages = state["groups"], state["stages"]
+    # 后面的阶段已经开始时，前面各组没报上来的视为已完成（例如某阶段写进度失败、只记了日志）
+    reached = max((gi for gi, g in enumerate(groups) for s in g if stages[s]["state"] != "pending"), default=0)
+    for g in groups[:reached]:
+        for s in g:
+            stages[s].update(state="done", fraction=1.0)
+
+    order = [s for g in groups for s in g]
+    expects = [stages[s]["expect_s"] for s in order]
+    known = all(e is not None for e in expects) and sum(expects) > 0
+    weights = expects if known else [1.0] * len(order)
+    done = [1.0 if stages[s]["state"] == "done" else stages[s]["fraction"] for s in order]
+    state["percent"] = round(100 * sum(w * f for w, f in zip(weights, done)) / sum(weights), 1)
+
+    # 剩余时间：各组依次执行；组内（5 个构建器）最多 workers 个同时跑，至少要等最慢的那个
+    if known:
+        eta = 0.0
+        for g in groups:
+            left = [stages[s]["expect_s"] * (1 - stages[s]["fraction"]) for s in g if stages[s]["state"] != "done"]
+            if left:
+                eta += max(max(left), sum(left) / (state["workers"] if len(g) > 1 else 1))
+        state["eta_s"] = round(eta, 1)
+    else:
+        state["eta_s"] = None
+
+    pending = [s for s in order if stages[s]["state"] != "done"]
+    running = [s for s in pending if stages[s]["state"] == "running"]
+    state["stage"] = (running or pending or order[-1:])[0]
+
+
+class StageProgress:
+    """
+    某个任务的阶段进度，合并写到 task_id 对应 job 的 meta["stage_progress"]。
+    job：task_id 对应的 job 已在手上时传入，写完同时更新它的 job.meta（之后的 save_meta 不会把进度写回旧值）。
+    各方法返回合并后的进度；task_id 的 job 还不存在或写入失败时返回 None。
+    """
+
+    def __init__(self, conn: Redis, task_id: str, task_type: str, groups: list[list[str]], job: Job | None = None):
+        self.conn = conn
+        self.task_id = task_id
+        self.task_type = task_type
+        self.groups = groups
+        self.job = job
+
+    def plan(self, rows: int, workers: int = 1) -> dict | None:
+        """清单解析完、知道行数后调用：按历史耗时给各阶段预计耗时。workers：构建阶段同时运行的构建器数。"""
+        try:
+            expect = estimate(self.conn, self.task_type, [s for g in self.groups for s in g], rows)
+        except Exception as e:
+            logger.warning("读取阶段耗时失败 (task_id=%s): %s", self.task_id, e)
+            expect = {}
+
+        def apply(state: dict) -> None:
+            state["rows"], state["workers"] = rows, max(workers, 1)
+            for stage, seconds in expect.items():
+                state["stages"][stage]["expect_s"] = seconds
+        return self._merge(apply)
+
+    def start(self, *stages: str) -> dict | None:
+        def apply(state: dict) -> None:
+            for stage in stages:
+                if state["stages"][stage]["state"] == "pending":
+                    state["stages"][stage]["state"] = "running"
+        return self._merge(apply)
+
+    def advance(self, stage: str, fraction: float) -> dict | None:
+        def apply(state: dict) -> None:
+            entry = state["stages"][stage]
+            if entry["state"] != "done":
+                entry.update(state="running", fraction=round(min(max(fraction, 0.0), 1.0), 3))
+        return self._merge(apply)
+
+    def finish(self, stage: str, seconds: float | None, rows: int | None = None) -> dict | None:
+        """
+        阶段完成：记下实际耗时，并计入 stage_hist 直方图（rows 为 None 时用 plan 时的行数）。
+        seconds 为 None 时只标记完成（例如重试时没有实际做事），不计入统计。
+        """
+        def apply(state: dict) -> None:
+            state["stages"][stage].update(
+                state="done", fraction=1.0, seconds=None if seconds is None else round(seconds, 3))
+        state = self._merge(apply)
+        if rows is None and state is not None:
+            rows = state["rows"]
+        if seconds is not None and rows is not None:
+            try:
+                record(self.conn, self.task_type, stage, seconds, rows)
+            except Exception as e:
+                logger.warning("记录阶段耗时失败 (task_id=%s, stage=%s): %s", self.task_id, stage, e)
+        return state
+
+    def _merge(self, apply: Callable[[dict], None]) -> dict | None:
+        key = Job.key_for(self.task_id)
+        serializer = self.job.serializer if self.job is not None else resolve_serializer()
+        try:
+            with self.conn.pipeline() as pipe:
+                while True:
+                    try:
+                        pipe.watch(key)
+                        raw = pipe.hget(key, "meta")
+                        if raw is None and not pipe.exists(key):
+                            return None  # task_id 的 job 已被删除
+                        meta = serializer.loads(raw) if raw else {}
+                        state = meta.get("stage_progress") or _new(self.groups)
+                        apply(state)
+                        _summarize(state)
+                        meta["stage_progress"] = state
+                        pipe.multi()
+                        pipe.hset(key, "meta", serializer.dumps(meta))
+                        pipe.execute()
+                        break
+                    except WatchError:
+                        continue
+        except Exception as e:
+            logger.warning("写入阶段进度失败 (task_id=%s): %s", self.task_id, e)
+            return None
+        if self.job is not None:
+            self.job.meta["stage_progress"] = state
+        return state
@@ -1,31 +1,499 @@
+"""
+产物和上传输入的存储。
+
+STORAGE_BACKEND：
+- local（默认）：产物放 OUTPUT_DIR/<task_id[:2]>/<task_id>/<task_id>.<ext>，上传输入放 INPUT_DIR，API 和 worker 需要共享文件系统
+- s3：S3 兼容对象存储（AWS S3，或把 S3_ENDPOINT_URL 指向 MinIO），API 和 worker 可以在不同机器上。
+  大文件按 S3_MULTIPART_THRESHOLD / S3_MULTIPART_CHUNKSIZE 分片上传；读取是流式的，也可以只读某个字节范围
+
+产物引用（ref）：save_output 返回的字符串，写进任务结果的 path、结果缓存条目等处。
+local 下就是文件路径（与以前一致），s3 下是 s3://bucket/key。exists / size / iter_bytes / local_copy
+按 ref 的形式选择后端，切换 STORAGE_BACKEND 之前产生的旧引用照样能读。
+"""
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
+from typing import BinaryIO, Iterator
+
 from app.core.config import get_settings
+from app.infrastructure import output_index
 
+logger = logging.getLogger("infrastructure.storage")
 S = get_settings()
 
+_CHUNK = 1024 * 1024
+
+
+class BlobStore(ABC):
+    """存储后端接口。key 是用 / 分隔的相对路径。"""
+
+    @abstractmethod
+    def ref(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, src: BinaryIO, chunk_size: int = _CHUNK) -> int:
+        """从文件对象流式写入，返回字节数。"""
 
-def ensure_task_dir(task_id: str) -> Path:
-    folder = S.OUTPUT_DIR / task_id
-    folder.mkdir(parents=True, exist_ok=True)
-    return folder
+    @abstractmethod
+    def size(self, key: str) -> int | None:
+        """对象大小；不存在时返回 None。"""
 
+    def exists(self, key: str) -> bool:
+        return self.size(key) is not None
 
+    @abstractmethod
+    def iter_bytes(self, key: str, start: int = 0, end: int | None = None,
+                   chunk_size: int = _CHUNK) -> Iterator[bytes]:
+        """流式读取 [start, end]（end 含，None 表示到结尾）。"""
 
-def output_path(task_id: str, ext: str = "bin") -> Path:
-    folder = ensure_task_dir(task_id)
-    return folder / f"{task_id}.{ext}"
+    @abstractmethod
+    def download_to(self, key: str, path: Path) -> None:
+        ...
 
+    def upload_from(self, key: str, path: Path) -> int:
+        with open(path, "rb") as f:
+            return self.put(key, f)
 
-# 在 OUTPUT_DIR/task_id/ 下按通配 task_id.* 找第一个匹配文件，找不到就返回 None。
-# 用于：下载端不知道扩展名时，兜底去磁盘探测已有产物。
-def probe_any(task_id: str) -> Path | None:
-    folder = S.OUTPUT_DIR / task_id
-    if not folder.exists():
+    @abstractmethod
+    def scan(self, prefix: str) -> Iterator[tuple[str, int, float]]:
+        """逐个给出 prefix 下的对象：(key, 字节数, 修改时间戳)。"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    def local_path(self, key: str) -> Path | None:
+        """本地文件系统上的路径（只有 local 后端有），用于 mmap / FileResponse 直接读文件。"""
         return None
-    cands = sorted(folder.glob(f"{task_id}.*"))
-    return cands[0] if cands else None
+
+
+class LocalStore(BlobStore):
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        parts = Path(key).parts
+        if not parts or ".." in parts or Path(key).is_absolute():
+            raise ValueError(f"非法的存储 key: {key}")
+        return self.root / key
+
+    def ref(self, key: str) -> str:
+        return str(self._path(key))
+
+    def put(self, key: str, src: BinaryIO, chunk_size: int = _CHUNK) -> int:
+        # 先写临时文件再原子替换，读取方不会看到写了一半的文件
+        dst = self._path(key)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.with_name(dst.name + ".part")
+        size = 0
+        with open(tmp, "wb") as f:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(tmp, dst)
+        return size
+
+    def upload_from(self, key: str, path: Path) -> int:
+        dst = self._path(key)
+        if Path(path).resolve() != dst.resolve():
+            return super().upload_from(key, path)
+        return dst.stat().st_size
+
+    def size(self, key: str) -> int | None:
+        try:
+            return self._path(key).stat().st_size
+        except (OSError, ValueError):
+            return None
+
+    def iter_bytes(self, key: str, start: int = 0, end: int | None = None,
+                   chunk_size: int = _CHUNK) -> Iterator[bytes]:
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def download_to(self, key: str, path: Path) -> None:
+        shutil.copyfile(self._path(key), path)
+
+    def scan(self, prefix: str) -> Iterator[tuple[str, int, float]]:
+        folder = self._path(prefix.rstrip("/")) if prefix.rstrip("/") else self.root
+        if not folder.is_dir():
+            return
+        for p in folder.rglob("*"):
+            if p.name.endswith(".part"):
+                continue
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            if p.is_file():
+                yield p.relative_to(self.root).as_posix(), st.st_size, st.st_mtime
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        # 顺带删掉空出来的 <task_id>/、<分片>/ 目录，不动根目录
+        parent = path.parent
+        while parent != self.root and self.root in parent.parents:
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+            parent = parent.parent
+
+    def local_path(self, key: str) -> Path | None:
+        path = self._path(key)
+        return path if path.exists() else None
+
+
+class S3Store(BlobStore):
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+
+    @property
+    def client(self):
+        return _s3_client()
+
+    @property
+    def transfer(self):
+        from boto3.s3.transfer import TransferConfig
+
+        return TransferConfig(
+            multipart_threshold=S.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S.S3_MULTIPART_CHUNKSIZE,
+        )
+
+    def _k(self, key: str) -> str:
+        return self.prefix + key
+
+    def ref(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self._k(key)}"
+
+    def put(self, key: str, src: BinaryIO, chunk_size: int = _CHUNK) -> int:
+        counted = _Reader(src)
+        self.client.upload_fileobj(counted, self.bucket, self._k(key), Config=self.transfer)
+        return counted.size
+
+    def upload_from(self, key: str, path: Path) -> int:
+        self.client.upload_file(str(path), self.bucket, self._k(key), Config=self.transfer)
+        return Path(path).stat().st_size
+
+    def size(self, key: str) -> int | None:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._k(key))["ContentLength"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def iter_bytes(self, key: str, start: int = 0, end: int | None = None,
+                   chunk_size: int = _CHUNK) -> Iterator[bytes]:
+        kwargs = {}
+        if start or end is not None:
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end}"
+        body = self.client.get_object(Bucket=self.bucket, Key=self._k(key), **kwargs)["Body"]
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+    def download_to(self, key: str, path: Path) -> None:
+        self.client.download_file(self.bucket, self._k(key), str(path), Config=self.transfer)
+
+    def scan(self, prefix: str) -> Iterator[tuple[str, int, float]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._k(prefix)):
+            for obj in page.get("Contents", []):
+                yield obj["Key"][len(self.prefix):], obj["Size"], obj["LastModified"].timestamp()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._k(key))
+
+
+class _Reader:
+    """包一层上传流：统计字节数，需要时顺带算 sha256（落盘/上传只读一遍）。"""
+
+    def __init__(self, src: BinaryIO, digest=None):
+        self.src = src
+        self.digest = digest
+        self.size = 0
+
+    def read(self, n: int = -1) -> bytes:
+        chunk = self.src.read(n)
+        self.size += len(chunk)
+        if self.digest is not None:
+            self.digest.update(chunk)
+        return chunk
+
+
+@lru_cache(maxsize=1)
+def _s3_client():
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError as e:
+        raise RuntimeError("STORAGE_BACKEND=s3 需要安装 boto3（pip install boto3）") from e
+
+    client = boto3.client(
+        "s3",
+        endpoint_url=S.S3_ENDPOINT_URL or None,
+        aws_access_key_id=S.S3_ACCESS_KEY,
+        aws_secret_access_key=S.S3_SECRET_KEY,
+        region_name=S.S3_REGION,
+        # MinIO 等自建服务一般不支持虚拟主机风格的 bucket 域名
+        config=Config(s3={"addressing_style": "path"}, retries={"max_attempts": 5, "mode": "standard"}),
+    )
+    if S.S3_CREATE_BUCKET:
+        from botocore.exceptions import ClientError
+
+        try:
+            client.head_bucket(Bucket=S.S3_BUCKET)
+        except ClientError:
+            client.create_bucket(Bucket=S.S3_BUCKET)
+    return client
+
+
+@lru_cache(maxsize=1)
+def get_store() -> BlobStore:
+    if S.STORAGE_BACKEND == "s3":
+        return S3Store(S.S3_BUCKET, S.S3_PREFIX)
+    return LocalStore(S.OUTPUT_DIR)
+
+
+def _resolve(ref: str) -> tuple[BlobStore, str]:
+    """ref -> (后端, key)。"""
+    if ref.startswith("s3://"):
+        bucket, _, key = ref[len("s3://"):].partition("/")
+        return S3Store(bucket), key
+    path = Path(ref)
+    store = get_store()
+    if isinstance(store, LocalStore) and store.root in path.parents:
+        return store, path.relative_to(store.root).as_posix()
+    return LocalStore(path.parent), path.name
+
+
+# ---------- 产物 ----------
+# 产物按 task_id 前两位分目录：<task_id[:2]>/<task_id>/<task_id>.<ext>，单个目录下的子目录数不会无限增长。
+# 查找走产物索引（output_index），不扫描目录。
+def output_key(task_id: str, ext: str = "bin") -> str:
+    return f"{task_id[:2]}/{task_id}/{task_id}.{ext}"
+
+
+def save_output(task_id: str, ext: str, data: bytes | bytearray | mmap.mmap | BinaryIO,
+                task_type: str | None = None) -> str:
+    """写入任务产物并登记到产物索引，返回 ref。data 可以是 bytes / mmap / 文件对象。"""
+    src = data if hasattr(data, "read") else BytesIO(data)
+    if hasattr(src, "seek"):
+        src.seek(0)
+    store = get_store()
+    key = output_key(task_id, ext)
+    reader = _Reader(src, hashlib.sha256())
+    store.put(key, reader)
+    ref = store.ref(key)
+    try:
+        output_index.record(task_id, ref, reader.size, ext, reader.digest.hexdigest(), task_type)
+    except Exception as e:
+        # 索引写不进去时产物照样可用：下载端还能从任务结果里拿到 ref
+        logger.warning("产物索引写入失败 (task_id=%s): %s", task_id, e)
+    return ref
+
+
+def find_output(task_id: str) -> output_index.OutputRecord | None:
+    """按 task_id 查产物索引（ref / size / sha256 等）；没有登记时返回 None。"""
+    try:
+        return output_index.get(task_id)
+    except Exception as e:
+        logger.warning("产物索引查询失败 (task_id=%s): %s", task_id, e)
+        return None
+
+
+def find(key: str) -> str | None:
+    store = get_store()
+    return store.ref(key) if store.exists(key) else None
+
+
+def exists(ref: str) -> bool:
+    return bool(ref) and size(ref) is not None
+
+
+def size(ref: str) -> int | None:
+    store, key = _resolve(ref)
+    return store.size(key)
+
+
+def iter_bytes(ref: str, start: int = 0, end: int | None = None) -> Iterator[bytes]:
+    store, key = _resolve(ref)
+    return store.iter_bytes(key, start, end)
+
+
+def local_key(ref: str) -> str | None:
+    """local 后端 OUTPUT_DIR 下的 ref 对应的相对 key（交给前置代理按 key 发送文件）；其他情况 None。"""
+    store, key = _resolve(ref)
+    return key if store is get_store() and isinstance(store, LocalStore) else None
+
+
+def delete(ref: str) -> None:
+    store, key = _resolve(ref)
+    store.delete(key)
+
+
+def scan(prefix: str) -> Iterator[tuple[str, int, float]]:
+    """当前后端 prefix 下的对象：(key, 字节数, 修改时间戳)。"""
+    return get_store().scan(prefix)
+
+
+def local_path(ref: str) -> Path | None:
+    store, key = _resolve(ref)
+    return store.local_path(key)
+
+
+@contextmanager
+def local_copy(ref: str) -> Iterator[Path]:
+    """以本地文件的形式读取 ref：local 后端直接给出原路径，对象存储先下载到临时文件。"""
+    path = local_path(ref)
+    if path is not None:
+        yield path
+        return
+    store, key = _resolve(ref)
+    fd, tmp = tempfile.mkstemp(suffix=Path(key).suffix)
+    os.close(fd)
+    try:
+        store.download_to(key, Path(tmp))
+        yield Path(tmp)
+    finally:
+        os.unlink(tmp)
+
+
+# ---------- 任务图的中间结果 ----------
+# 报关资料任务图各阶段之间传递的 Manifest / xlsx 放在 _dag/<task_id>/ 下（与产物同一个后端），Redis 里只记这里返回的 key。
+# 打包任务结束（不论成败）时整个目录删除；遗留的由保留期清理按 BAOGUAN_DAG_TTL 删除。
+def _scratch_prefix(task_id: str) -> str:
+    return f"_dag/{task_id}/"
+
+
+def put_scratch(task_id: str, name: str, data: bytes) -> str:
+    key = _scratch_prefix(task_id) + name
+    get_store().put(key, BytesIO(data))
+    return key
+
+
+def read_scratch(key: str) -> bytes | None:
+    """key 由 put_scratch 返回；对象已不存在时返回 None。"""
+    store = get_store()
+    if store.size(key) is None:
+        return None
+    return b"".join(store.iter_bytes(key))
+
+
+def remove_scratch(task_id: str) -> None:
+    store = get_store()
+    for key, _, _ in list(store.scan(_scratch_prefix(task_id))):
+        store.delete(key)
+
+
+def scan_scratch() -> Iterator[tuple[str, int, float]]:
+    """所有任务图中间结果：(key, 字节数, 修改时间戳)。"""
+    return get_store().scan("_dag/")
+
+
+# ---------- 上传输入（spool） ----------
+# API 端把上传内容分块写进存储（local：INPUT_DIR；s3：<S3_PREFIX>/_inputs/），RQ 任务里只带 input_key，
+# worker 端再用 mmap 只读映射回来（对象存储先下载到本地临时文件），Redis 中只保存任务元数据。
+
+def input_key(task_id: str) -> str:
+    return f"{task_id}.in"
+
+
+def _input_location(key: str) -> tuple[BlobStore, str]:
+    # key 只取文件名，防止拼出输入目录之外的路径
+    name = Path(key).name
+    store = get_store()
+    if isinstance(store, LocalStore):
+        return LocalStore(S.input_dir), name
+    return store, f"_inputs/{name}"
+
+
+class _MappedInput(mmap.mmap):
+    """只读 mmap，补齐 zipfile / pandas 需要的文件对象接口（3.13 以前的 mmap 没有 seekable）。"""
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+
+def spool_input(src: BinaryIO, task_id: str, chunk_size: int | None = None) -> tuple[str, int, str]:
+    """
+    把上传流按块写入存储，返回 (input_key, 字节数, sha256)。
+    local 先写临时文件再原子替换，worker 不会读到写了一半的文件；s3 大文件走分片上传。
+    """
+    key = input_key(task_id)
+    store, k = _input_location(key)
+    reader = _Reader(src, hashlib.sha256())
+    store.put(k, reader, chunk_size or S.UPLOAD_CHUNK_SIZE)
+    return key, reader.size, reader.digest.hexdigest()
+
+
+@contextmanager
+def _mapped(path: Path) -> Iterator[bytes | mmap.mmap]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        mapped = _MappedInput(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+@contextmanager
+def open_input(key: str) -> Iterator[bytes | mmap.mmap]:
+    """
+    以只读 mmap 打开已落盘的输入，不把整个文件复制进 worker 内存。
+    空文件无法 mmap，直接给出 b""。
+    """
+    store, k = _input_location(key)
+    with local_copy(store.ref(k)) as path, _mapped(path) as data:
+        yield data
+
+
+def scan_inputs() -> Iterator[tuple[str, int, float]]:
+    """所有已落盘的输入：(input_key, 字节数, 修改时间戳)。"""
+    store, prefix = _input_location("")
+    for key, size, mtime in store.scan(prefix):
+        yield Path(key).name, size, mtime
+
+
+def remove_input(key: str) -> None:
+    store, k = _input_location(key)
+    store.delete(k)
 
 
 if __name__ == "__main__":
-    print("hahaha")
-    print(ensure_task_dir("test"))
\ No newline at end of file
+    print(get_store())
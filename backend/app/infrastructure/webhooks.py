@@ -0,0 +1,346 @@
+"""
+任务完成回调（webhook）：上传时带 callback_url，任务结束（成功或失败）后把最终状态和下载地址 POST 过去，
+自动化客户端不用再轮询 /status。
+
+- webhooks:subs:<task_id>：登记在这个任务上的回调地址（set）；加入同一任务的多次上传（结果缓存）各自登记
+- webhooks:delivery:<delivery_id>：每个 (任务, 地址) 一条投递记录（hash）：url、payload、attempts、state、
+  last_status、last_error、next_at；state：pending -> delivered | failed | dropped
+- webhooks:queue：待投递 / 等待重试的 delivery_id（zset，score 是下次投递时间），长度上限 WEBHOOK_QUEUE_MAX，
+  满了以后新的投递直接记为 dropped，不会无限堆积
+- 投递：API 进程里的后台任务（run_dispatcher）取到期的条目，在线程里 POST；2xx 成功，
+  网络错误 / 5xx / 408 / 425 / 429 按指数退避（带抖动）重试，最多 WEBHOOK_MAX_ATTEMPTS 次，其余 3xx / 4xx 不再重试
+- 多个 API 进程：每条投递先抢 webhooks:lease:<delivery_id>（SET NX，带过期），抢到的进程才发；
+  发送途中进程退出的，租约过期后由其他进程重发，所以接收方可能收到重复的回调，按 X-Webhook-Delivery 去重
+
+地址限制（防 SSRF）：登记时和每次投递前都解析主机名，解析到内网 / 本机 / 链路本地等非公网地址的拒绝
+（WEBHOOK_ALLOW_PRIVATE=true 或主机在 WEBHOOK_ALLOWED_HOSTS 内时放行）；不跟随重定向，3xx 按失败处理、不重试。
+
+请求头：X-Webhook-Event（job.finished | job.failed）、X-Webhook-Delivery、X-Webhook-Attempt；
+配置了 WEBHOOK_SECRET 时另有 X-Webhook-Signature: sha256=<对请求体的 HMAC-SHA256>。
+本地联调用 scripts/4-webhook-receiver.py 起一个接收端。
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import random
+import socket
+import time
+import urllib.error
+import urllib.request
+from typing import Any
+from urllib.parse import urlsplit
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from rq.job import Job
+
+from app.core.config import get_settings
+
+logger = logging.getLogger("infrastructure.webhooks")
+settings = get_settings()
+
+_PREFIX = "webhooks"
+_QUEUE = f"{_PREFIX}:queue"
+_RETRYABLE = {408, 425, 429}
+_TERMINAL = {"finished": "job.finished", "failed": "job.failed", "stopped": "job.failed", "canceled": "job.failed"}
+
+
+def _subs_key(task_id: str) -> str:
+    return f"{_PREFIX}:subs:{task_id}"
+
+
+def _delivery_key(delivery_id: str) -> str:
+    return f"{_PREFIX}:delivery:{delivery_id}"
+
+
+def _lease_key(delivery_id: str) -> str:
+    return f"{_PREFIX}:lease:{delivery_id}"
+
+
+def _s(v: Any) -> str:
+    return v.decode() if isinstance(v, bytes) else str(v)
+
+
+def delivery_id(task_id: str, url: str) -> str:
+    return f"{task_id}-{hashlib.sha256(url.encode()).hexdigest()[:12]}"
+
+
+class AddressRejected(ValueError):
+    """回调地址解析到了非公网地址。"""
+
+
+def _check_address(parts) -> None:
+    """主机名解析到的每个地址都必须是公网地址；解析失败或有非公网地址时抛 ValueError。"""
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                   proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        raise ValueError(f"callback_url 的主机无法解析: {parts.hostname}")
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%", 1)[0])
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise AddressRejected(f"callback_url 不能指向内网或本机地址: {parts.hostname} -> {ip}")
+
+
+def validate(url: str) -> str:
+    """
+    检查回调地址：http(s)、有主机名、在 WEBHOOK_ALLOWED_HOSTS 内（配置了的话），
+    且解析到的都是公网地址（WEBHOOK_ALLOW_PRIVATE 或主机在允许列表内时不查）；不合格抛 ValueError。
+    会做 DNS 解析，在事件循环里调用时放到线程里。
+    """
+    url = url.strip()
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("callback_url 必须是 http:// 或 https:// 地址")
+    if len(url) > 2048:
+        raise ValueError("callback_url 过长")
+    allowed = {h.lower() for h in settings.WEBHOOK_ALLOWED_HOSTS}
+    if allowed and parts.hostname.lower() not in allowed:
+        raise ValueError(f"callback_url 的主机不在允许列表内: {parts.hostname}")
+    if not settings.WEBHOOK_ALLOW_PRIVATE and not allowed:
+        _check_address(parts)
+    return url
+
+
+# ---------- 登记与入队 ----------
+def subscribe_cmds(pipe, task_id: str, url: str) -> None:
+    """
+    把登记回调地址的命令加进 pipe（同步或 redis.asyncio 的 pipeline 都可以），由调用方执行，
+    例如与入队在同一个事务里。
+    """
+    pipe.sadd(_subs_key(task_id), url)
+    pipe.expire(_subs_key(task_id), settings.WEBHOOK_TTL_S)
+
+
+def payload_of(job: Job, status: str, result: Any = None) -> dict:
+    """回调请求体：最终状态、产物下载地址（成功时）和失败原因。"""
+    finished = status == "finished"
+    return {
+        "event": _TERMINAL.get(status, "job.failed"),
+        "task_id": job.id,
+        "status": status,
+        "task_type": job.meta.get("task_type"),
+        "filename": job.meta.get("filename"),
+        "output_ext": (result or {}).get("ext") if finished and isinstance(result, dict) else None,
+        "download_url": f"{settings.WEBHOOK_PUBLIC_BASE_URL.rstrip('/')}/files/{job.id}/download" if finished else None,
+        "error": None if finished else (job.meta.get("error_message") or status),
+        "ts": time.time(),
+    }
+
+
+def _enqueue(conn: Redis, task_id: str, url: str, payload: dict) -> str | None:
+    """为 (任务, 地址) 建一条投递并放进队列；已经建过的不重复建。返回 delivery_id，重复时返回 None。"""
+    did = delivery_id(task_id, url)
+    key = _delivery_key(did)
+    if not conn.hsetnx(key, "url", url):
+        return None
+    full = conn.zcard(_QUEUE) >= settings.WEBHOOK_QUEUE_MAX
+    now = time.time()
+    pipe = conn.pipeline()
+    pipe.hset(key, mapping={
+        "task_id": task_id,
+        "payload": json.dumps(payload, ensure_ascii=False, default=str),
+        "attempts": 0,
+        "state": "dropped" if full else "pending",
+        "created": now,
+        "next_at": now,
+    })
+    pipe.expire(key, settings.WEBHOOK_TTL_S)
+    if not full:
+        pipe.zadd(_QUEUE, {did: now})
+    pipe.execute()
+    if full:
+        logger.warning("回调队列已满（%d），丢弃 task_id=%s -> %s", settings.WEBHOOK_QUEUE_MAX, task_id, url)
+    return did
+
+
+def notify(conn: Redis, job: Job, status: str, result: Any = None, urls: list[str] | None = None) -> int:
+    """任务进入结束状态：给登记过的（或 urls 指定的）每个地址建一条投递，返回新建的条数。"""
+    if urls is None:
+        urls = [_s(u) for u in conn.smembers(_subs_key(job.id))]
+    if not urls:
+        return 0
+    payload = payload_of(job, status, result)
+    return sum(1 for url in urls if _enqueue(conn, job.id, url, payload))
+
+
+async def deliveries_async(aconn: AsyncRedis, task_id: str) -> list[dict]:
+    """任务上各个回调地址的投递情况；还没结束的任务 state 为 waiting。"""
+    urls = sorted(_s(u) for u in await aconn.smembers(_subs_key(task_id)))
+    if not urls:
+        return []
+    async with aconn.pipeline(transaction=False) as pipe:
+        for url in urls:
+            pipe.hgetall(_delivery_key(delivery_id(task_id, url)))
+        hashes = await pipe.execute()
+    out = []
+    for url, hash_ in zip(urls, hashes):
+        raw = {_s(k): _s(v) for k, v in hash_.items()}
+        out.append({
+            "url": url,
+            "state": raw.get("state", "waiting"),
+            "attempts": int(raw.get("attempts", 0)),
+            "last_status": int(raw["last_status"]) if raw.get("last_status") else None,
+            "last_error": raw.get("last_error") or None,
+            "next_at": float(raw["next_at"]) if raw.get("state") == "pending" else None,
+        })
+    return out
+
+
+# ---------- worker 端 ----------
+def on_job_success(job, connection: Redis, result: Any) -> None:
+    try:
+        notify(connection, job, "finished", result)
+    except Exception as e:
+        logger.warning("建立完成回调失败 (task_id=%s): %s", job.id, e)
+
+
+def on_job_failure(job, connection: Redis) -> None:
+    try:
+        notify(connection, job, "failed")
+    except Exception as e:
+        logger.warning("建立失败回调失败 (task_id=%s): %s", job.id, e)
+
+
+# ---------- 投递 ----------
+def backoff(attempts: int) -> float:
+    """第 attempts 次失败后等待的秒数：BASE * 2^(attempts-1)，封顶 MAX，±20% 抖动。"""
+    delay = min(settings.WEBHOOK_BACKOFF_MAX_S, settings.WEBHOOK_BACKOFF_BASE_S * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """不跟随重定向：3xx 作为 HTTPError 返回，重定向目标不会绕过地址检查。"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _post(url: str, body: bytes, headers: dict[str, str]) -> tuple[int | None, str | None]:
+    """返回 (HTTP 状态码, 错误描述)；连不上 / 超时时状态码为 None。"""
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with _opener.open(req, timeout=settings.WEBHOOK_TIMEOUT_S) as resp:
+            return resp.status, None
+    except urllib.error.HTTPError as e:
+        return e.code, f"HTTP {e.code}"
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"[:300]
+
+
+def deliver(conn: Redis, did: str) -> str | None:
+    """发一次；返回投递后的 state，条目已不存在（记录过期）时返回 None。调用方需已持有租约。"""
+    key = _delivery_key(did)
+    raw = {_s(k): _s(v) for k, v in conn.hgetall(key).items()}
+    if not raw or raw.get("state") != "pending":
+        conn.zrem(_QUEUE, did)
+        return None
+
+    attempts = int(raw.get("attempts", 0)) + 1
+    body = raw["payload"].encode()
+    headers = {
+        "Content-Type": "application/json; charset=utf-8",
+        "User-Agent": "erp-webhook/1",
+        "X-Webhook-Event": json.loads(body).get("event", ""),
+        "X-Webhook-Delivery": did,
+        "X-Webhook-Attempt": str(attempts),
+    }
+    if settings.WEBHOOK_SECRET:
+        sig = hmac.new(settings.WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers["X-Webhook-Signature"] = f"sha256={sig}"
+
+    try:
+        validate(raw["url"])  # 登记后 DNS 可能变了，投递前再查一次；暂时解析不了的按网络错误重试
+    except AddressRejected as e:
+        status, error, rejected = None, str(e), True
+    except ValueError as e:
+        status, error, rejected = None, str(e), False
+    else:
+        status, error = _post(raw["url"], body, headers)
+        rejected = False
+    now = time.time()
+    if status is not None and 200 <= status < 300:
+        state, next_at = "delivered", None
+    elif rejected or attempts >= settings.WEBHOOK_MAX_ATTEMPTS or (
+        status is not None and 300 <= status < 500 and status not in _RETRYABLE
+    ):
+        state, next_at = "failed", None
+    else:
+        state, next_at = "pending", now + backoff(attempts)
+
+    pipe = conn.pipeline()
+    pipe.hset(key, mapping={
+        "attempts": attempts,
+        "state": state,
+        "last_status": status or "",
+        "last_error": error or "",
+        "next_at": next_at or now,
+    })
+    if next_at:
+        pipe.zadd(_QUEUE, {did: next_at})
+    else:
+        pipe.zrem(_QUEUE, did)
+    pipe.execute()
+
+    if state == "delivered":
+        logger.info("回调已送达 %s (attempt=%d)", did, attempts)
+    elif state == "failed":
+        logger.warning("回调投递放弃 %s -> %s (attempt=%d): %s", did, raw["url"], attempts, error)
+    else:
+        logger.info("回调投递失败 %s (attempt=%d): %s，%.0fs 后重试", did, attempts, error, next_at - now)
+    return state
+
+
+def _claim_due(conn: Redis, limit: int) -> list[str]:
+    """取到期的条目并抢租约；租约期内发送方崩溃，过期后别的进程会再取到。"""
+    due = [_s(d) for d in conn.zrangebyscore(_QUEUE, "-inf", time.time(), start=0, num=limit * 2)]
+    claimed = []
+    lease = settings.WEBHOOK_TIMEOUT_S + 30
+    for did in due:
+        if conn.set(_lease_key(did), "1", nx=True, ex=lease):
+            claimed.append(did)
+            if len(claimed) >= limit:
+                break
+    return claimed
+
+
+def _deliver_leased(conn: Redis, did: str) -> None:
+    try:
+        deliver(conn, did)
+    except Exception:
+        logger.exception("回调投递出错 %s", did)
+    finally:
+        conn.delete(_lease_key(did))
+
+
+def dispatch_once(conn: Redis) -> int:
+    """同步地发一轮到期的回调（测试 / 手动补发用），返回处理的条数。"""
+    claimed = _claim_due(conn, settings.WEBHOOK_CONCURRENCY)
+    for did in claimed:
+        _deliver_leased(conn, did)
+    return len(claimed)
+
+
+async def run_dispatcher(conn: Redis) -> None:
+    """API 进程 lifespan 里启动的后台任务：每 WEBHOOK_POLL_S 取一批到期的回调，在线程里并发发送。"""
+    while True:
+        try:
+            claimed = await asyncio.to_thread(_claim_due, conn, settings.WEBHOOK_CONCURRENCY)
+            if claimed:
+                await asyncio.gather(*(asyncio.to_thread(_deliver_leased, conn, did) for did in claimed))
+                continue  # 可能还有积压，马上取下一批
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("回调分发失败")
+        await asyncio.sleep(settings.WEBHOOK_POLL_S)
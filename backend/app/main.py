@@ -1,6 +1,7 @@
 # backend/app/main.py
 from __future__ import annotations
 
+import asyncio
 import logging
 from typing import Iterable, Generator
 from contextlib import asynccontextmanager
@@ -13,6 +14,8 @@ from app.core.config import get_settings
 from app.core.loggers import setup_logging
 from app.adapters.http.routes import api_router
 from app.infrastructure.db import init_db, dispose_engine  # 关停时释放连接
+from app.infrastructure import inline_pool, retention, webhooks
+from app.infrastructure.redis_client import redis_conn
 
 # ---- logging & settings ----
 setup_logging()
@@ -74,9 +77,20 @@ async def lifespan(app: FastAPI):
     # 注：此时路由已 include 到 app，打印无遗漏
     _log_routes(app)
 
+    # 产物 / 任务记录的保留期清理（多个 API 进程时由 Redis 锁错开）
+    sweeper = asyncio.create_task(retention.run_periodically(redis_conn)) if settings.RETENTION_ENABLED else None
+    # 任务完成回调的投递（多个 API 进程按条目抢租约，不会重复发送）
+    dispatcher = asyncio.create_task(webhooks.run_dispatcher(redis_conn)) if settings.WEBHOOK_ENABLED else None
+
     yield
 
     # ---- shutdown ----
+    if sweeper:
+        sweeper.cancel()
+    if dispatcher:
+        dispatcher.cancel()
+    inline_pool.shutdown()
+
     try:
         await dispose_engine()
         logger.info("DB engine disposed")
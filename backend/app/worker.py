@@ -0,0 +1,219 @@
+"""
+预加载的 RQ worker 入口（替代 `rq worker ... default`）：
+
+    cd backend && python -m app.worker [队列名 ...]     # 不带队列名时监听全部声明的队列
+
+主进程只做一次准备：导入任务模块（pandas / openpyxl / 报关资料构建器），预热模板和公章图片缓存，
+可选地用示例清单完整跑一遍构建，然后 gc.freeze()，再 fork 出 WORKER_PROCESSES 个工作子进程。
+子进程以写时复制方式共享这些已经加载好的内存页，不再为每个任务重新导入或 fork。
+报关资料的并行构建进程池在各子进程里第一次用到时创建，跨任务复用，子进程退出前关闭。
+
+子进程用 SimpleWorker 在本进程内直接执行任务；默认监听所有声明的队列（见 app.infrastructure.queues），
+WORKER_SCHEDULING=weighted 时按队列权重公平取任务，并保证各队列的并发上限。处理满 WORKER_MAX_JOBS 个任务，
+或某个任务结束后 RSS 超过 WORKER_MAX_RSS_MB，就退出，由主进程重新 fork 一个补上，
+以此限制 pandas / openpyxl 长期运行造成的内存碎片。
+
+没有 os.fork 的平台（Windows）上退化为在当前进程里运行单个 worker。
+"""
+from __future__ import annotations
+
+import gc
+import logging
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+from redis import Redis
+from rq import Queue, SimpleWorker
+
+from app.core.config import get_settings
+from app.core.loggers import setup_logging
+from app.infrastructure import queues as rq_queues
+
+logger = logging.getLogger("erp.worker.server")
+settings = get_settings()
+
+RESOURCE_DIR = Path(__file__).resolve().parent / "app_tasks" / "resource"
+
+
+def _rss_mb() -> float:
+    """当前进程常驻内存（MB）。Linux 读 /proc，其余平台用峰值 RSS 近似。"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+class RecyclingWorker(SimpleWorker):
+    """在本进程内执行任务；任务结束后 RSS 超过上限就停止领取新任务，退出后由主进程补一个新的。"""
+
+    max_rss_mb: int = 0
+
+    def execute_job(self, job, queue):
+        super().execute_job(job, queue)
+        if self.max_rss_mb:
+            rss = _rss_mb()
+            if rss > self.max_rss_mb:
+                self.log.info("Worker %s: RSS %.0fMB 超过上限 %dMB，处理完当前任务后退出",
+                              self.name, rss, self.max_rss_mb)
+                self._stop_requested = True
+
+
+class WeightedWorker(RecyclingWorker):
+    """
+    按 RQ_QUEUES 的权重公平地从多个队列取任务（平滑加权轮询：只有积压的队列参与，每轮加上自己的权重，
+    积分最高的排在最前，取到后扣掉那一轮参与队列的权重之和）。
+    走 RQ 的 reorder_queues() 扩展点：每取到一个任务 RQ 调用它，这里重排 _ordered_queues，
+    下一次 dequeue_any 按这个顺序取（LPOP / BLPOP 都优先取排在前面的队列）。
+    concurrency 上限由 queue_class=CappedQueue 在每次领取时检查：已满的队列不参与领取，
+    取到任务即占一个名额，任务执行完（成功或失败）在 execute_job 里释放。
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("queue_class", rq_queues.CappedQueue)
+        super().__init__(*args, **kwargs)
+        self._credits: dict[str, int] = {}
+        self._round: list[str] = []  # 当前顺序里参与加权的（有积压、未满的）队列
+
+    def _saturated(self, q: Queue) -> bool:
+        limit = rq_queues.concurrency_of(q.name)
+        return bool(limit) and rq_queues.running_count(self.connection, q.name) >= limit
+
+    def execute_job(self, job, queue):
+        try:
+            super().execute_job(job, queue)
+        finally:
+            if rq_queues.concurrency_of(queue.name):
+                rq_queues.release_slot(self.connection, queue.name, job.id)
+
+    def reorder_queues(self, reference_queue: Queue) -> None:
+        credits = self._credits
+        if reference_queue.name in self._round:
+            credits[reference_queue.name] -= sum(rq_queues.weight_of(n) for n in self._round)
+
+        pipe = self.connection.pipeline()
+        for q in self.queues:
+            pipe.llen(q.key)
+        depths = dict(zip((q.name for q in self.queues), pipe.execute()))
+        saturated = {q.name for q in self.queues if depths[q.name] and self._saturated(q)}
+
+        ready = [q for q in self.queues if depths[q.name] and q.name not in saturated]
+        for q in ready:
+            credits[q.name] = credits.get(q.name, 0) + rq_queues.weight_of(q.name)
+        ready.sort(key=lambda q: credits[q.name], reverse=True)
+        # 空队列按权重排在后面（阻塞等待时先到的任务先取）；已满的放最后，领取时 CappedQueue 会跳过它们
+        rest = sorted((q for q in self.queues if q not in ready),
+                      key=lambda q: (q.name in saturated, -rq_queues.weight_of(q.name)))
+        self._round = [q.name for q in ready]
+        self._ordered_queues = ready + rest
+
+
+def preload() -> None:
+    """在 fork 之前把任务要用的模块和资源加载进主进程。"""
+    t0 = time.perf_counter()
+    from app.app_tasks import process, baoguan_dag  # noqa: F401  pandas / openpyxl / 各构建器
+    from app.app_tasks import process_BaoGuan as pb
+    from app.app_tasks.baoGuan import z_resources
+
+    z_resources.template_workbook(pb.BAOGUAN_TEMPLATE_PATH)
+    z_resources.stamp_png(pb.GONGZHANG_PATH, 320)
+    z_resources.stamp_png(pb.GONGZHANG_PATH, 300)
+
+    sample = RESOURCE_DIR / "example.xlsx"
+    if settings.WORKER_WARMUP and sample.exists():
+        # 串行跑一遍 5 个构建器，把 openpyxl 写出、PIL 编码等延迟导入的代码路径都走到
+        from app.app_tasks.baoGuan.a_extractInfo import ExcelReader
+
+        manifest = ExcelReader(sample.read_bytes()).read_manifest()
+        hetong_no = manifest.first("合同号码", "")
+        for idx in range(len(pb.DOCUMENT_BUILDERS)):
+            pb._build_document(idx, manifest, hetong_no)
+
+    gc.collect()
+    gc.freeze()  # 之后子进程里的 GC 不再扫描/改写这些对象，共享页保持不被复制
+    logger.info(f"预加载完成，用时 {time.perf_counter() - t0:.2f}s，RSS {_rss_mb():.0f}MB")
+
+
+def run_worker(queues: list[str]) -> None:
+    """在当前进程里跑一个 worker，直到达到回收条件或收到停止信号。"""
+    conn = Redis.from_url(settings.REDIS_URL)  # fork 之后各自新建连接，不共用父进程的 socket
+    worker_class = WeightedWorker if settings.WORKER_SCHEDULING == "weighted" else RecyclingWorker
+    worker = worker_class(queues, connection=conn)
+    worker.max_rss_mb = settings.WORKER_MAX_RSS_MB
+    try:
+        worker.work(max_jobs=settings.WORKER_MAX_JOBS or None, logging_level=settings.LOG_LEVEL)
+    finally:
+        # 构建进程池在本进程第一次并行构建时创建、跨任务复用，退出（含 os._exit 回收）前关掉
+        from app.app_tasks import process_BaoGuan as pb
+
+        pb.shutdown_pool()
+
+
+def serve(queues: list[str]) -> None:
+    setup_logging()
+    preload()
+
+    if not hasattr(os, "fork"):
+        run_worker(queues)
+        return
+
+    children: dict[int, int] = {}  # pid -> 槽位
+    stopping = False
+
+    def spawn(slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_worker(queues)
+            except BaseException:
+                logger.exception("工作子进程异常退出")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = slot
+        logger.info(f"启动工作子进程 slot={slot} pid={pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for slot in range(max(1, settings.WORKER_PROCESSES)):
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0:
+            logger.warning(f"工作子进程 pid={pid} 退出码 {code}，1s 后重新启动")
+            time.sleep(1)
+        spawn(slot)
+
+    logger.info("所有工作子进程已退出")
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1:] or rq_queues.declared_queues())
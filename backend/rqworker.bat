@@ -37,8 +37,8 @@ echo OUTPUT_DIR = %OUTPUT_DIR%
 echo.
 echo Starting RQ worker...
 
-REM -u 用引号更安全；-P 用当前目录
-rq worker -u "%REDIS_URL%" default --worker-class rq.SimpleWorker -P "%CD%"
+REM Windows 没有 fork，app.worker 会在当前进程里运行单个 SimpleWorker
+python -m app.worker
 
 endlocal
 pause
\ No newline at end of file
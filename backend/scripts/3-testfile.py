@@ -12,6 +12,7 @@ FILES_BASE = f"{BASE_URL}{API_PREFIX}/files"
 
 POLL_INTERVAL_SEC = 1.0    # 轮询间隔
 POLL_TIMEOUT_SEC = 120     # 轮询超时
+CALLBACK_URL = None        # 例 "http://127.0.0.1:9009/hook"：任务结束后服务端 POST 结果过来（见 4-webhook-receiver.py），不用轮询
 
 # ====== 小工具 ======
 def _get_filename_from_cd(cd: str | None) -> str | None:
@@ -25,6 +26,8 @@ def upload_bytes(data: bytes, filename: str, task_type: str = "text") -> str:
     """上传原始字节；也可以改成传文件路径"""
     files = {"file": (filename, data)}
     params = {"task_type": task_type}
+    if CALLBACK_URL:
+        params["callback_url"] = CALLBACK_URL
     r = requests.post(f"{FILES_BASE}", files=files, params=params, timeout=30)
     r.raise_for_status()
     resp = r.json()
@@ -0,0 +1,56 @@
+# webhook_receiver.py
+# 本地联调用的回调接收端：打印收到的每个回调，可以让前几次请求失败来观察重试退避。
+#   python scripts/4-webhook-receiver.py --port 9009
+#   python scripts/4-webhook-receiver.py --port 9009 --fail 2 --status 503   # 前 2 次返回 503
+# 上传时带 callback_url=http://127.0.0.1:9009/hook（见 3-testfile.py 的 CALLBACK_URL；本机地址要 WEBHOOK_ALLOW_PRIVATE=true，.env 里已开）
+import argparse
+import hashlib
+import hmac
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=9009)
+parser.add_argument("--fail", type=int, default=0, help="前 N 次请求返回 --status")
+parser.add_argument("--status", type=int, default=503)
+parser.add_argument("--secret", default="", help="与 WEBHOOK_SECRET 相同时校验 X-Webhook-Signature")
+args = parser.parse_args()
+
+seen = {"count": 0}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        seen["count"] += 1
+        n = seen["count"]
+
+        sig_ok = "-"
+        if args.secret:
+            expect = "sha256=" + hmac.new(args.secret.encode(), body, hashlib.sha256).hexdigest()
+            sig_ok = hmac.compare_digest(expect, self.headers.get("X-Webhook-Signature", ""))
+
+        status = args.status if n <= args.fail else 200
+        print(
+            f"[{time.strftime('%H:%M:%S')}] #{n} {self.path} -> {status} "
+            f"event={self.headers.get('X-Webhook-Event')} delivery={self.headers.get('X-Webhook-Delivery')} "
+            f"attempt={self.headers.get('X-Webhook-Attempt')} signature_ok={sig_ok}"
+        )
+        try:
+            print(json.dumps(json.loads(body), indent=2, ensure_ascii=False))
+        except ValueError:
+            print(body[:500])
+
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *a):  # 上面已经打印过
+        pass
+
+
+if __name__ == "__main__":
+    print(f"listening on http://{args.host}:{args.port}  (fail first {args.fail} with {args.status})")
+    ThreadingHTTPServer((args.host, args.port), Handler).serve_forever()